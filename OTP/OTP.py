@@ -27,7 +27,7 @@ from builtins import object
 import os
 from PyQt5.QtCore import (QSettings, QTranslator, qVersion,
                               QCoreApplication, QProcess, QDateTime,
-                              QVariant, QLocale, QDate)
+                              QVariant, QLocale, QDate, Qt)
 from PyQt5.QtWidgets import (QAction, QListWidgetItem, QCheckBox,
                                  QMessageBox, QLabel, QDoubleSpinBox,
                                  QFileDialog, QInputDialog, QLineEdit)
@@ -37,12 +37,21 @@ from sys import platform
 from .config import (AVAILABLE_TRAVERSE_MODES,
                     DATETIME_FORMAT, AGGREGATION_MODES, ACCUMULATION_MODES,
                     DEFAULT_FILE, CALC_REACHABILITY_MODE,
-                    VM_MEMORY_RESERVED, Config, MANUAL_URL)
-from .dialogs import ExecOTPDialog, RouterDialog, InfoDialog
+                    VM_MEMORY_RESERVED, Config, MANUAL_URL, update_meta,
+                    output_format)
+from .dialogs import (ExecOTPDialog, ExecOTPServerDialog, RouterDialog,
+                      InfoDialog, JobMonitorDialog, shutdown_otp_server)
 from qgis._core import (QgsVectorLayer, QgsVectorLayerJoinInfo,
                         QgsCoordinateReferenceSystem, QgsField)
-from qgis.core import QgsVectorFileWriter, QgsProject
+from qgis.core import (QgsVectorFileWriter, QgsProject, QgsFeatureRequest,
+                       QgsCoordinateTransform, NULL)
 from .dialogs import OTPMainWindow
+from .cache import ResultCache
+from .incremental import IncrementalUpdate, keep_inputs
+from .points import write_points
+from .results import results_to_geopackage, write_to_layer, table_name
+from .jobs import Job, JobQueue
+from .jvm import estimate_memory, choose_resources, HEADROOM
 import locale
 import tempfile
 import shutil
@@ -117,6 +126,10 @@ class OTP(object):
         config.read(do_create=True)
         self.config_control = ConfigurationControl(self.dlg)
 
+        # evaluations running in the background
+        self.job_queue = JobQueue()
+        self.job_monitor = None
+
         self.setup_UI()
 
     def save(self):
@@ -301,6 +314,12 @@ class OTP(object):
         self.dlg.refresh_layers_button.clicked.connect(
             lambda: self.fill_layer_combos())
 
+        # cores and memory are chosen per evaluation if automatic
+        def toggle_auto_resources(auto):
+            self.dlg.cpu_edit.setEnabled(not auto)
+            self.dlg.memory_edit.setEnabled(not auto)
+        self.dlg.auto_resources_check.toggled.connect(toggle_auto_resources)
+
         # connect menu actions
         self.dlg.reset_config_action.triggered.connect(
             self.config_control.reset_to_default)
@@ -311,6 +330,7 @@ class OTP(object):
         self.dlg.close_action.triggered.connect(self.dlg.close)
         self.dlg.info_action.triggered.connect(self.info)
         self.dlg.manual_action.triggered.connect(self.open_manual)
+        self.dlg.job_monitor_action.triggered.connect(self.show_job_monitor)
 
         # apply settings to UI (the layers are unknown at QGIS startup,
         # so don't expect them to be already selected)
@@ -453,6 +473,14 @@ class OTP(object):
             self.iface.removeToolBarIcon(action)
         # remove the toolbar
         del self.toolbar
+        # stop the evaluations running in the background
+        self.job_queue.cancel_all()
+        if self.job_monitor is not None:
+            self.job_monitor.close()
+        # stop the evaluation server, it would keep the graphs in memory
+        sys_settings = config.settings['system']
+        if sys_settings['server'] in ['True', True]:
+            shutdown_otp_server(int(sys_settings['server_port']))
 
     def set_date(self, time=None):
         date = self.dlg.calendar_edit.selectedDate()
@@ -803,7 +831,7 @@ class OTP(object):
         temp_dest_layer.addExpressionField('1', reach_field)
         agg_acc['processed_field'] = reach_field_name
         # take the set max travel time as the threshold (in seconds)
-        threshold = int(config.settings['router_config']['max_time_min']) * 60
+        threshold = config.typed()['router_config']['max_time_min'] * 60
         agg_acc['params'] = [str(threshold)]
 
         if self.dlg.reachability_csv_check.checkState():
@@ -835,6 +863,14 @@ class OTP(object):
 
         # update settings and save them
         self.save()
+        # the settings at the start of the evaluation, the results of jobs
+        # running in the background are added after the settings might
+        # have changed
+        settings = config.typed()
+        if result_layer_name is None:
+            result_layer_name = 'results-{}-{}-{}'.format(
+                self.dlg.router_combo.currentText(),
+                self.dlg.origins_combo.currentText(), now_string)
 
         # LAYERS
         if origin_layer is None:
@@ -857,56 +893,103 @@ class OTP(object):
 
         working_dir = os.path.dirname(__file__)
 
+        sys_settings = settings['system']
+        if sys_settings['auto_resources']:
+            resources = self.estimate_resources(origin_layer,
+                                                destination_layer, settings)
+            available = resources['available']
+            if (available is not None and
+                resources['estimated'] * HEADROOM > available):
+                reply = QMessageBox.question(
+                    self.dlg, 'Hinweis',
+                    u'Die Berechnung benötigt voraussichtlich {:.1f} GB '
+                    u'Arbeitsspeicher, verfügbar sind nur {:.1f} GB.\n'
+                    u'Soll die Berechnung trotzdem gestartet werden?'.format(
+                        resources['estimated'] * HEADROOM, available),
+                    QMessageBox.Ok, QMessageBox.Cancel)
+                if reply == QMessageBox.Cancel:
+                    return
+            # the chosen values only apply to the config of this run, the
+            # settings of the user are kept
+            sys_settings['reserved'] = resources['memory']
+            sys_settings['n_threads'] = resources['n_threads']
+        else:
+            resources = {'memory': sys_settings['reserved'],
+                         'n_threads': sys_settings['n_threads'],
+                         'jvm_args': []}
+        memory = resources['memory']
+
         # write config to temporary directory with additional meta infos
         tmp_dir = tempfile.mkdtemp()
         config_xml = os.path.join(tmp_dir, 'config.xml')
         meta = {
             'date_of_calculation': now_string,
-            'user': getpass.getuser()
+            'user': getpass.getuser(),
+            'resources': resources
         }
-        config.write(config_xml, hide_inactive=True, meta=meta)
-
-        # convert layers to csv and write them to temporary directory
-        orig_tmp_filename = os.path.join(tmp_dir, 'origins.csv')
-        dest_tmp_filename = os.path.join(tmp_dir, 'destinations.csv')
-
-        wgs84 = QgsCoordinateReferenceSystem(4326)
-        non_geom_fields = get_non_geom_indices(origin_layer)
-        selected_only = (self.dlg.selected_only_check.isChecked() and
-                         origin_layer.selectedFeatureCount() > 0)
-        QgsVectorFileWriter.writeAsVectorFormat(
-            origin_layer,
-            orig_tmp_filename,
-            "utf-8",
-            wgs84,
-            "CSV",
-            onlySelected=selected_only,
-            attributes=non_geom_fields,
-            layerOptions=["GEOMETRY=AS_YX"])
-
-        non_geom_fields = get_non_geom_indices(destination_layer)
-        selected_only = (self.dlg.selected_only_check.isChecked() and
-                         destination_layer.selectedFeatureCount() > 0)
-        QgsVectorFileWriter.writeAsVectorFormat(
-            destination_layer,
-            dest_tmp_filename,
-            "utf-8",
-            wgs84,
-            "CSV",
-            onlySelected=selected_only,
-            attributes=non_geom_fields,
-            layerOptions=["GEOMETRY=AS_YX"])
+        # the plugin reads the results as csv, the extension of the target
+        # decides the format of the results (instead of the config)
+        settings['post_processing']['output_format'] = ''
+        config.write(config_xml, hide_inactive=True, meta=meta,
+                     settings=settings)
+
+        # export the needed fields of the layers as points files to the
+        # temporary directory
+        orig_tmp_filename = os.path.join(tmp_dir, 'origins.pts')
+        dest_tmp_filename = os.path.join(tmp_dir, 'destinations.pts')
+
+        for layer, filename, is_destination in [
+            (origin_layer, orig_tmp_filename, False),
+            (destination_layer, dest_tmp_filename, True)]:
+            selected_only = (self.dlg.selected_only_check.isChecked() and
+                             layer.selectedFeatureCount() > 0)
+            fields = get_export_fields(layer, settings,
+                                       is_destination=is_destination)
+            export_points(layer, filename, fields, selected_only=selected_only)
 
         print('wrote origins and destinations to temporary folder "{}"'.format(
             tmp_dir))
 
+        # only results written to csv files can be updated later on
+        incremental = (target_file is not None and
+                       output_format(target_file) == 'csv' and
+                       sys_settings['incremental'])
+        update = None
+        dst_config = None
         if target_file is not None:
-            # copy config to file with similar name as results file
+            # config with similar name as results file
             dst_config = os.path.splitext(target_file)[0] + '-config.xml'
-            shutil.copy(config_xml, dst_config)
+            # compare with the previous run into the same file
+            if incremental:
+                update = IncrementalUpdate(target_file, dst_config,
+                                           config_xml, orig_tmp_filename,
+                                           dest_tmp_filename)
+                if not update.possible:
+                    update = None
         else:
             target_file = os.path.join(tmp_dir, 'results.csv')
 
+        if output_format(target_file) != 'csv' and (add_results or
+                                                    join_results):
+            msg_box = QMessageBox(
+                QMessageBox.Warning, "Hinweis",
+                u'Nur Ergebnisse im CSV-Format können als Layer '
+                u'hinzugefügt werden, die Ergebnisse werden nur in die '
+                u'Datei {} geschrieben.'.format(target_file))
+            msg_box.exec_()
+            add_results = join_results = False
+
+        def keep_run():
+            '''
+            store the config and the inputs of the run next to its results
+            (the next incremental run compares with them), only call it
+            after the results were written
+            '''
+            if dst_config is not None:
+                shutil.copy(config_xml, dst_config)
+            if incremental:
+                keep_inputs(target_file, orig_tmp_filename, dest_tmp_filename)
+
         target_path = os.path.dirname(target_file)
 
         if not os.path.exists(target_path):
@@ -938,7 +1021,6 @@ class OTP(object):
             msg_box.exec_()
             return
         java_executable = self.dlg.java_edit.text()
-        memory = self.dlg.memory_edit.value()
         if not os.path.exists(java_executable):
             msg_box = QMessageBox(
                 QMessageBox.Warning, "Fehler",
@@ -947,12 +1029,9 @@ class OTP(object):
             return
         # ToDo: add parameter after java, causes errors atm
         # basic cmd is same for all evaluations
-        cmd = '''"{java_executable}" -Xmx{ram_GB}G -jar "{jython_jar}"
+        cmd = '''"{java_executable}" -Xmx{ram_GB}G {jvm_args} -jar "{jython_jar}"
         -Dpython.path="{otp_jar}"
-        {wd}/otp_batch.py
-        --config "{config_xml}"
-        --origins "{origins}" --destinations "{destinations}"
-        --target "{target}" --nlines {nlines}'''
+        {wd}/otp_batch.py'''
 
         cmd = cmd.format(
             java_executable=java_executable,
@@ -960,66 +1039,232 @@ class OTP(object):
             otp_jar=otp_jar,
             wd=working_dir,
             ram_GB=memory,
-            config_xml = config_xml,
-            origins=orig_tmp_filename,
-            destinations=dest_tmp_filename,
-            target=target_file,
-            nlines=PRINT_EVERY_N_LINES
+            jvm_args=' '.join(resources['jvm_args'])
         )
 
-        times = config.settings['time']
-        arrive_by = times['arrive_by']
-        if arrive_by == True or arrive_by == 'True':
+        args = ['--config', config_xml,
+                '--origins', orig_tmp_filename,
+                '--destinations', dest_tmp_filename,
+                '--target', target_file,
+                '--nlines', str(PRINT_EVERY_N_LINES)]
+
+        use_server = sys_settings['server']
+        server_port = sys_settings['server_port']
+
+        times = settings['time']
+        if times['arrive_by']:
             n_points = destination_layer.featureCount()
         else:
             n_points = origin_layer.featureCount()
 
         time_batch = times['time_batch']
-        batch_active = time_batch['active']
-        if batch_active == 'True' or batch_active == True:
+        if time_batch['active'] and time_batch['time_step']:
             dt_begin = datetime.strptime(times['datetime'], DATETIME_FORMAT)
             dt_end = datetime.strptime(time_batch['datetime_end'],
                                        DATETIME_FORMAT)
             n_iterations = ((dt_end - dt_begin).total_seconds() /
-                            (int(time_batch['time_step']) * 60) + 1)
+                            (time_batch['time_step'] * 60) + 1)
         else:
             n_iterations = 1
 
-        diag = ExecOTPDialog(cmd,
-                             parent=self.dlg,
-                             auto_start=True,
-                             n_points=n_points,
-                             n_iterations=n_iterations,
-                             points_per_tick=PRINT_EVERY_N_LINES)
-        diag.exec_()
+        # only the changed sources are routed, the results are patched
+        batch_target = target_file
+        if update is not None:
+            print('{} source(s) changed since the last run'.format(
+                len(update.replaced)))
+            if not update.changed:
+                update.patch()
+                keep_run()
+                self.add_results(target_file, tmp_dir, now_string,
+                                 origin_layer, add_results=add_results,
+                                 join_results=join_results,
+                                 result_layer_name=result_layer_name,
+                                 settings=settings)
+                return
+            changed_csv = os.path.join(tmp_dir, 'changed.csv')
+            update.write_changed(changed_csv)
+            batch_target = os.path.join(tmp_dir, 'update.csv')
+            sources_arg = '--destinations' if update.arrive_by else '--origins'
+            args[args.index(sources_arg) + 1] = changed_csv
+            args[args.index('--target') + 1] = batch_target
+            n_points = len(update.changed)
+
+        # identical jobs are taken from the cache, only csv results are
+        # cached (the binary formats come with sidecar files)
+        cache = None
+        if (update is None and output_format(target_file) == 'csv' and
+            sys_settings['cache']):
+            cache = ResultCache(sys_settings['cache_path'],
+                                sys_settings['cache_size_mb'])
+            cache_key = cache.key(settings, orig_tmp_filename,
+                                  dest_tmp_filename,
+                                  os.path.splitext(target_file)[1])
+            if cache.get(cache_key, target_file):
+                print('results taken from cache ({})'.format(cache_key))
+                keep_run()
+                self.add_results(target_file, tmp_dir, now_string,
+                                 origin_layer, add_results=add_results,
+                                 join_results=join_results,
+                                 result_layer_name=result_layer_name,
+                                 settings=settings)
+                return
+
+        # jobs in the background are started by the queue, the dialog is
+        # parented to the QGIS window, the plugin window may be closed
+        background = sys_settings['job_queue']
+        parent = self.iface.mainWindow() if background else self.dlg
+        if use_server:
+            server_cmd = cmd + ' --serve --port {}'.format(server_port)
+            diag = ExecOTPServerDialog(args, server_port, server_cmd,
+                                       parent=parent,
+                                       auto_start=not background,
+                                       n_points=n_points,
+                                       n_iterations=n_iterations,
+                                       points_per_tick=PRINT_EVERY_N_LINES)
+        else:
+            cmd += ''.join(' "{}"'.format(arg) for arg in args)
+            diag = ExecOTPDialog(cmd,
+                                 parent=parent,
+                                 auto_start=not background,
+                                 n_points=n_points,
+                                 n_iterations=n_iterations,
+                                 points_per_tick=PRINT_EVERY_N_LINES)
+
+        def finish(success):
+            if not success:
+                shutil.rmtree(tmp_dir)
+                return
+            if cache is not None:
+                cache.put(cache_key, target_file)
+            if update is not None:
+                update.patch(batch_target)
+            keep_run()
+            # the peak usage of the heap is reported by the batch analysis
+            heap_peak = (diag.progress or {}).get('heap_peak_mb')
+            if dst_config is not None and heap_peak is not None:
+                update_meta(dst_config, {'heap_peak_mb': heap_peak})
+
+            self.add_results(target_file, tmp_dir, now_string, origin_layer,
+                             add_results=add_results,
+                             join_results=join_results,
+                             result_layer_name=result_layer_name,
+                             settings=settings)
+
+        if not background:
+            diag.exec_()
+            finish(diag.success)
+            return
+
+        self.job_queue.set_budget(max_jobs=sys_settings['queue_max_jobs'],
+                                  max_cores=sys_settings['queue_max_cores'],
+                                  max_memory=sys_settings['queue_max_memory'])
+        job_name = '{}: {} -> {} ({})'.format(
+            self.dlg.router_combo.currentText(), origin_layer.name(),
+            destination_layer.name(), now_string)
+        self.job_queue.add(Job(job_name, diag, on_finished=finish,
+                               cores=resources['n_threads'],
+                               memory=memory, server=use_server))
+        self.show_job_monitor()
+
+    def estimate_resources(self, origin_layer, destination_layer, settings):
+        '''
+        choose heap, garbage collector and number of threads of the
+        evaluation of the given layers from the estimated peak memory and
+        the resources of the machine (see jvm.choose_resources)
+
+        evaluations running at once in the background share the budget of
+        the job queue
+        '''
+        sys_settings = settings['system']
+        postproc = settings['post_processing']
+        router_config = settings['router_config']
+        counts = []
+        for layer in [origin_layer, destination_layer]:
+            selected_only = (self.dlg.selected_only_check.isChecked() and
+                             layer.selectedFeatureCount() > 0)
+            counts.append(layer.selectedFeatureCount() if selected_only
+                          else layer.featureCount())
+        n_sources, n_targets = counts
+        if settings['time']['arrive_by']:
+            n_sources, n_targets = n_targets, n_sources
+        time_batch = settings['time']['time_batch']
+        n_parallel_times = (sys_settings['n_parallel_times']
+                            if time_batch['active'] else 1)
+        merged = (postproc['aggregation_accumulation']['active'] or
+                  bool(postproc['best_of']))
+        graph_file = os.path.join(router_config['path'],
+                                  router_config['router'], 'Graph.obj')
+
+        def estimate(n_threads):
+            return estimate_memory(
+                graph_file, n_sources, n_targets, n_threads=n_threads,
+                n_parallel_times=min(n_parallel_times, n_threads),
+                calculate_details=postproc['details'],
+                write_dest_data=postproc['dest_data'], merged=merged)
+
+        max_cores = max_memory = None
+        if sys_settings['job_queue']:
+            n_jobs = max(sys_settings['queue_max_jobs'], 1)
+            if sys_settings['queue_max_cores']:
+                max_cores = max(sys_settings['queue_max_cores'] // n_jobs, 1)
+            if sys_settings['queue_max_memory']:
+                max_memory = max(sys_settings['queue_max_memory'] // n_jobs, 1)
+        return choose_resources(estimate, max_cores=max_cores,
+                                max_memory=max_memory)
+
+    def show_job_monitor(self):
+        '''
+        show the (non-modal) monitor of the evaluations in the background
+        '''
+        if self.job_monitor is None:
+            self.job_monitor = JobMonitorDialog(
+                self.job_queue, parent=self.iface.mainWindow())
+        self.job_monitor.show()
+        self.job_monitor.raise_()
+
+    def add_results(self, target_file, tmp_dir, now_string, origin_layer,
+                    add_results=False, join_results=False,
+                    result_layer_name=None, settings=None):
+        '''
+        add the results as layer to QGIS and/or join them to the origins
 
-        # not successful or no need to add layers to QGIS ->
-        # just remove temporary files
-        if not diag.success or (not add_results and not join_results):
+        the (typed) settings the results were evaluated with default to the
+        current ones
+        '''
+        if settings is None:
+            settings = config.typed()
+        # no need to add layers to QGIS -> just remove temporary files
+        if not add_results and not join_results:
             shutil.rmtree(tmp_dir)
             return
 
         ### add/join layers in QGIS after OTP is done ###
 
-        if result_layer_name is None:
-            result_layer_name = 'results-{}-{}'.format(
-                self.dlg.router_combo.currentText(),
-                self.dlg.origins_combo.currentText())
-            result_layer_name += '-' + now_string
-        # WARNING: csv layer is only link to file,
-        # if temporary is removed you won't see anything later
-        #result_layer = self.iface.addVectorLayer(target_file,
-                                                 #result_layer_name,
-                                                 #'delimitedtext')
-        uri = 'file:///' + target_file + '?type=csv&delimiter=;'
-        result_layer = QgsVectorLayer(uri, result_layer_name, 'delimitedtext')
+        # aggregated values (one row per origin) are written straight into
+        # fields of the origins, if the provider allows it
+        agg_acc = settings['post_processing']['aggregation_accumulation']
+        if (join_results and agg_acc['active'] and
+            agg_acc['mode'] in AGGREGATION_MODES):
+            oid = settings['origin']['id_field']
+            if write_to_layer(origin_layer, oid, target_file):
+                join_results = False
+                if not add_results:
+                    shutil.rmtree(tmp_dir)
+                    return
+
+        # the results are stored in a GeoPackage next to the results file
+        # (with indexed ids), the layer links to it, so it has to be kept
+        gpkg_file = os.path.splitext(target_file)[0] + '.gpkg'
+        result_layer = results_to_geopackage(
+            target_file, gpkg_file, table_name('results_' + now_string),
+            layer_name=result_layer_name)
         QgsProject.instance().addMapLayer(result_layer)
 
         if join_results:
             join = QgsVectorLayerJoinInfo()
             join.setJoinLayerId(result_layer.id())
             join.setJoinFieldName('origin id')
-            join.setTargetFieldName(config.settings['origin']['id_field'])
+            join.setTargetFieldName(settings['origin']['id_field'])
             join.setUsingMemoryCache(True)
             join.setJoinLayer(result_layer)
             origin_layer.addJoin(join)
@@ -1167,7 +1412,22 @@ class ConfigurationControl(object):
         self.dlg.jython_edit.setText(jython_jar)
         self.dlg.java_edit.setText(java)
         self.dlg.cpu_edit.setValue(n_threads)
+        self.dlg.parallel_times_edit.setValue(
+            int(sys_settings['n_parallel_times']))
         self.dlg.memory_edit.setValue(memory)
+        self.dlg.server_check.setChecked(sys_settings['server'] in ['True', True])
+        self.dlg.cache_check.setChecked(sys_settings['cache'] in ['True', True])
+        self.dlg.incremental_check.setChecked(
+            sys_settings['incremental'] in ['True', True])
+        self.dlg.job_queue_check.setChecked(
+            sys_settings['job_queue'] in ['True', True])
+        self.dlg.auto_resources_check.setChecked(
+            sys_settings['auto_resources'] in ['True', True])
+        self.dlg.queue_jobs_edit.setValue(int(sys_settings['queue_max_jobs']))
+        self.dlg.queue_cores_edit.setValue(
+            int(sys_settings['queue_max_cores']))
+        self.dlg.queue_memory_edit.setValue(
+            int(sys_settings['queue_max_memory']))
 
     def update(self):
         '''
@@ -1236,10 +1496,20 @@ class ConfigurationControl(object):
         java = self.dlg.java_edit.text()
         graph_path = self.dlg.graph_path_edit.text()
         sys_settings['n_threads'] = n_threads
+        sys_settings['n_parallel_times'] = self.dlg.parallel_times_edit.value()
         sys_settings['reserved'] = memory
         sys_settings['otp_jar_file'] = otp_jar
         sys_settings['jython_jar_file'] = jython_jar
         sys_settings['java'] = java
+        sys_settings['server'] = self.dlg.server_check.isChecked()
+        sys_settings['cache'] = self.dlg.cache_check.isChecked()
+        sys_settings['incremental'] = self.dlg.incremental_check.isChecked()
+        sys_settings['job_queue'] = self.dlg.job_queue_check.isChecked()
+        sys_settings['auto_resources'] = \
+            self.dlg.auto_resources_check.isChecked()
+        sys_settings['queue_max_jobs'] = self.dlg.queue_jobs_edit.value()
+        sys_settings['queue_max_cores'] = self.dlg.queue_cores_edit.value()
+        sys_settings['queue_max_memory'] = self.dlg.queue_memory_edit.value()
         config.settings['router_config']['path'] = graph_path
 
     def save(self):
@@ -1289,13 +1559,69 @@ def get_geometry_fields(layer):
             geoms.append(field.name())
     return geoms
 
-def get_non_geom_indices(layer):
-    '''return the indices of all fields of a given layer except the geometry fields'''
-    indices = []
-    for i, field in enumerate(layer.fields()):
-        if field.typeName() != 'geometry':
-            indices.append(i)
-    return indices
+def get_export_fields(layer, settings, is_destination=False):
+    '''
+    return the names of the fields of the origin resp. destination layer the
+    batch analysis with the given settings needs (in order of the layer):
+
+    - the id field
+    - the processed field, of the targets if aggregated, of the sources
+      (origins resp. destinations if arrive by) if accumulated
+    - all fields of the destinations, if their data is written to the
+      results (only without aggregation/accumulation)
+
+    the settings are expected to be typed (see Config.typed)
+    '''
+    role = 'destination' if is_destination else 'origin'
+    names = [field.name() for field in layer.fields()
+             if field.typeName() != 'geometry']
+    needed = [settings[role]['id_field']]
+    postproc = settings['post_processing']
+    agg_acc = postproc['aggregation_accumulation']
+    if agg_acc['active']:
+        is_source = is_destination == settings['time']['arrive_by']
+        if is_source == (agg_acc['mode'] in ACCUMULATION_MODES):
+            needed.append(agg_acc['processed_field'])
+    elif is_destination and postproc['dest_data']:
+        return names
+    return [name for name in names if name in needed]
+
+def export_points(layer, filename, field_names, selected_only=False):
+    '''
+    write the features of the layer with the given fields as points file
+    (see points.py), the coordinates are transformed to WGS84, features
+    without geometry are skipped
+    '''
+    transform = QgsCoordinateTransform(layer.crs(),
+                                       QgsCoordinateReferenceSystem(4326),
+                                       QgsProject.instance())
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes(field_names, layer.fields())
+    if selected_only:
+        features = layer.getSelectedFeatures(request)
+    else:
+        features = layer.getFeatures(request)
+    latitudes = []
+    longitudes = []
+    columns = [[] for name in field_names]
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry is None or geometry.isEmpty():
+            continue
+        # centroid of other than single point geometries
+        point = transform.transform(geometry.centroid().asPoint())
+        latitudes.append(point.y())
+        longitudes.append(point.x())
+        for name, values in zip(field_names, columns):
+            value = feature[name]
+            if value == NULL:
+                value = None
+            elif isinstance(value, (QDate, QDateTime)):
+                value = value.toString(Qt.ISODate)
+            else:
+                value = str(value)
+            values.append(value)
+    write_points(filename, field_names, latitudes, longitudes, columns)
 
 def csv_remove_columns(csv_filename, columns):
     '''remove the given columns from a csv file with header'''
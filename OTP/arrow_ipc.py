@@ -0,0 +1,352 @@
+'''
+Writer of the Apache Arrow IPC file format (also known as Feather V2)
+
+pure python without dependencies, so that columnar results can be written
+from Jython (pyarrow is not available there), the files can be read with
+pyarrow.ipc.open_file(filename) or pandas.read_feather(filename)
+
+only the subset needed for the results of the batch analysis is supported:
+the column types int32, int64, float64, utf8 and timestamp (seconds,
+without timezone), utf8 columns may be dictionary-encoded
+'''
+import struct
+
+ARROW_MAGIC = b'ARROW1'
+CONTINUATION = b'\xff\xff\xff\xff'
+
+METADATA_VERSION = 4 # V5
+# message header types
+SCHEMA, DICTIONARY_BATCH, RECORD_BATCH = 1, 2, 3
+# type ids of the supported column types
+TYPE_INT, TYPE_FLOAT, TYPE_UTF8, TYPE_TIMESTAMP = 2, 3, 5, 10
+DOUBLE = 2 # precision of float64
+SECOND = 0 # unit of timestamps
+
+# column type -> (type id, struct format of the values or None if variable)
+TYPES = {
+    'int32': (TYPE_INT, 'i'),
+    'int64': (TYPE_INT, 'q'),
+    'float64': (TYPE_FLOAT, 'd'),
+    'timestamp': (TYPE_TIMESTAMP, 'q'),
+    'utf8': (TYPE_UTF8, None),
+}
+
+# inline sizes of the scalar kinds of flatbuffer tables
+SIZES = {'bool': 1, 'ubyte': 1, 'short': 2, 'int': 4, 'long': 8, 'offset': 4}
+FORMATS = {'bool': '<B', 'ubyte': '<B', 'short': '<h', 'int': '<i',
+           'long': '<q'}
+
+
+def pad(n, alignment=8):
+    return (alignment - n % alignment) % alignment
+
+
+class Table(object):
+    '''
+    flatbuffer table, the fields are given in the order of their slots as
+    tuples (kind, value) or None if not set
+    '''
+    def __init__(self, *fields):
+        self.fields = fields
+
+
+class Vector(object):
+    '''
+    flatbuffer vector of tables (struct_format None) or of structs packed
+    with the given format
+    '''
+    def __init__(self, items, struct_format=None, alignment=8):
+        self.items = items
+        self.struct_format = struct_format
+        self.alignment = alignment
+
+
+def serialize(root):
+    '''
+    serialize the flatbuffer with the given root table
+
+    the objects are written front to back, referenced objects are always
+    placed behind the referencing ones (offsets are unsigned)
+    '''
+    buf = bytearray(4)
+    # (position of offset to patch, object)
+    pending = [(0, root)]
+
+    def align(alignment, shift=0):
+        buf.extend(b'\0' * pad(len(buf) + shift, alignment))
+
+    while pending:
+        ref, obj = pending.pop(0)
+        if isinstance(obj, Table):
+            slots = [(i, f) for i, f in enumerate(obj.fields) if f is not None]
+            slots.sort(key=lambda s: -SIZES[s[1][0]])
+            max_size = max([SIZES[f[0]] for i, f in slots] + [4])
+            # vtable: own size, size of table, offsets of the fields
+            n_slots = len(obj.fields)
+            align(2)
+            vtable_pos = len(buf)
+            buf.extend(b'\0' * (4 + 2 * n_slots))
+            # inline fields follow the offset to the vtable
+            align(max_size, 4)
+            pos = len(buf)
+            buf.extend(struct.pack('<i', pos - vtable_pos))
+            offsets = [0] * n_slots
+            for i, (kind, value) in slots:
+                align(SIZES[kind])
+                offsets[i] = len(buf) - pos
+                if kind == 'offset':
+                    pending.append((len(buf), value))
+                    buf.extend(b'\0' * 4)
+                else:
+                    buf.extend(struct.pack(FORMATS[kind], value))
+            buf[vtable_pos:vtable_pos + 4] = struct.pack(
+                '<HH', 4 + 2 * n_slots, len(buf) - pos)
+            for i, offset in enumerate(offsets):
+                buf[vtable_pos + 4 + 2 * i:vtable_pos + 6 + 2 * i] = \
+                    struct.pack('<H', offset)
+        elif isinstance(obj, Vector):
+            if obj.struct_format is None:
+                align(4)
+                pos = len(buf)
+                buf.extend(struct.pack('<I', len(obj.items)))
+                for item in obj.items:
+                    pending.append((len(buf), item))
+                    buf.extend(b'\0' * 4)
+            else:
+                # the elements have to be aligned, not the length
+                align(obj.alignment, 4)
+                pos = len(buf)
+                buf.extend(struct.pack('<I', len(obj.items)))
+                for item in obj.items:
+                    buf.extend(struct.pack(obj.struct_format, *item))
+        # strings
+        else:
+            align(4)
+            pos = len(buf)
+            if not isinstance(obj, bytes):
+                obj = obj.encode('utf-8')
+            buf.extend(struct.pack('<I', len(obj)) + obj + b'\0')
+        buf[ref:ref + 4] = struct.pack('<I', pos - ref)
+    return bytes(buf)
+
+
+class Column(object):
+    '''
+    description of a column
+
+    Parameters
+    ----------
+    name: name of the column
+    type: type of the column, one of TYPES
+    dictionary: optional, id of the dictionary the values (indices) of the
+                column refer to, only for columns of type 'utf8'
+    nullable: optional, if True the column may contain missing values (None)
+    '''
+    def __init__(self, name, type, dictionary=None, nullable=True):
+        if type not in TYPES:
+            raise ValueError('unsupported column type {}'.format(type))
+        self.name = name
+        self.type = type
+        self.dictionary = dictionary
+        self.nullable = nullable
+
+    def table(self):
+        type_id = TYPES[self.type][0]
+        if self.type in ('int32', 'int64'):
+            type_table = Table(('int', 32 if self.type == 'int32' else 64),
+                               ('bool', True))
+        elif self.type == 'float64':
+            type_table = Table(('short', DOUBLE))
+        elif self.type == 'timestamp':
+            type_table = Table(('short', SECOND))
+        else:
+            type_table = Table()
+        encoding = None
+        if self.dictionary is not None:
+            # indices are int32, dictionaries are not ordered
+            encoding = ('offset', Table(('long', self.dictionary),
+                                        ('offset', Table(('int', 32),
+                                                         ('bool', True)))))
+        return Table(('offset', self.name),
+                     ('bool', self.nullable),
+                     ('ubyte', type_id),
+                     ('offset', type_table),
+                     encoding,
+                     ('offset', Vector([])))
+
+
+def encode_column(values, type):
+    '''
+    encode the values of a column as arrow buffers
+
+    returns the number of missing values (None) and the list of buffers
+    '''
+    n = len(values)
+    null_count = 0
+    validity = b''
+    if None in values:
+        bits = bytearray((n + 7) // 8)
+        for i, value in enumerate(values):
+            if value is None:
+                null_count += 1
+            else:
+                bits[i // 8] |= 1 << (i % 8)
+        validity = bytes(bits)
+    value_format = TYPES[type][1]
+    if value_format is not None:
+        default = 0.0 if value_format == 'd' else 0
+        values = [default if v is None else v for v in values]
+        data = struct.pack('<{}{}'.format(n, value_format), *values)
+        return null_count, [validity, data]
+    offsets = [0]
+    strings = []
+    size = 0
+    for value in values:
+        if value is not None:
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            strings.append(value)
+            size += len(value)
+        offsets.append(size)
+    offsets = struct.pack('<{}i'.format(n + 1), *offsets)
+    return null_count, [validity, offsets, b''.join(strings)]
+
+
+def record_batch(columns, types):
+    '''
+    return the record batch table and the body of the given column values
+    '''
+    n_rows = len(columns[0]) if columns else 0
+    nodes = []
+    buffers = []
+    body = []
+    offset = 0
+    for values, type in zip(columns, types):
+        if len(values) != n_rows:
+            raise ValueError('all columns must have the same length')
+        null_count, column_buffers = encode_column(values, type)
+        nodes.append((n_rows, null_count))
+        for data in column_buffers:
+            buffers.append((offset, len(data)))
+            padding = pad(len(data))
+            body.append(data + b'\0' * padding)
+            offset += len(data) + padding
+    table = Table(('long', n_rows),
+                  ('offset', Vector(nodes, '<qq')),
+                  ('offset', Vector(buffers, '<qq')))
+    return table, b''.join(body)
+
+
+def dictionary_encode(ids):
+    '''
+    return the distinct ids in order of their first occurrence (the
+    dictionary of a dictionary-encoded column) and a dict with the index
+    of every id in it
+    '''
+    dictionary = []
+    index = {}
+    for i in ids:
+        if i not in index:
+            index[i] = len(dictionary)
+            dictionary.append(i)
+    return dictionary, index
+
+
+class ArrowFileWriter(object):
+    '''
+    writes tables to a file in Arrow IPC file format batch by batch, the
+    batches are written immediately, only their positions are kept until the
+    file is closed
+
+    Parameters
+    ----------
+    filename: file to write to (overwrites existing file)
+    columns: list of Columns
+    dictionaries: optional, dict with ids of dictionaries as keys and the
+                  lists of their values (distinct strings, see
+                  dictionary_encode) as values
+    resume: optional, state of a writer of the same file (see state()), the
+            file is truncated to this state and continued
+    '''
+    def __init__(self, filename, columns, dictionaries={}, resume=None):
+        self.columns = columns
+        self.schema = Table(('short', 0), # little endian
+                            ('offset', Vector([c.table() for c in columns])))
+        if resume is not None:
+            self.file = open(filename, 'r+b')
+            self.file.truncate(resume['offset'])
+            self.file.seek(resume['offset'])
+            self.dictionary_blocks = [tuple(b) for b in
+                                      resume['dictionary_blocks']]
+            self.batch_blocks = [tuple(b) for b in resume['batch_blocks']]
+            return
+        self.file = open(filename, 'wb')
+        self.file.write(ARROW_MAGIC + b'\0\0')
+        self.write_message(SCHEMA, self.schema)
+        self.dictionary_blocks = []
+        self.batch_blocks = []
+        for dict_id in sorted(dictionaries.keys()):
+            batch, body = record_batch([dictionaries[dict_id]], ['utf8'])
+            header = Table(('long', dict_id), ('offset', batch))
+            self.dictionary_blocks.append(
+                self.write_message(DICTIONARY_BATCH, header, body))
+
+    def write_message(self, header_type, header, body=b''):
+        '''
+        write an encapsulated message and return its block
+        (position, length of metadata, length of body)
+        '''
+        position = self.file.tell()
+        message = Table(('short', METADATA_VERSION),
+                        ('ubyte', header_type),
+                        ('offset', header),
+                        ('long', len(body)))
+        metadata = serialize(message)
+        metadata += b'\0' * pad(len(metadata))
+        self.file.write(CONTINUATION + struct.pack('<i', len(metadata)))
+        self.file.write(metadata)
+        self.file.write(body)
+        return (position, len(metadata) + 8, len(body))
+
+    def write_batch(self, columns):
+        '''
+        write a batch of rows given as list of the values of each column
+        (in order of the columns the writer was created with), values of
+        dictionary-encoded columns are the indices in their dictionary
+        '''
+        types = ['int32' if c.dictionary is not None else c.type
+                 for c in self.columns]
+        batch, body = record_batch(columns, types)
+        self.batch_blocks.append(
+            self.write_message(RECORD_BATCH, batch, body))
+
+    def state(self):
+        '''
+        flush the written batches and return the state of the writer
+        (json serializable), the file can be continued from this state
+        '''
+        self.file.flush()
+        return {
+            'offset': self.file.tell(),
+            'dictionary_blocks': self.dictionary_blocks,
+            'batch_blocks': self.batch_blocks
+        }
+
+    def close(self):
+        '''
+        write the footer and close the file
+        '''
+        if self.file is None:
+            return
+        # end of stream
+        self.file.write(CONTINUATION + b'\0\0\0\0')
+        footer = Table(('short', METADATA_VERSION),
+                       ('offset', self.schema),
+                       ('offset', Vector(self.dictionary_blocks, '<qi4xq')),
+                       ('offset', Vector(self.batch_blocks, '<qi4xq')))
+        footer = serialize(footer)
+        self.file.write(footer)
+        self.file.write(struct.pack('<i', len(footer)))
+        self.file.write(ARROW_MAGIC)
+        self.file.close()
+        self.file = None
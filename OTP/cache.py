@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+Cache of the results of the batch analysis on disk
+
+the results are stored under a key hashing everything the results depend
+on: the graph (size and time of last modification), the settings and the
+exported origins and destinations. The least recently used results are
+removed if the cache exceeds its size limit.
+
+only results in a single file can be cached (csv), the binary formats are
+written with sidecar files (ids, description) that are not stored
+'''
+import os
+import json
+import shutil
+import hashlib
+
+from .config import settings_hash
+
+GRAPH_FILE = 'Graph.obj'
+# settings the results depend on
+CACHED_SETTINGS = ['router_config', 'time', 'post_processing']
+READ_CHUNK = 1024 * 1024
+
+
+def file_hash(filename, hash_obj=None):
+    '''
+    update the given hash object (a new sha1 if not given) with the content
+    of the file and return it
+    '''
+    if hash_obj is None:
+        hash_obj = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                break
+            hash_obj.update(chunk)
+    return hash_obj
+
+
+class ResultCache(object):
+    '''
+    least recently used results, stored as files in a directory
+
+    Parameters
+    ----------
+    path: directory of the cache (created if not existing)
+    max_size_mb: maximum size of all cached results in MB
+    '''
+    def __init__(self, path, max_size_mb=1024):
+        self.path = path
+        self.max_bytes = int(max_size_mb) * 1024 * 1024
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def key(self, settings, origins_csv, destinations_csv, extension='.csv'):
+        '''
+        return the key of the results of a batch analysis
+
+        Parameters
+        ----------
+        settings: the settings of the analysis converted to their types
+                  (see config.Config.typed)
+        origins_csv: exported origins
+        destinations_csv: exported destinations
+        extension: optional, file extension of the results (format)
+        '''
+        router_config = settings['router_config']
+        graph = os.path.join(router_config['path'], router_config['router'],
+                             GRAPH_FILE)
+        if os.path.exists(graph):
+            stat = os.stat(graph)
+            graph_state = [graph, stat.st_size, int(stat.st_mtime)]
+        else:
+            graph_state = [graph]
+        # the names of the layers don't matter, only the exported content
+        id_fields = [settings['origin']['id_field'],
+                     settings['destination']['id_field']]
+        description = json.dumps(
+            [graph_state, settings_hash(settings, keys=CACHED_SETTINGS),
+             id_fields, extension])
+        hash_obj = hashlib.sha1(description.encode('utf-8'))
+        for filename in [origins_csv, destinations_csv]:
+            hash_obj.update(b'\0')
+            file_hash(filename, hash_obj)
+        return hash_obj.hexdigest() + extension
+
+    def get(self, key, target):
+        '''
+        copy the cached results with the given key to the target file,
+        returns False if there are no results cached under this key
+        '''
+        filename = os.path.join(self.path, key)
+        if not os.path.exists(filename):
+            return False
+        shutil.copyfile(filename, target)
+        # mark as recently used
+        os.utime(filename, None)
+        return True
+
+    def put(self, key, results):
+        '''
+        store the results file under the given key
+        '''
+        if os.path.getsize(results) > self.max_bytes:
+            return
+        filename = os.path.join(self.path, key)
+        tmp_filename = filename + '.tmp'
+        shutil.copyfile(results, tmp_filename)
+        os.replace(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        '''
+        remove the least recently used results until the cache fits its
+        size limit
+        '''
+        entries = []
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if name.endswith('.tmp') or not os.path.isfile(filename):
+                continue
+            stat = os.stat(filename)
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        size = sum(e[1] for e in entries)
+        for mtime, file_size, filename in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            os.remove(filename)
+            size -= file_size
+
+    def clear(self):
+        '''
+        remove all cached results
+        '''
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if os.path.isfile(filename):
+                os.remove(filename)
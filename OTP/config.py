@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from xml.etree import ElementTree as etree
-from xml.dom import minidom
-import os, copy
+from xml.sax.saxutils import escape
+import os, copy, io, json, hashlib
 from collections import OrderedDict
 from os.path import expanduser
 
@@ -12,6 +12,7 @@ MANUAL_URL = 'https://gis.ggr-planung.de/repos/qgis/OpenTripPlanner-Plugin-Anlei
 DEFAULT_OTP_JAR = os.path.join(path, 'otp-ggr-stable.jar')
 DEFAULT_JYTHON_PATH = os.path.join(path, 'jython-standalone-2.7.0.jar')
 DEFAULT_GRAPH_PATH = os.path.join(expanduser('~'), 'otp_graphs')
+DEFAULT_CACHE_PATH = os.path.join(expanduser('~'), 'otp_cache')
 JAVA_DEFAULT = ''
 LATITUDE_COLUMN = 'Y' # field-name used for storing lat values in csv files
 LONGITUDE_COLUMN = 'X' # field-name used for storing lon values in csv files
@@ -22,6 +23,26 @@ DATETIME_FORMAT = "%d/%m/%Y-%H:%M:%S" # format of time stored in xml files
 OUTPUT_DATE_FORMAT = 'dd.MM.yyyy HH:mm:ss' # format of the time in the results
 CALC_REACHABILITY_MODE = "THRESHOLD_SUM_AGGREGATOR" # agg. mode that is used to calculate number of reachable destinations (note: threshold is taken from set max travel time)
 INFINITE = 2147483647 # represents indefinite values in the UI, pyqt spin boxes are limited to max int32
+SERVER_PORT = 9301 # default port the OTP evaluation server listens to (localhost only)
+SERVER_EXIT_MARKER = '#OTP-EXIT' # prefix of the last line the server sends after a job, followed by the exit code
+PROGRESS_MARKER = '#OTP-PROGRESS' # prefix of the lines with progress events of the batch analysis, followed by the event as json
+SERVER_MAX_ROUTERS = 3 # max. number of routers the server keeps loaded (least recently used ones are dropped)
+# estimated memory of a single result in bytes (plain, additional with
+# details resp. with the data of the destinations), used to size the slices
+# of sources evaluated at once and the heap of the JVM
+RESULT_BYTES = 96
+RESULT_DETAILS_BYTES = 320
+RESULT_DEST_DATA_BYTES = 64
+HEAP_FRACTION = 0.5 # share of the free heap the results of a slice may use
+
+# formats the results can be written in (=keys) with the file extensions of
+# the targets they are chosen for, if no format is set in the config
+OUTPUT_FORMATS = OrderedDict([
+    ('csv', ['.csv']), # ';'-delimited text
+    ('matrix', ['.npy']), # dense binary travel time matrix
+    ('sparse', ['.npz']), # sparse matrix (CSR) of the reachable pairs
+    ('arrow', ['.arrow', '.feather']) # typed columns in Arrow IPC file format
+])
 
 # needed parameters for aggregation/accumulation modes (=keys) are listed here
 # order of parameters in list has to be the same, the specific mode requires them
@@ -123,6 +144,99 @@ ACCUMULATION_MODES = {
     }
 }
 
+def split_params(mode, params):
+    '''
+    split a flat list of params into the sets of params of the given
+    aggregation/accumulation mode, a list of params holding multiple sets
+    (e.g. several thresholds) is evaluated once per set
+
+    Parameters
+    ----------
+    mode: the aggregation or accumulation mode (see AGGREGATION_MODES resp. ACCUMULATION_MODES)
+    params: list of params, consecutive sets of as many params as the mode requires
+    '''
+    modes = AGGREGATION_MODES if mode in AGGREGATION_MODES else ACCUMULATION_MODES
+    n_params = len(modes[mode]['params'])
+    params = list(params or [])
+    if n_params == 0 or len(params) <= n_params:
+        return [params]
+    if len(params) % n_params != 0:
+        raise ValueError('{} requires sets of {} params, {} given'.format(
+            mode, n_params, len(params)))
+    return [params[i:i + n_params] for i in range(0, len(params), n_params)]
+
+def mode_columns(field, mode, param_sets):
+    '''
+    return the names of the columns of the aggregated resp. accumulated
+    values of the field, one per set of params (named by the params, if
+    there is more than one set)
+    '''
+    suffix = '-aggregated' if mode in AGGREGATION_MODES else '-accumulated'
+    if len(param_sets) <= 1:
+        return [field + suffix]
+    return ['{}{}-{}'.format(field, suffix,
+                             '-'.join('{:g}'.format(p) for p in params))
+            for params in param_sets]
+
+def output_format(target, configured=''):
+    '''
+    return the output format of the results written to the given target
+    (see OUTPUT_FORMATS), a format set in the config has priority over the
+    extension of the target
+    '''
+    if configured:
+        return configured
+    extension = os.path.splitext(target)[1].lower()
+    for key, extensions in OUTPUT_FORMATS.items():
+        if extension in extensions:
+            return key
+    return 'csv'
+
+def held_result_sets(n_parallel=1, merged=False):
+    '''
+    return the number of result sets of a slice of sources held in memory at
+    once: with times evaluated in parallel the next window is submitted
+    while the results of the current time are still processed (n_parallel
+    running + 1 processed), results merged over time are held in addition
+    '''
+    n_held = n_parallel + 1 if n_parallel > 1 else 1
+    return n_held + 1 if merged else n_held
+
+def shard_units(n_sources, n_times, index=0, count=1, merged=False):
+    '''
+    return the units of work of a shard of a batch analysis split across
+    multiple machines as list of tuples (first source, end of sources, list
+    of time indices), the assignment only depends on the number of sources
+    and times, so every shard (and merging) derives the same one
+
+    the sources are split into as many contiguous blocks as there are shards.
+    If the results are merged over time (aggregation, accumulation or best
+    of), all times of a block are evaluated by the same shard (the shard with
+    the index of the block), otherwise the (block, time) units are spread
+    over the shards
+
+    Parameters
+    ----------
+    n_sources: number of sources (origins resp. destinations if arrive by)
+    n_times: number of times
+    index: optional, index of the shard (starting at 0)
+    count: optional, number of shards
+    merged: optional, True if the results are merged over time
+    '''
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('invalid shard {} of {}'.format(index + 1, count))
+    bounds = [n_sources * b // count for b in range(count + 1)]
+    units = []
+    for b in range(count):
+        if merged:
+            time_indices = list(range(n_times)) if b == index else []
+        else:
+            time_indices = [t for t in range(n_times)
+                            if (b + t) % count == index]
+        if time_indices and bounds[b] < bounds[b + 1]:
+            units.append((bounds[b], bounds[b + 1], time_indices))
+    return units
+
 AVAILABLE_TRAVERSE_MODES = [
     'WALK',
     'TRANSIT',
@@ -157,8 +271,23 @@ setting_struct = OrderedDict([
         'otp_jar_file': DEFAULT_OTP_JAR,
         'reserved': 2,
         'n_threads': 1,
+        'n_parallel_times': 1,
         'jython_jar_file': DEFAULT_JYTHON_PATH,
         'java': JAVA_DEFAULT,
+        'server': False,
+        'server_port': SERVER_PORT,
+        'cache': False,
+        'cache_path': DEFAULT_CACHE_PATH,
+        'cache_size_mb': 1024,
+        'incremental': False,
+        # run the evaluations in the background (see jobs.JobQueue)
+        'job_queue': False,
+        'queue_max_jobs': 1, # number of evaluations running at once
+        'queue_max_cores': 0, # CPU cores of all running evaluations, 0 = all
+        'queue_max_memory': 0, # GB of all running evaluations, 0 = unlimited
+        # heap, GC and threads derived from the size of the evaluation and
+        # the machine (see jvm.py) instead of n_threads and reserved
+        'auto_resources': False,
     }),
     ('time', {
         'datetime': '', # == now,
@@ -191,32 +320,189 @@ setting_struct = OrderedDict([
         'best_of': '',
         'details': False,
         'dest_data': False,
+        'output_format': '', # one of OUTPUT_FORMATS, derived from target if empty
         'aggregation_accumulation': {
             'active': False,
             'mode': '',
             'params': [],
             'processed_field': ''
+        },
+        # statistics of the travel times over all times of a time batch
+        # instead of the results of each time (see otp_eval.StatisticsWriter)
+        'statistics': {
+            'active': False,
+            'percentiles': ['10', '50', '90'],
+            'thresholds': [] # travel times in seconds
         }
     })
 ])
 
+# types of the settings whose defaults don't tell them (by path of the
+# setting), the types of the other settings are taken from their defaults
+TYPE_OVERRIDES = {
+    'time/time_batch/time_step': 'optional_int',
+    'router_config/max_walk_distance': 'float',
+    'router_config/bike_speed': 'float',
+    'post_processing/best_of': 'optional_int',
+    'post_processing/aggregation_accumulation/params': 'float_list',
+    'post_processing/statistics/percentiles': 'float_list',
+    'post_processing/statistics/thresholds': 'float_list',
+}
+
+try:
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
+
+
+def compile_types(struct, path=''):
+    '''
+    return the types of all settings of the given structure as flat dict with
+    the paths of the settings as keys (e.g. "time/time_batch/active")
+    '''
+    types = {}
+    for key, default in struct.items():
+        key_path = path + key
+        if isinstance(default, dict):
+            types.update(compile_types(default, key_path + '/'))
+            continue
+        type_name = TYPE_OVERRIDES.get(key_path)
+        if type_name is None:
+            if isinstance(default, bool):
+                type_name = 'bool'
+            elif isinstance(default, int):
+                type_name = 'int'
+            elif isinstance(default, float):
+                type_name = 'float'
+            elif isinstance(default, list):
+                type_name = 'list'
+            else:
+                type_name = 'str'
+        types[key_path] = type_name
+    return types
+
+
+def convert(value, type_name):
+    '''
+    convert a value (as set in the UI or read from xml) to the given type,
+    raises a ValueError if it can't be converted
+    '''
+    if type_name == 'bool':
+        if value in [True, 'True', 'true']:
+            return True
+        if value in [False, 'False', 'false', '', None]:
+            return False
+        raise ValueError(value)
+    if type_name in ['int', 'optional_int']:
+        if value in ['', None]:
+            if type_name == 'optional_int':
+                return None
+            raise ValueError(value)
+        return int(float(value))
+    if type_name == 'float':
+        return float(value)
+    if type_name in ['list', 'float_list']:
+        if value is None:
+            value = []
+        elif isinstance(value, STRING_TYPES):
+            value = value.split(',')
+        if type_name == 'float_list':
+            return [float(v) for v in value if v != '']
+        return [v if isinstance(v, STRING_TYPES) else str(v)
+                for v in value if v != '']
+    if value is None:
+        return ''
+    return value if isinstance(value, STRING_TYPES) else str(value)
+
+
+def typed_settings(settings, struct=None, path='', invalid=None):
+    '''
+    return a copy of the settings with all values converted to the types of
+    the settings (see SETTING_TYPES), missing settings get their defaults,
+    settings not in the structure are kept as they are
+
+    Parameters
+    ----------
+    settings: settings as read from xml or set in the UI
+    struct: optional, the structure of the settings (default setting_struct)
+    path: optional, path of the settings in the structure
+    invalid: optional, list the paths of invalid values are appended to,
+             invalid values are replaced by their defaults then, if not given
+             a ValueError is raised
+    '''
+    if struct is None:
+        struct = setting_struct
+    typed = OrderedDict()
+    for key, value in settings.items():
+        if key not in struct:
+            typed[key] = copy.deepcopy(value)
+    for key, default in struct.items():
+        key_path = path + key
+        value = settings.get(key, default)
+        if isinstance(default, dict):
+            # all subsettings are removed, e.g. inactive ones (see write())
+            if value == '':
+                value = {}
+            if not isinstance(value, dict):
+                if invalid is None:
+                    raise ValueError('invalid setting "{}"'.format(key_path))
+                invalid.append(key_path)
+                value = {}
+            typed[key] = typed_settings(value, struct=default,
+                                        path=key_path + '/', invalid=invalid)
+            continue
+        try:
+            typed[key] = convert(value, SETTING_TYPES[key_path])
+        except (ValueError, TypeError):
+            if invalid is None:
+                raise ValueError('invalid value "{}" of setting "{}"'.format(
+                    value, key_path))
+            invalid.append(key_path)
+            typed[key] = convert(default, SETTING_TYPES[key_path])
+    return typed
+
+
+def settings_hash(settings, keys=None):
+    '''
+    return a canonical hash of the (typed) settings, equal settings have the
+    same hash regardless of the order of the keys
+
+    Parameters
+    ----------
+    settings: the settings
+    keys: optional, the keys of the settings to hash, all of setting_struct
+          if not given (additional entries like META are not hashed)
+    '''
+    if keys is None:
+        keys = setting_struct.keys()
+    settings = dict((key, settings.get(key)) for key in keys)
+    description = json.dumps(settings, sort_keys=True, separators=(',', ':'),
+                             default=str)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+SETTING_TYPES = compile_types(setting_struct)
+
 '''
 holds informations about the environment and database settings
 '''
 class Config():
 
     def __init__(self):
-        pass
+        self.settings = typed_settings({})
+        self.invalid = []
 
     def read(self, filename=None, do_create=False):
         '''
-        read the config from given xml file (default config.xml)
+        read the config from given xml file (default config.xml), the values
+        are converted to the types of the settings, invalid values are
+        replaced by their defaults and their paths are listed in self.invalid
         '''
 
         if not filename:
             filename = DEFAULT_FILE
 
-        self.settings = copy.deepcopy(setting_struct)
+        self.settings = typed_settings({})
         # create file with default settings if it does not exist
         if not os.path.isfile(filename) and do_create:
             self.write(filename)
@@ -227,15 +513,30 @@ class Config():
             self.write(filename)
             tree = etree.parse(filename)
         f_set = xml_to_dict(tree.getroot())
-        # update subkeys to match file settings
-        for key, value in f_set.items():
-            if key in self.settings:
-                self.settings[key].update(value)
+        if not isinstance(f_set, dict):
+            f_set = {}
+        self.invalid = []
+        self.settings = typed_settings(f_set, invalid=self.invalid)
 
     def reset(self):
-        self.settings = copy.deepcopy(setting_struct)
+        self.settings = typed_settings({})
+        self.invalid = []
+
+    def typed(self):
+        '''
+        return the current settings (e.g. changed in the UI) converted to the
+        types of the settings, raises a ValueError if values are invalid
+        '''
+        return typed_settings(self.settings)
+
+    def hash(self, keys=None):
+        '''
+        return a canonical hash of the current settings (see settings_hash)
+        '''
+        return settings_hash(self.typed(), keys=keys)
 
-    def write(self, filename=None, hide_inactive=False, meta=None):
+    def write(self, filename=None, hide_inactive=False, meta=None,
+              settings=None):
         '''
         write the config as xml to given file (default config.xml)
 
@@ -244,43 +545,84 @@ class Config():
         filename: file including path to write current settings to
         hide_inactive: hides unused entries for better readability (e.g. don't write aggregation settings if not used)
         meta: dictionary with additional meta-data to write to file
+        settings: optional, settings to write instead of the current ones (e.g. the ones of a single run)
         '''
 
         if not filename:
             filename = DEFAULT_FILE
 
-        run_set = copy.deepcopy(self.settings)
+        run_set = copy.deepcopy(settings or self.settings)
         if hide_inactive:
-            tb_active = run_set['time']['time_batch']['active']
-            if tb_active == 'False' or tb_active == False:
+            if not convert(run_set['time']['time_batch']['active'], 'bool'):
                 del run_set['time']['time_batch']
-            pp_active = run_set['post_processing']['aggregation_accumulation']['active']
-            if pp_active == 'False' or pp_active == False:
-                del run_set['post_processing']['aggregation_accumulation']
-            bestof = run_set['post_processing']['best_of']
-            if not bestof:
-                del run_set['post_processing']['best_of']
+            postproc = run_set['post_processing']
+            if not convert(postproc['aggregation_accumulation']['active'],
+                           'bool'):
+                del postproc['aggregation_accumulation']
+            if not convert(postproc['statistics']['active'], 'bool'):
+                del postproc['statistics']
+            if not postproc['best_of']:
+                del postproc['best_of']
 
         if meta:
             run_set['META'] = meta
-        xml_tree = etree.Element('CONFIG')
-        dict_to_xml(xml_tree, run_set)
-        with open(filename, 'w') as f:
-            f.write(prettify(xml_tree))
+        write_xml(filename, run_set)
 
-def dict_to_xml(element, dictionary):
+def update_meta(filename, meta):
     '''
-    append the entries of a dictionary as childs to the given xml tree element
+    add entries to the meta-data of a config written with Config.write
+    (e.g. measured while running OTP), the settings are kept as they are
     '''
-    if isinstance(dictionary, list):
-        element.text = ','.join(dictionary)
-    elif not isinstance(dictionary, dict):
-        element.text = str(dictionary)
-    else:
-        for key in dictionary:
-            elem = etree.Element(key)
-            element.append(elem)
-            dict_to_xml(elem, dictionary[key])
+    run_set = xml_to_dict(etree.parse(filename).getroot())
+    if not isinstance(run_set.get('META'), dict):
+        run_set['META'] = {}
+    run_set['META'].update(meta)
+    write_xml(filename, run_set)
+
+def write_xml(filename, run_set):
+    '''
+    write the dictionary with the settings as xml to given file
+    '''
+    lines = [u'<?xml version="1.0" encoding="utf-8"?>']
+    dict_to_xml_lines(lines, 'CONFIG', run_set)
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write(u'\n'.join(lines) + u'\n')
+
+def format_value(value):
+    '''
+    return the value as text of a xml element
+    '''
+    if value is None:
+        return u''
+    if isinstance(value, list):
+        return u','.join(format_value(v) for v in value)
+    if isinstance(value, float):
+        return u'{!r}'.format(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if not isinstance(value, STRING_TYPES):
+        return u'{}'.format(value)
+    return value
+
+def dict_to_xml_lines(lines, tag, dictionary, indent=u''):
+    '''
+    append the lines of the xml element with the given tag and the entries
+    of a dictionary as childs (resp. the value as text) to the given lines
+    '''
+    if not isinstance(dictionary, dict):
+        text = escape(format_value(dictionary))
+        if text:
+            lines.append(u'{0}<{1}>{2}</{1}>'.format(indent, tag, text))
+        else:
+            lines.append(u'{}<{}/>'.format(indent, tag))
+        return
+    if not dictionary:
+        lines.append(u'{}<{}/>'.format(indent, tag))
+        return
+    lines.append(u'{}<{}>'.format(indent, tag))
+    for key in dictionary:
+        dict_to_xml_lines(lines, key, dictionary[key], indent + u'  ')
+    lines.append(u'{}</{}>'.format(indent, tag))
 
 def xml_to_dict(tree):
     '''
@@ -294,14 +636,8 @@ def xml_to_dict(tree):
         value = tree.text
         if not value:
             value = ''
+        value = value.strip()
         value = value.split(',')
         if len(value) == 1:
             value = value[0]
     return value
-
-def prettify(element):
-    """
-    Return a pretty-printed XML string for element
-    """
-    parsed = minidom.parseString(etree.tostring(element, 'utf-8'))
-    return parsed.toprettyxml(indent="  ")
@@ -2,13 +2,17 @@
 from builtins import str
 import os
 from PyQt5 import uic
-from PyQt5 import QtCore, QtGui, QtWidgets
-import copy, os, re, sys, datetime
+from PyQt5 import QtCore, QtGui, QtWidgets, QtNetwork
+import copy, os, re, sys, datetime, json
+from collections import deque
 from shutil import move
+import tempfile
 import re
 
 # Initialize Qt resources from file resources.py
 from . import resources
+from .config import SERVER_EXIT_MARKER, PROGRESS_MARKER
+from .jobs import QUEUED, RUNNING
 
 MAIN_FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'ui', 'OTP_main_window.ui'))
@@ -68,6 +72,12 @@ QProgressBar::chunk {
 }
 """
 
+# max. number of lines shown in the log of the progress dialogs (the full log
+# is written to a file)
+MAX_LOG_LINES = 1000
+# interval of refreshing the shown log in milliseconds
+LOG_REFRESH_MS = 250
+
 def parse_version(meta_file):
     regex = 'version=([0-9]+\.[0-9]+)'
     with open(meta_file, 'r') as f:
@@ -118,8 +128,15 @@ class InfoDialog(QtWidgets.QDialog, INFO_FORM_CLASS):
 class ProgressDialog(QtWidgets.QDialog, PROGRESS_FORM_CLASS):
     """
     Dialog showing progress in textfield and bar after starting a certain task with run()
+
+    only the last lines of the log are shown (refreshed at a fixed rate), the
+    full log is written to a file
+
+    Parameters
+    ----------
+    log_file: optional, file the full log is written to (defaults to a new file in the temporary directory)
     """
-    def __init__(self, parent=None, auto_close=False):
+    def __init__(self, parent=None, auto_close=False, log_file=None):
         super().__init__(parent=parent)
         self.parent = parent
         self.setupUi(self)
@@ -133,6 +150,16 @@ class ProgressDialog(QtWidgets.QDialog, PROGRESS_FORM_CLASS):
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.update_timer)
 
+        if log_file is None:
+            log_file = os.path.join(tempfile.gettempdir(), 'otp-{}.log'.format(
+                datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        self.log_file = log_file
+        self.log_stream = None
+        self.log_lines = deque(maxlen=MAX_LOG_LINES)
+        self.log_changed = False
+        self.log_timer = QtCore.QTimer(self)
+        self.log_timer.timeout.connect(self.refresh_log)
+        self.log_timer.start(LOG_REFRESH_MS)
 
     def running(self):
         self.startButton.setEnabled(False)
@@ -148,17 +175,47 @@ class ProgressDialog(QtWidgets.QDialog, PROGRESS_FORM_CLASS):
             self.close()
 
     def show_status(self, text, progress=None):
-        #if hasattr(text, 'toLocal8Bit'):
-            #text = str(text.toLocal8Bit())
-        #else:
-            #text = _fromUtf8(text)
-        self.log_edit.insertHtml(text + '<br>')
-        self.log_edit.moveCursor(QtGui.QTextCursor.End)
+        '''
+        add the text (html) to the log, the shown log is refreshed later on
+        '''
+        if self.log_stream is None:
+            self.log_stream = open(self.log_file, 'a', encoding='utf-8')
+            self.log_lines.append(
+                '<i>Vollständiges Protokoll: {}</i>'.format(self.log_file))
+        self.log_lines.extend(text.split('\n'))
+        self.log_changed = True
+        plain = re.sub('<[^>]*>', '', re.sub('<br>', '\n', text))
+        self.log_stream.write(plain + '\n')
         if progress:
             if isinstance(progress, QtCore.QVariant):
                 progress = progress.toInt()[0]
             self.progress_bar.setValue(progress)
 
+    def refresh_log(self):
+        '''
+        show the last lines of the log
+        '''
+        if not self.log_changed:
+            return
+        self.log_changed = False
+        self.log_edit.setHtml('<br>'.join(self.log_lines))
+        self.log_edit.moveCursor(QtGui.QTextCursor.End)
+        if self.log_stream is not None:
+            self.log_stream.flush()
+
+    def showEvent(self, evnt):
+        # the log is refreshed again, if the dialog was closed before
+        self.log_timer.start(LOG_REFRESH_MS)
+        super().showEvent(evnt)
+
+    def closeEvent(self, evnt):
+        self.log_timer.stop()
+        self.refresh_log()
+        if self.log_stream is not None:
+            self.log_stream.close()
+            self.log_stream = None
+        super().closeEvent(evnt)
+
     # task needs to be overridden
     def run(self):
         self.start_time = datetime.datetime.now()
@@ -182,6 +239,9 @@ class ExecOTPDialog(ProgressDialog):
     n_points: number of points to calculate in one iteration
     points_per_tick: how many points are calculated before showing progress
     """
+    # emitted with the success (True/False) when the process finished
+    job_finished = QtCore.pyqtSignal(bool)
+
     def __init__(self, command, parent=None, auto_close=False, auto_start=False, n_iterations=1, n_points=0, points_per_tick=50):
         super().__init__(parent=parent, auto_close=auto_close)
 
@@ -198,6 +258,14 @@ class ExecOTPDialog(ProgressDialog):
 
         self.ticks = 0.
         self.iterations = 0
+        # last progress event of the batch analysis, the time it was received
+        # and the number of ticks since then
+        self.progress = None
+        self.progress_time = None
+        self.progress_ticks = 0
+        self.points_per_tick = points_per_tick
+        # incomplete last line of the output
+        self.out_buffer = ''
 
         # Just to prevent accidentally running multiple times
         # Disable the button when process starts, and enable it when it finishes
@@ -205,42 +273,16 @@ class ExecOTPDialog(ProgressDialog):
         self.process.finished.connect(self.finished)
 
         # how often will the stdout-indicator written before reaching 100%
-        n_ticks = float(n_points) / points_per_tick
-        n_ticks *= n_iterations
-        tick_indicator = 'Processing:'
-        iteration_finished_indicator = 'A total of'
-
-        # leave some space for post processing
-        max_progress = 98.
+        self.n_iterations = n_iterations
+        self.n_ticks = float(n_points) / points_per_tick
+        self.n_ticks *= n_iterations
 
         def show_progress():
             out = self.process.readAllStandardOutput()
             out = str(out.data(), encoding='utf-8')
             err = self.process.readAllStandardError()
             err = str(err.data(), encoding='utf-8')
-            if len(out):
-                self.show_status(out)
-                if tick_indicator in out and n_ticks:
-                    self.ticks += max_progress / n_ticks
-                    self.progress_bar.setValue(min(max_progress, int(self.ticks)))
-                elif iteration_finished_indicator in out:
-                    self.iterations += 1
-                    self.progress_bar.setValue(self.iterations * max_progress / n_iterations)
-
-                '''  this approach shows progress more accurately, but may cause extreme lags -> deactivated (alternative: thread this)
-                if out.startswith(progress_indicator):
-                    # sometimes the stdout comes in too fast, you have to split it (don't split other than progress messages, warnings tend to be very long with multiple breaks, bad performance)
-                    for out_split in out.split("\n"):
-                        if (len(out_split) == 0):
-                            continue
-                        self.show_status(out_split)
-                        if(total_ticks and out_split.startswith(progress_indicator)):
-                            self.ticks += 100. / total_ticks
-                            self.progress_bar.setValue(min(100, int(self.ticks)))
-                else:
-                    self.show_status(out)
-                '''
-            if len(err): self.show_status(err)
+            self.show_output(out, err)
 
         self.process.readyReadStandardOutput.connect(show_progress)
         self.process.readyReadStandardError.connect(show_progress)
@@ -250,6 +292,71 @@ class ExecOTPDialog(ProgressDialog):
         if auto_start:
             self.startButton.clicked.emit(True)
 
+    def show_output(self, out, err=''):
+        '''
+        show the output of OTP and derive the progress from it
+
+        the progress is taken from the progress events of the batch analysis
+        (lines starting with PROGRESS_MARKER, not shown), between the events
+        it is estimated from the progress messages of OTP
+        '''
+        tick_indicator = 'Processing:'
+        iteration_finished_indicator = 'A total of'
+
+        # leave some space for post processing
+        max_progress = 98.
+
+        if len(out):
+            lines = (self.out_buffer + out).split('\n')
+            # last line may be incomplete
+            self.out_buffer = lines.pop()
+            text = []
+            for line in lines:
+                if line.startswith(PROGRESS_MARKER):
+                    try:
+                        self.progress = json.loads(
+                            line[len(PROGRESS_MARKER):])
+                    except ValueError:
+                        continue
+                    self.progress_time = datetime.datetime.now()
+                    self.progress_ticks = 0
+                else:
+                    text.append(line)
+            text = '\n'.join(text)
+            if text:
+                self.show_status(text)
+            n_ticks = text.count(tick_indicator)
+            if self.progress is not None:
+                self.progress_ticks += n_ticks
+                done = min(self.progress['done'] + self.progress_ticks *
+                           self.points_per_tick, self.progress['total'])
+                total = self.progress['total'] or 1
+                self.progress_bar.setValue(int(max_progress * done / total))
+            elif n_ticks and self.n_ticks:
+                self.ticks += n_ticks * max_progress / self.n_ticks
+                self.progress_bar.setValue(min(max_progress, int(self.ticks)))
+            elif iteration_finished_indicator in text:
+                self.iterations += 1
+                self.progress_bar.setValue(
+                    self.iterations * max_progress / self.n_iterations)
+        if len(err): self.show_status(err)
+
+    def update_timer(self):
+        '''
+        show the elapsed time and the estimated remaining time
+        '''
+        super().update_timer()
+        if not self.progress or not self.progress.get('rate'):
+            return
+        remaining = ((self.progress['total'] - self.progress['done']) /
+                     self.progress['rate'])
+        remaining -= (datetime.datetime.now() -
+                      self.progress_time).total_seconds()
+        h, remainder = divmod(int(max(remaining, 0)), 3600)
+        m, s = divmod(remainder, 60)
+        self.progress_bar.setFormat(
+            '%p% (noch ca. {:02d}:{:02d}:{:02d})'.format(h, m, s))
+
     def running(self):
         self.cancelButton.clicked.connect(self.kill)
         super().running()
@@ -258,10 +365,16 @@ class ExecOTPDialog(ProgressDialog):
         self.cancelButton.clicked.disconnect(self.kill)
         super().stopped()
 
+    def exit_code(self):
+        return self.process.exitCode()
+
     def finished(self):
         self.startButton.setText('Neustart')
         self.timer.stop()
-        if self.process.exitCode() == QtCore.QProcess.NormalExit and not self.killed:
+        if self.out_buffer:
+            self.show_output('\n')
+        self.progress_bar.setFormat('%p%')
+        if self.exit_code() == QtCore.QProcess.NormalExit and not self.killed:
             self.progress_bar.setValue(100)
             self.progress_bar.setStyleSheet(FINISHED_STYLE)
             self.success = True
@@ -269,26 +382,254 @@ class ExecOTPDialog(ProgressDialog):
             self.progress_bar.setStyleSheet(ABORTED_STYLE)
             self.success = False
         self.stopped()
+        self.job_finished.emit(self.success)
 
     def kill(self):
         self.timer.stop()
         self.killed = True
         self.process.kill()
-        self.log_edit.insertHtml('<b> Vorgang abgebrochen </b> <br>')
-        self.log_edit.moveCursor(QtGui.QTextCursor.End)
+        self.show_status('<b> Vorgang abgebrochen </b>')
         self.success = False
 
-    def run(self):
-        self.killed = False
+    def reset_progress(self):
         self.ticks = 0
+        self.iterations = 0
+        self.progress = None
+        self.progress_ticks = 0
+        self.out_buffer = ''
+        self.progress_bar.setFormat('%p%')
         self.progress_bar.setStyleSheet(DEFAULT_STYLE)
         self.progress_bar.setValue(0)
+
+    def run(self):
+        self.killed = False
+        self.reset_progress()
         self.show_status('<br>Starte Script: <i>' + self.command + '</i><br>')
         self.process.start(self.command)
         self.start_time = datetime.datetime.now()
         self.timer.start(1000)
 
 
+class ExecOTPServerDialog(ExecOTPDialog):
+    """
+    ExecOTPDialog submitting the job to the OTP evaluation server instead of
+    starting a new process, the server is started (detached) first, if it
+    is not reachable
+
+    Parameters
+    ----------
+    args: list of arguments of otp_batch.py describing the job
+    port: port the evaluation server listens to
+    server_command: command to start the evaluation server with
+    connect_timeout: seconds to wait for a newly started server to listen
+    """
+    def __init__(self, args, port, server_command, parent=None,
+                 auto_close=False, auto_start=False, connect_timeout=60,
+                 **kwargs):
+        super().__init__(server_command, parent=parent,
+                         auto_close=auto_close, auto_start=False, **kwargs)
+        self.args = args
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.server_started = False
+        self.connect_attempts = 0
+        self.server_exit_code = None
+        self.buffer = ''
+
+        self.socket = QtNetwork.QTcpSocket(self)
+        self.socket.connected.connect(self.submit)
+        self.socket.readyRead.connect(self.read_output)
+        self.socket.error.connect(self.socket_error)
+        self.socket.disconnected.connect(self.disconnected)
+        if auto_start:
+            self.startButton.clicked.emit(True)
+
+    def connect_server(self):
+        self.connect_attempts += 1
+        self.socket.connectToHost(QtNetwork.QHostAddress.LocalHost, self.port)
+
+    def submit(self):
+        self.show_status('Auftrag an OTP-Server (Port {}) übergeben'.format(
+            self.port))
+        job = {'command': 'evaluate', 'args': self.args}
+        self.socket.write((json.dumps(job) + '\n').encode('utf-8'))
+
+    def read_output(self):
+        self.buffer += str(self.socket.readAll().data(), encoding='utf-8')
+        lines = self.buffer.split('\n')
+        # last line may be incomplete
+        self.buffer = lines.pop()
+        out = []
+        for line in lines:
+            if line.startswith(SERVER_EXIT_MARKER):
+                self.server_exit_code = int(line[len(SERVER_EXIT_MARKER):])
+                continue
+            out.append(line)
+        if out:
+            self.show_output('\n'.join(out) + '\n')
+        if self.server_exit_code is not None:
+            self.socket.disconnectFromHost()
+
+    def socket_error(self, error):
+        if self.killed or self.server_exit_code is not None:
+            return
+        if error == QtNetwork.QAbstractSocket.ConnectionRefusedError:
+            # no server listening -> start one and wait for it
+            if self.connect_attempts < self.connect_timeout:
+                if not self.server_started:
+                    self.show_status('Starte OTP-Server: <i>{}</i>'.format(
+                        self.command))
+                    QtCore.QProcess.startDetached(self.command)
+                    self.server_started = True
+                QtCore.QTimer.singleShot(1000, self.connect_server)
+                return
+            self.show_status('OTP-Server auf Port {} nicht erreichbar'.format(
+                self.port))
+            self.finished()
+            return
+        # connection is closed afterwards, disconnected() finishes the dialog
+        self.show_status('Verbindung zum OTP-Server fehlgeschlagen: {}'
+                         .format(self.socket.errorString()))
+
+    def disconnected(self):
+        if not self.killed:
+            self.finished()
+
+    def exit_code(self):
+        if self.server_exit_code is None:
+            return 1
+        return self.server_exit_code
+
+    def kill(self):
+        self.killed = True
+        # the server stops the job after the current time resp. slice
+        if self.socket.state() == QtNetwork.QAbstractSocket.ConnectedState:
+            self.socket.write(
+                (json.dumps({'command': 'cancel'}) + '\n').encode('utf-8'))
+            self.socket.waitForBytesWritten(1000)
+        self.socket.abort()
+        super().kill()
+        self.show_status('Der OTP-Server bricht den laufenden Auftrag ab')
+        self.finished()
+
+    def run(self):
+        self.killed = False
+        self.reset_progress()
+        self.connect_attempts = 0
+        self.server_exit_code = None
+        self.buffer = ''
+        self.running()
+        self.connect_server()
+        self.start_time = datetime.datetime.now()
+        self.timer.start(1000)
+
+
+class JobMonitorDialog(QtWidgets.QDialog):
+    """
+    non-modal dialog listing the jobs of a JobQueue with their state and
+    progress, the log of a job is shown on double click
+
+    Parameters
+    ----------
+    queue: the JobQueue to monitor
+    """
+    COLUMNS = ['Berechnung', 'Status', 'Fortschritt']
+
+    def __init__(self, queue, parent=None):
+        super().__init__(parent=parent)
+        self.queue = queue
+        self.setWindowTitle('Warteschlange der Berechnungen')
+        self.resize(600, 300)
+        layout = QtWidgets.QVBoxLayout(self)
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(
+            QtWidgets.QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(
+            QtWidgets.QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(
+            0, QtWidgets.QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.cellDoubleClicked.connect(self.show_log)
+        layout.addWidget(self.table)
+
+        buttons = QtWidgets.QHBoxLayout()
+        log_button = QtWidgets.QPushButton('Protokoll anzeigen')
+        log_button.clicked.connect(lambda: self.show_log(self.selected_row()))
+        cancel_button = QtWidgets.QPushButton('Abbrechen')
+        cancel_button.clicked.connect(self.cancel)
+        clear_button = QtWidgets.QPushButton('Beendete entfernen')
+        clear_button.clicked.connect(self.queue.remove_finished)
+        close_button = QtWidgets.QPushButton('Schließen')
+        close_button.clicked.connect(self.close)
+        for button in [log_button, cancel_button, clear_button]:
+            buttons.addWidget(button)
+        buttons.addStretch()
+        buttons.addWidget(close_button)
+        layout.addLayout(buttons)
+
+        self.queue.changed.connect(self.refresh)
+        self.refresh()
+
+    def selected_row(self):
+        rows = self.table.selectionModel().selectedRows()
+        return rows[0].row() if rows else -1
+
+    def refresh(self):
+        '''
+        show the jobs of the queue, the progress bars follow the ones of the
+        dialogs running the jobs
+        '''
+        jobs = self.queue.jobs
+        self.table.setRowCount(len(jobs))
+        for row, job in enumerate(jobs):
+            self.table.setItem(row, 0, QtWidgets.QTableWidgetItem(job.name))
+            self.table.setItem(row, 1, QtWidgets.QTableWidgetItem(job.label))
+            bar = self.table.cellWidget(row, 2)
+            if bar is None or bar.property('job') != id(job):
+                bar = QtWidgets.QProgressBar()
+                bar.setProperty('job', id(job))
+                source = job.dialog.progress_bar
+                bar.setValue(source.value())
+                source.valueChanged.connect(bar.setValue)
+                self.table.setCellWidget(row, 2, bar)
+            if job.state in (QUEUED, RUNNING):
+                bar.setStyleSheet(DEFAULT_STYLE)
+            elif job.dialog.success:
+                bar.setStyleSheet(FINISHED_STYLE)
+            else:
+                bar.setStyleSheet(ABORTED_STYLE)
+
+    def show_log(self, row, column=0):
+        if row < 0 or row >= len(self.queue.jobs):
+            return
+        dialog = self.queue.jobs[row].dialog
+        dialog.show()
+        dialog.raise_()
+
+    def cancel(self):
+        row = self.selected_row()
+        if row < 0:
+            return
+        self.queue.cancel(self.queue.jobs[row])
+
+
+def shutdown_otp_server(port, timeout=1000):
+    '''
+    ask the OTP evaluation server listening to the given port to shut down,
+    returns True if a server was reached
+    '''
+    socket = QtNetwork.QTcpSocket()
+    socket.connectToHost(QtNetwork.QHostAddress.LocalHost, port)
+    if not socket.waitForConnected(timeout):
+        return False
+    socket.write((json.dumps({'command': 'shutdown'}) + '\n').encode('utf-8'))
+    socket.waitForBytesWritten(timeout)
+    socket.disconnectFromHost()
+    return True
+
+
 class ExecCreateRouterDialog(ProgressDialog):
     def __init__(self, source_folder, target_folder,
                  java_executable, otp_jar, memory=2,
@@ -336,7 +677,8 @@ class ExecCreateRouterDialog(ProgressDialog):
     def finished(self):
         self.startButton.setText('Neustart')
         self.timer.stop()
-        if self.process.exitCode() == QtCore.QProcess.NormalExit and not self.killed:
+        if (self.process.exitCode() == QtCore.QProcess.NormalExit and
+            not self.killed):
             self.show_status("graph created...")
             self.progress_bar.setValue(100)
             self.progress_bar.setStyleSheet(FINISHED_STYLE)
@@ -360,8 +702,7 @@ class ExecCreateRouterDialog(ProgressDialog):
         self.timer.stop()
         self.killed = True
         self.process.kill()
-        self.log_edit.insertHtml('<b> Vorgang abgebrochen </b> <br>')
-        self.log_edit.moveCursor(QtGui.QTextCursor.End)
+        self.show_status('<b> Vorgang abgebrochen </b>')
 
 
 class RouterDialog(QtWidgets.QDialog, ROUTER_FORM_CLASS):
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+Incremental updates of the results of the batch analysis
+
+the exported origins and destinations of a run are kept next to its
+results. When the same analysis is run again into the same target, only
+the sources (origins resp. destinations if arrive by) that were added or
+moved are routed and the previous results are patched. Any other change
+(targets, settings, accumulation) requires a full run.
+'''
+import os
+import csv
+import shutil
+
+from .config import (Config, AGGREGATION_MODES, LATITUDE_COLUMN,
+                     LONGITUDE_COLUMN)
+from . import points
+
+# settings that have to be unchanged to patch previous results
+COMPARED_SETTINGS = ['router_config', 'time', 'post_processing', 'origin',
+                     'destination']
+
+
+def read_points(filename, id_field):
+    '''
+    read the rows of an exported layer (csv or points file), returns the
+    header and a dict with the ids as keys and the rows (as dicts) as values
+    '''
+    if os.path.splitext(filename)[1].lower() == points.EXTENSION:
+        fields, latitudes, longitudes, columns = points.read_points(filename)
+        header = [LATITUDE_COLUMN, LONGITUDE_COLUMN] + fields
+        rows = zip([repr(lat) for lat in latitudes],
+                   [repr(lon) for lon in longitudes], *columns)
+        rows = [dict(zip(header, row)) for row in rows]
+        return header, dict((row[id_field], row) for row in rows)
+    with open(filename, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        rows = dict((row[id_field], row) for row in reader)
+        return reader.fieldnames, rows
+
+
+def input_files(target_file, extension='.csv'):
+    '''
+    return the names of the files the exported origins and destinations of
+    the results are kept in (with the extension of the exported files)
+    '''
+    base = os.path.splitext(target_file)[0]
+    return base + '-origins' + extension, base + '-destinations' + extension
+
+
+def keep_inputs(target_file, origins_csv, destinations_csv):
+    '''
+    keep the exported origins and destinations the results were computed
+    with, for later incremental updates
+    '''
+    extension = os.path.splitext(origins_csv)[1]
+    for src, dst in zip([origins_csv, destinations_csv],
+                        input_files(target_file, extension)):
+        shutil.copy(src, dst)
+
+
+class IncrementalUpdate(object):
+    '''
+    compares the inputs of a new run with the ones of the previous run into
+    the same target
+
+    Parameters
+    ----------
+    target_file: the results of the previous run (to be updated)
+    previous_config: config file of the previous run
+    config_file: config file of the new run
+    origins_csv: exported origins of the new run
+    destinations_csv: exported destinations of the new run
+    '''
+    def __init__(self, target_file, previous_config, config_file, origins_csv,
+                 destinations_csv):
+        self.target_file = target_file
+        self.possible = False
+        # ids of the sources whose results are replaced
+        self.replaced = set()
+        self.changed = []
+        prev_origins, prev_destinations = input_files(
+            target_file, os.path.splitext(origins_csv)[1])
+        if not all(os.path.exists(f) for f in [
+            target_file, previous_config, prev_origins, prev_destinations]):
+            return
+
+        previous, current = Config(), Config()
+        previous.read(previous_config)
+        current.read(config_file)
+        settings = current.settings
+        for key in COMPARED_SETTINGS:
+            if previous.settings[key] != settings[key]:
+                return
+        agg_acc = settings['post_processing']['aggregation_accumulation']
+        # accumulated values depend on all sources
+        if agg_acc['active'] and agg_acc['mode'] not in AGGREGATION_MODES:
+            return
+
+        self.arrive_by = settings['time']['arrive_by']
+        oid = settings['origin']['id_field']
+        did = settings['destination']['id_field']
+        if self.arrive_by:
+            sources = (prev_destinations, destinations_csv, did)
+            targets = (prev_origins, origins_csv, oid)
+        else:
+            sources = (prev_origins, origins_csv, oid)
+            targets = (prev_destinations, destinations_csv, did)
+
+        # any change of the targets changes the results of all sources
+        prev_header, prev_targets = read_points(targets[0], targets[2])
+        header, new_targets = read_points(targets[1], targets[2])
+        if prev_header != header or prev_targets != new_targets:
+            return
+
+        prev_header, prev_sources = read_points(sources[0], sources[2])
+        self.header, new_sources = read_points(sources[1], sources[2])
+        if prev_header != self.header:
+            return
+        self.sources_csv = sources[1]
+        self.id_field = sources[2]
+        coords = [LATITUDE_COLUMN, LONGITUDE_COLUMN]
+        for source_id, row in new_sources.items():
+            prev = prev_sources.get(source_id)
+            # added or moved
+            if prev is None or [prev.get(c) for c in coords] != [
+                row.get(c) for c in coords]:
+                self.changed.append(row)
+                self.replaced.add(source_id)
+        # removed
+        self.replaced.update(set(prev_sources.keys()) -
+                             set(new_sources.keys()))
+        self.possible = True
+
+    @property
+    def key_column(self):
+        '''
+        column of the results holding the ids of the sources
+        '''
+        return 'destination id' if self.arrive_by else 'origin id'
+
+    def write_changed(self, filename):
+        '''
+        write the added and moved sources to the given csv file
+        '''
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self.header)
+            writer.writeheader()
+            writer.writerows(self.changed)
+
+    def patch(self, update_csv=None):
+        '''
+        replace the results of the changed sources in the previous results
+        with the ones in given csv file (results of the changed sources only)
+        '''
+        tmp_file = self.target_file + '.tmp'
+        with open(self.target_file, newline='', encoding='utf-8') as f_prev, \
+             open(tmp_file, 'w', newline='', encoding='utf-8') as f_out:
+            reader = csv.reader(f_prev, delimiter=';')
+            writer = csv.writer(f_out, delimiter=';')
+            header = next(reader)
+            writer.writerow(header)
+            key = header.index(self.key_column)
+            for row in reader:
+                if row[key] not in self.replaced:
+                    writer.writerow(row)
+            if update_csv is not None and os.path.exists(update_csv):
+                with open(update_csv, newline='', encoding='utf-8') as f:
+                    update = csv.reader(f, delimiter=';')
+                    # an empty update has no header either
+                    if next(update, None) is not None:
+                        writer.writerows(update)
+        os.replace(tmp_file, self.target_file)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+'''
+Queue running evaluations of the batch analysis in the background
+
+the jobs are started in the order they were added, as many at once as the
+budget of jobs, CPU cores and memory allows. Jobs submitted to the OTP
+evaluation server are run one after another (the server keeps one warm JVM
+evaluating one job at a time). Every job runs in its own ExecOTPDialog,
+which is only shown on request, the results of a job are processed as soon
+as it finishes.
+'''
+import os
+import traceback
+from PyQt5 import QtCore
+
+# states of the jobs
+QUEUED, RUNNING, FINISHED, FAILED, CANCELED = range(5)
+STATE_LABELS = {
+    QUEUED: 'wartet',
+    RUNNING: 'läuft',
+    FINISHED: 'fertig',
+    FAILED: 'fehlgeschlagen',
+    CANCELED: 'abgebrochen'
+}
+
+
+class Job(object):
+    '''
+    evaluation waiting in or run by the JobQueue
+
+    Parameters
+    ----------
+    name: name of the job shown in the monitor
+    dialog: ExecOTPDialog running the evaluation (not started yet)
+    on_finished: optional, function called with the success (True/False)
+                 after the evaluation finished, e.g. to add the results
+    cores: optional, number of CPU cores the evaluation uses
+    memory: optional, memory the evaluation uses in GB
+    server: optional, True if the evaluation is submitted to the OTP
+            evaluation server
+    '''
+    def __init__(self, name, dialog, on_finished=None, cores=1, memory=1,
+                 server=False):
+        self.name = name
+        self.dialog = dialog
+        self.on_finished = on_finished
+        self.cores = cores
+        self.memory = memory
+        self.server = server
+        self.state = QUEUED
+        # the dialog is only shown on request and is started by the queue
+        # (only once), it is kept when its window is closed
+        dialog.setAttribute(QtCore.Qt.WA_DeleteOnClose, False)
+        dialog.startButton.hide()
+
+    @property
+    def label(self):
+        return STATE_LABELS[self.state]
+
+
+class JobQueue(QtCore.QObject):
+    '''
+    runs jobs back-to-back or concurrently within a budget
+
+    Parameters
+    ----------
+    max_jobs: optional, max. number of jobs running at once
+    max_cores: optional, max. number of CPU cores used by the running jobs
+               (all cores of the machine if 0)
+    max_memory: optional, max. memory used by the running jobs in GB
+                (unlimited if 0)
+    '''
+    # emitted whenever jobs are added or change their state
+    changed = QtCore.pyqtSignal()
+
+    def __init__(self, max_jobs=1, max_cores=0, max_memory=0, parent=None):
+        super().__init__(parent=parent)
+        self.jobs = []
+        self.set_budget(max_jobs=max_jobs, max_cores=max_cores,
+                        max_memory=max_memory)
+
+    def set_budget(self, max_jobs=1, max_cores=0, max_memory=0):
+        '''
+        change the budget, takes effect when the next job is started
+        '''
+        self.max_jobs = max(int(max_jobs), 1)
+        self.max_cores = int(max_cores) or os.cpu_count() or 1
+        self.max_memory = int(max_memory)
+        self.start_next()
+
+    @property
+    def running(self):
+        return [job for job in self.jobs if job.state == RUNNING]
+
+    @property
+    def queued(self):
+        return [job for job in self.jobs if job.state == QUEUED]
+
+    def add(self, job):
+        '''
+        append the job to the queue, it is started as soon as the budget
+        allows it
+        '''
+        self.jobs.append(job)
+        job.dialog.job_finished.connect(
+            lambda success: self.job_finished(job, success))
+        self.changed.emit()
+        self.start_next()
+
+    def fits(self, job):
+        '''
+        return True if the job can be started next to the running ones
+        '''
+        running = self.running
+        # a job exceeding the budget on its own is run alone
+        if not running:
+            return True
+        if len(running) >= self.max_jobs:
+            return False
+        if job.server or any(r.server for r in running):
+            return False
+        if sum(r.cores for r in running) + job.cores > self.max_cores:
+            return False
+        if (self.max_memory and
+            sum(r.memory for r in running) + job.memory > self.max_memory):
+            return False
+        return True
+
+    def start_next(self):
+        '''
+        start the queued jobs in order as long as they fit into the budget
+        '''
+        for job in self.queued:
+            if not self.fits(job):
+                break
+            job.state = RUNNING
+            job.dialog.startButton.clicked.emit(True)
+            self.changed.emit()
+
+    def job_finished(self, job, success):
+        if job.state != RUNNING:
+            return
+        job.state = FINISHED if success else (
+            CANCELED if job.dialog.killed else FAILED)
+        self.changed.emit()
+        if job.on_finished is not None:
+            try:
+                job.on_finished(success)
+            except Exception:
+                traceback.print_exc()
+                job.dialog.show_status(
+                    '<b>Fehler beim Übernehmen der Ergebnisse</b><br>' +
+                    traceback.format_exc().replace('\n', '<br>'))
+        self.start_next()
+
+    def cancel(self, job):
+        '''
+        remove the job from the queue resp. stop it if it is running
+        '''
+        if job.state == QUEUED:
+            job.state = CANCELED
+            self.changed.emit()
+            # e.g. removes the temporary files of the job
+            if job.on_finished is not None:
+                job.on_finished(False)
+        elif job.state == RUNNING:
+            job.dialog.kill()
+
+    def cancel_all(self):
+        for job in self.queued + self.running:
+            self.cancel(job)
+
+    def remove_finished(self):
+        '''
+        remove the jobs that are not waiting or running anymore
+        '''
+        done = [job for job in self.jobs if job.state not in (QUEUED, RUNNING)]
+        for job in done:
+            self.jobs.remove(job)
+            job.dialog.deleteLater()
+        self.changed.emit()
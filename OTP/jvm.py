@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+'''
+Size the JVM running the batch analysis automatically
+
+the peak memory of an evaluation is estimated from the size of the graph,
+the number of origins and destinations, the size of the slices of sources
+evaluated at once and the details of the results. The heap (-Xmx), the
+garbage collector and the number of threads are chosen against the free
+memory and the CPU cores of the machine.
+'''
+import os
+import math
+import ctypes
+
+from .config import (RESULT_BYTES, RESULT_DETAILS_BYTES,
+                     RESULT_DEST_DATA_BYTES, HEAP_FRACTION, held_result_sets)
+
+# memory of the JVM running Jython and OTP without a graph in GB
+JVM_BASE_GB = 0.5
+# memory of a loaded graph relative to the size of the serialized Graph.obj
+GRAPH_FACTOR = 3.
+# routing state (shortest path tree) held by each thread relative to the
+# memory of the graph
+THREAD_GRAPH_SHARE = 0.05
+# number of sources a slice should hold at least if not set (the SliceSizer
+# adapts the slices to the heap, more heap means less slices)
+DEFAULT_SPLIT = 100
+# memory left to QGIS and the system in GB
+SYSTEM_RESERVED_GB = 1.5
+# the heap is chosen this much larger than the estimated peak
+HEADROOM = 1.25
+# heaps of this size (in GB) and above are collected with G1
+G1_MIN_HEAP_GB = 4
+
+GB = 1024. ** 3
+
+
+def available_memory():
+    '''
+    return the memory available for new processes in GB or None if it can't
+    be determined
+    '''
+    try:
+        import psutil
+        return psutil.virtual_memory().available / GB
+    except ImportError:
+        pass
+    if os.path.exists('/proc/meminfo'):
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024 / GB
+        return None
+    if os.name == 'nt':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys / GB
+    return None
+
+
+def estimate_memory(graph_file, n_sources, n_targets, n_threads=1,
+                    n_parallel_times=1, split=None, calculate_details=False,
+                    write_dest_data=False, merged=False):
+    '''
+    return the estimated peak memory of an evaluation in GB
+
+    Parameters
+    ----------
+    graph_file: serialized graph (Graph.obj) of the router
+    n_sources: number of sources (origins resp. destinations if arrive by)
+    n_targets: number of targets each source is routed to
+    n_threads: optional, number of threads evaluating the sources
+    n_parallel_times: optional, number of times evaluated at once
+    split: optional, number of sources evaluated at once
+    calculate_details: optional, if True the results carry itinerary details
+    write_dest_data: optional, if True the data of the destinations is written
+    merged: optional, if True the merged results of the previous times are
+            held in addition (aggregation, accumulation, best of)
+    '''
+    graph_gb = 0
+    if os.path.exists(graph_file):
+        graph_gb = os.path.getsize(graph_file) * GRAPH_FACTOR / GB
+    threads_gb = graph_gb * THREAD_GRAPH_SHARE * n_threads
+    result_bytes = RESULT_BYTES
+    if calculate_details:
+        result_bytes += RESULT_DETAILS_BYTES
+    if write_dest_data:
+        result_bytes += RESULT_DEST_DATA_BYTES
+    n_held = held_result_sets(n_parallel_times, merged)
+    if split is None:
+        split = DEFAULT_SPLIT
+    split = max(min(split, n_sources), 1)
+    slice_gb = (split * max(n_targets, 1) * result_bytes * n_held /
+                HEAP_FRACTION / GB)
+    return JVM_BASE_GB + graph_gb + threads_gb + slice_gb
+
+
+def choose_resources(estimate, max_cores=None, max_memory=None):
+    '''
+    choose the heap, the garbage collector and the number of threads of an
+    evaluation with the given estimated peak memory
+
+    Parameters
+    ----------
+    estimate: function returning the estimated peak memory in GB for a given
+              number of threads
+    max_cores: optional, number of CPU cores the evaluation may use
+               (all cores but one left to QGIS if not given)
+    max_memory: optional, memory the evaluation may use in GB (the memory
+                available on the machine minus the memory left to QGIS if
+                not given)
+
+    Returns
+    -------
+    dictionary with the heap in GB ('memory'), the number of threads
+    ('n_threads'), the additional arguments of the JVM ('jvm_args'), the
+    estimated peak memory in GB ('estimated') and the memory available in GB
+    ('available', None if unknown)
+    '''
+    if not max_cores:
+        max_cores = max((os.cpu_count() or 1) - 1, 1)
+    available = max_memory
+    if not available:
+        available = available_memory()
+        if available is not None:
+            available -= SYSTEM_RESERVED_GB
+    # as many threads as the memory allows
+    n_threads = max_cores
+    while n_threads > 1 and available is not None and (
+        estimate(n_threads) * HEADROOM > available):
+        n_threads -= 1
+    estimated = estimate(n_threads)
+    memory = int(math.ceil(estimated * HEADROOM))
+    if available is not None:
+        memory = min(memory, int(available))
+    memory = max(memory, 1)
+    if memory >= G1_MIN_HEAP_GB:
+        jvm_args = ['-XX:+UseG1GC', '-XX:+UseStringDeduplication']
+    else:
+        jvm_args = ['-XX:+UseParallelGC']
+    # the collector shouldn't use more cores than the evaluation
+    jvm_args.append('-XX:ParallelGCThreads={}'.format(n_threads))
+    return {
+        'memory': memory,
+        'n_threads': n_threads,
+        'jvm_args': jvm_args,
+        'estimated': round(estimated, 2),
+        'available': round(available, 2) if available is not None else None
+    }
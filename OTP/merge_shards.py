@@ -0,0 +1,230 @@
+'''
+Merges the results of a batch analysis split across multiple machines
+(see option --shard of otp_batch.py) into one result
+
+the shards evaluate disjoint sources (resp. disjoint pairs of sources and
+times, see config.shard_units), so aggregated values and best of results
+are complete per source and are only combined. Accumulated values are
+summed up per destination, because every shard accumulates the amounts of
+its own origins only.
+
+csv results are merged without dependencies, binary matrices (.npy, .npz)
+require NumPy and Arrow tables (.arrow, .feather) pyarrow
+
+to be used with Python 3 (not with Jython)
+'''
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+import csv
+import os
+
+from config import output_format, shard_units
+
+# suffix of the columns of accumulated values (see config.mode_columns)
+ACCUMULATED = '-accumulated'
+
+
+def accumulated_columns(header):
+    '''
+    return the indices of the columns of accumulated values in the header
+    '''
+    return [i for i, column in enumerate(header) if ACCUMULATED in column]
+
+
+def merge_csv(shards, target):
+    '''
+    merge csv results, the rows of the shards are concatenated, accumulated
+    values of the same destination are summed up
+    '''
+    header = None
+    accumulated = OrderedDict()
+    with open(target, 'w', newline='') as f_out:
+        writer = csv.writer(f_out, delimiter=';')
+        for shard in shards:
+            with open(shard, newline='') as f:
+                reader = csv.reader(f, delimiter=';')
+                shard_header = next(reader, None)
+                # shards without any results
+                if shard_header is None:
+                    continue
+                if header is None:
+                    header = shard_header
+                    writer.writerow(header)
+                    summed = accumulated_columns(header)
+                elif shard_header != header:
+                    raise ValueError('the columns of "{}" differ from the '
+                                     'ones of the other shards'.format(shard))
+                if not summed:
+                    writer.writerows(reader)
+                    continue
+                for row in reader:
+                    values = accumulated.get(row[0])
+                    if values is None:
+                        accumulated[row[0]] = row
+                        continue
+                    for i in summed:
+                        values[i] = float(values[i]) + float(row[i])
+        writer.writerows(accumulated.values())
+
+
+def read_meta(shard):
+    with open(os.path.splitext(shard)[0] + '.json') as f:
+        return json.load(f)
+
+
+def check_shards(metas):
+    '''
+    check that the sidecar files describe all shards of the same analysis,
+    returns the number of shards
+    '''
+    counts = set(meta.get('shard', [0, 1])[1] for meta in metas)
+    indices = sorted(meta.get('shard', [0, 1])[0] for meta in metas)
+    if len(counts) != 1 or indices != list(range(counts.pop())):
+        raise ValueError('the shards given are incomplete or belong to '
+                         'different splits ({})'.format(
+                             ', '.join('{}/{}'.format(i + 1, n) for i, n in
+                                       [m.get('shard', [0, 1]) for m in metas])))
+    for key in ['format', 'shape', 'axes', 'dtype', 'times', 'merged']:
+        if len(set(json.dumps(meta.get(key)) for meta in metas)) > 1:
+            raise ValueError('the shards differ in "{}"'.format(key))
+    return len(metas)
+
+
+def write_meta(shards, target, meta, **changes):
+    '''
+    copy the sidecar files of the first shard to the merged target
+    '''
+    import numpy as np
+    path = os.path.dirname(shards[0])
+    base = os.path.splitext(target)[0]
+    meta = OrderedDict(meta)
+    meta.pop('shard', None)
+    for key, suffix in [('origin_ids', '-origins.npy'),
+                        ('destination_ids', '-destinations.npy')]:
+        ids = np.load(os.path.join(path, meta[key]))
+        np.save(base + suffix, ids)
+        meta[key] = os.path.basename(base + suffix)
+    meta['file'] = os.path.basename(target)
+    meta.update(changes)
+    with open(base + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def merge_matrix(shards, target):
+    '''
+    merge dense matrices, the rows evaluated by each shard are copied
+    '''
+    import numpy as np
+    metas = [read_meta(shard) for shard in shards]
+    check_shards(metas)
+    meta = metas[0]
+    shape = meta['shape']
+    n_rows = shape[-2]
+    merged_matrix = np.lib.format.open_memmap(
+        target, mode='w+', dtype=meta['dtype'], shape=tuple(shape))
+    for shard, shard_meta in zip(shards, metas):
+        index, count = shard_meta.get('shard', [0, 1])
+        matrix = np.load(shard, mmap_mode='r')
+        for first, end, time_indices in shard_units(
+            n_rows, len(meta['times']), index, count, merged=meta['merged']):
+            if len(shape) == 2:
+                merged_matrix[first:end] = matrix[first:end]
+                continue
+            for t in time_indices:
+                merged_matrix[t, first:end] = matrix[t, first:end]
+    merged_matrix.flush()
+    del merged_matrix
+    write_meta(shards, target, meta)
+
+
+def merge_sparse(shards, target):
+    '''
+    merge sparse matrices, the rows not evaluated by a shard are empty in it,
+    so the pairs of all shards are combined row by row
+    '''
+    import numpy as np
+    metas = [read_meta(shard) for shard in shards]
+    check_shards(metas)
+    meta = metas[0]
+    n_rows = meta['shape'][0]
+    rows, indices, data = [], [], []
+    for shard in shards:
+        with np.load(shard) as npz:
+            indptr = npz['indptr']
+            rows.append(np.repeat(np.arange(n_rows), np.diff(indptr)))
+            indices.append(npz['indices'])
+            data.append(npz['data'])
+    rows = np.concatenate(rows)
+    # keep the order of the columns within each row
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(n_rows + 1, dtype='i8')
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+    # np.savez would append .npz to other extensions
+    with open(target, 'wb') as f:
+        np.savez(f, format=np.array(['csr']),
+                 shape=np.array(meta['shape'], dtype='i8'), indptr=indptr,
+                 indices=np.concatenate(indices)[order],
+                 data=np.concatenate(data)[order])
+    write_meta(shards, target, meta, nnz=int(indptr[-1]))
+
+
+def merge_arrow(shards, target):
+    '''
+    merge Arrow tables, the rows are concatenated, accumulated values of the
+    same destination are summed up
+    '''
+    import pyarrow as pa
+    import pyarrow.ipc
+    tables = []
+    for shard in shards:
+        with pa.memory_map(shard) as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+    table = pa.concat_tables(tables)
+    summed = accumulated_columns(table.column_names)
+    if summed:
+        key = table.column_names[0]
+        table = table.set_column(0, key, table.column(0).cast(pa.string()))
+        names = [table.column_names[i] for i in summed]
+        grouped = table.group_by(key, use_threads=False).aggregate(
+            [(name, 'sum') for name in names])
+        table = grouped.rename_columns(
+            [name[:-len('_sum')] if name.endswith('_sum') else name
+             for name in grouped.column_names]).select([key] + names)
+    with pa.OSFile(target, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+MERGE_FUNCTIONS = {
+    'csv': merge_csv,
+    'matrix': merge_matrix,
+    'sparse': merge_sparse,
+    'arrow': merge_arrow
+}
+
+
+def get_parser():
+    parser = ArgumentParser(
+        description='Merge the results of the shards of a batch analysis')
+    parser.add_argument('--shards', action='store', nargs='+', required=True,
+                        help='results of all shards (same format)',
+                        dest='shards')
+    parser.add_argument('--target', action='store', required=True,
+                        help='file the merged results will be written to',
+                        dest='target')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    options = parser.parse_args()
+    formats = set(output_format(shard) for shard in options.shards)
+    if len(formats) != 1 or output_format(options.target) not in formats:
+        parser.error('the shards and the target have to be of the same format')
+    try:
+        MERGE_FUNCTIONS[formats.pop()](options.shards, options.target)
+    except ValueError as e:
+        parser.error(str(e))
+    print('{} shards merged into "{}"'.format(len(options.shards),
+                                              options.target))
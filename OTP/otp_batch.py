@@ -7,34 +7,62 @@ to be used with Jython (Java Bindings!)
 @author: Christoph Franke
 '''
 #!/usr/bin/jython
-from config import (DATETIME_FORMAT, INFINITE)
-from otp_eval import OTPEvaluation, CSVWriter
-from argparse import ArgumentParser
+from config import (DATETIME_FORMAT, INFINITE, SERVER_PORT,
+                    SERVER_EXIT_MARKER, OUTPUT_FORMATS, split_params,
+                    output_format as get_output_format)
+from otp_eval import (OTPEvaluation, CSVWriter, MatrixWriter, SparseWriter,
+                      ArrowWriter, StatisticsWriter, OTPServer, Checkpoint)
+from argparse import ArgumentParser, ArgumentTypeError
 from datetime import datetime, timedelta
+import hashlib
+import socket
+import json
 import sys
+import os
 from config import Config
 
-if __name__ == '__main__':
+def parse_shard(value):
+    '''
+    parse a shard given as "i/N" (i starting at 1) into the tuple (index, count)
+    with the index starting at 0
+    '''
+    try:
+        i, n = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ArgumentTypeError('shard has to be given as i/N')
+    if n < 1 or not 1 <= i <= n:
+        raise ArgumentTypeError('shard {} is out of range'.format(value))
+    return (i - 1, n)
+
+
+def get_parser():
     parser = ArgumentParser(description="Batch Analysis with OpenTripPlanner")
 
     parser.add_argument('--origins', action="store",
                         help="csv file containing the origin points " +
-                        "with at least lat/lon and id",
-                        dest="origins", required=True)
+                        "with at least lat/lon and id, or points file " +
+                        "(.pts) written by the plugin",
+                        dest="origins")
 
     parser.add_argument('--destinations', action="store",
                         help="csv file containing the destination points " +
-                        "with at least lat/lon and id",
-                        dest="destinations", required=True)
+                        "with at least lat/lon and id, or points file " +
+                        "(.pts) written by the plugin",
+                        dest="destinations")
 
     parser.add_argument('--config', action="store",
                         help="xml file containing the configuration for trip " +
                         "planning (for xml-structure see Config.setting_struct)",
-                        dest="config_file", required=True)
+                        dest="config_file")
 
     parser.add_argument('--target', action="store",
                         help="target csv file the results will be written to " +
-                        "(overwrites existing file)",
+                        "(overwrites existing file), a target ending with " +
+                        ".npy is written as dense binary travel time matrix, " +
+                        "one ending with .npz as sparse matrix (CSR) of the " +
+                        "reachable pairs, one ending with .arrow or .feather " +
+                        "as typed table in Arrow IPC file format (the format " +
+                        "can also be set in the config)",
                         dest="target", default="otp_results.csv")
 
     parser.add_argument('--nlines', action="store",
@@ -43,25 +71,110 @@ if __name__ == '__main__':
                         "(write every n results)",
                         dest="nlines", default=50, type=int)
 
+    parser.add_argument('--resume', action="store_true",
+                        help="resume an interrupted run into the same target " +
+                        "from its last checkpoint (the finished sources and " +
+                        "times are skipped), starts from scratch if there is " +
+                        "no checkpoint of the same job",
+                        dest="resume")
+
+    parser.add_argument('--shard', action="store",
+                        help="evaluate only the share i/N (e.g. 2/4) of the " +
+                        "sources and times, for splitting a batch across " +
+                        "N machines, the results of all shards are combined " +
+                        "with merge_shards.py",
+                        dest="shard", type=parse_shard)
+
+    parser.add_argument('--serve', action="store_true",
+                        help="start a long-running evaluation server keeping " +
+                        "the graphs loaded, jobs are submitted with --server",
+                        dest="serve")
+
+    parser.add_argument('--port', action="store",
+                        help="port the evaluation server listens to " +
+                        "(only used with --serve)",
+                        dest="port", default=SERVER_PORT, type=int)
+
+    parser.add_argument('--server', action="store",
+                        help="submit the job to the evaluation server " +
+                        "listening to the given port instead of loading " +
+                        "the graph here",
+                        dest="server", type=int)
 
     parser.set_defaults(arriveby=False)
-
-    options = parser.parse_args()
+    return parser
+
+
+def submit(port, args):
+    '''
+    submit a job to the evaluation server listening to the given port on
+    localhost, the output of the server is written to stdout
+
+    returns the exit code of the job
+    '''
+    sock = socket.create_connection(('127.0.0.1', port))
+    exit_code = 1
+    try:
+        job = {'command': 'evaluate', 'args': args}
+        sock.sendall(json.dumps(job) + '\n')
+        f = sock.makefile('r')
+        for line in f:
+            if line.startswith(SERVER_EXIT_MARKER):
+                exit_code = int(line[len(SERVER_EXIT_MARKER):])
+                break
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    finally:
+        sock.close()
+    return exit_code
+
+
+def job_fingerprint(config, origins_csv, destinations_csv, target,
+                    output_format, shard=None):
+    '''
+    return a fingerprint of the inputs of a job, a checkpoint is only resumed
+    by a job with the same fingerprint
+
+    the settings are hashed canonically (see Config.hash), so rewriting the
+    config with other metadata doesn't change the fingerprint
+    '''
+    hash_obj = hashlib.sha1(config.hash())
+    for filename in [origins_csv, destinations_csv]:
+        stat = os.stat(filename)
+        hash_obj.update('{}:{}:{}'.format(
+            os.path.abspath(filename), stat.st_size, int(stat.st_mtime)))
+    hash_obj.update('{}:{}:{}'.format(os.path.abspath(target), output_format,
+                                      shard))
+    return hash_obj.hexdigest()
+
+
+def run(args=None, server=None):
+    '''
+    evaluate the job described by the given command line arguments, the
+    options of the server (--serve, --port, --server) are ignored
+
+    Parameters
+    ----------
+    args: optional, list of arguments (defaults to sys.argv)
+    server: optional, OTPServer, if given the graph is taken from the
+            routers already loaded by the server
+    '''
+    parser = get_parser()
+    options = parser.parse_args(args)
+    if not (options.origins and options.destinations and options.config_file):
+        parser.error('--origins, --destinations and --config are required')
 
     origins_csv = options.origins
     destinations_csv = options.destinations
     target_csv = options.target
     print_every_n_lines = options.nlines
 
-    # read configuration from xml-file
-    # unfortunately you can't use lxml in jython (because parts are compiled
-    # in c) as in Config (config.py)
-    # so i had to use xml.minidom instead (ugly but inevitable)
-
-    # config.read(options.config_file)
-
+    # the values of the settings are converted to their types when reading
     config = Config()
     config.read(options.config_file)
+    if config.invalid:
+        parser.error('invalid settings in the config: {}'.format(
+            ', '.join(config.invalid)))
 
     # router
     router_config = config.settings['router_config']
@@ -74,21 +187,21 @@ if __name__ == '__main__':
         max_time = None
     else:
         max_time *= 60 # OTP needs this one in seconds
-    max_walk = float(router_config['max_walk_distance'])
+    max_walk = router_config['max_walk_distance']
     # max value -> no need to set it up (is Double.MAX_VALUE in OTP by default),
     # same as max_time
     if max_walk >= INFINITE:
         max_walk = None
-    walk_speed = float(router_config['walk_speed'])
-    bike_speed = float(router_config['bike_speed'])
-    clamp_wait = int(router_config['clamp_initial_wait_min'])
+    walk_speed = router_config['walk_speed']
+    bike_speed = router_config['bike_speed']
+    clamp_wait = router_config['clamp_initial_wait_min']
     if clamp_wait > 0:
         clamp_wait *= 60
-    pre_transit_time = int(router_config['pre_transit_time_min'])
+    pre_transit_time = router_config['pre_transit_time_min']
     pre_transit_time *= 60
-    max_transfers = int(router_config['max_transfers'])
-    wheel_chair_accessible = router_config['wheel_chair_accessible'] == 'True'
-    max_slope = float(router_config['max_slope'])
+    max_transfers = router_config['max_transfers']
+    wheel_chair_accessible = router_config['wheel_chair_accessible']
+    max_slope = router_config['max_slope']
 
     traverse_modes = router_config['traverse_modes']
 
@@ -102,19 +215,18 @@ if __name__ == '__main__':
     times = config.settings['time']
     dt = times['datetime']
     date_times = [datetime.strptime(dt, DATETIME_FORMAT)]
-    arrive_by = times['arrive_by'] == 'True'
+    arrive_by = times['arrive_by']
     smart_search = False
-    if 'time_batch' in times and times['time_batch']['active'] == 'True':
+    time_batch = times['time_batch']
+    if time_batch['active']:
 
-        time_batch = times['time_batch']
-        smart_search = time_batch['smart_search'] == 'True'
+        smart_search = time_batch['smart_search']
 
         dt_end = time_batch['datetime_end']
         date_time_end = datetime.strptime(dt_end, DATETIME_FORMAT)
-#         if smart_search:
-#             time_step = 1
-#         else:
-        time_step = int(time_batch['time_step'])
+        time_step = time_batch['time_step']
+        if not time_step:
+            parser.error('the time step of the time batch is missing')
 
         dt = date_times[0]
         step_delta = timedelta(0, time_step * 60) # days, seconds ...
@@ -126,42 +238,52 @@ if __name__ == '__main__':
 
     # post processing
     postproc = config.settings['post_processing']
-    if 'best_of' in postproc and len(postproc['best_of']) > 0:
-        bestof = int(postproc['best_of'])
-    else:
-        bestof = None
+    bestof = postproc['best_of']
+    calculate_details = postproc['details']
+    write_dest_data = postproc['dest_data']
 
-    details = postproc['details']
-    calculate_details = details == 'True' # avoid error if key does not exist or
-                                          # data is empty
-
-    dest_data = postproc['dest_data']
-    write_dest_data = dest_data == 'True' # avoid error if key does not exist or
-                                          # data is empty
+    # format set in config has priority over extension of target
+    output_format = get_output_format(target_csv, postproc['output_format'])
+    if output_format not in OUTPUT_FORMATS:
+        parser.error('unknown output format "{}" (available: {})'.format(
+            output_format, ', '.join(OUTPUT_FORMATS.keys())))
 
     mode = field = params = None
-    if 'aggregation_accumulation' in postproc:
-        agg_acc = postproc['aggregation_accumulation']
-        active = agg_acc['active']
-        if active == 'True':
-            mode = agg_acc['mode']
-            params = agg_acc['params']
-            if isinstance(params, list):
-                params = [float(x) for x in params]
-            if isinstance(params, str):
-                params = [float(x) for x in params.split(',')]
-            field = agg_acc['processed_field']
+    agg_acc = postproc['aggregation_accumulation']
+    if agg_acc['active']:
+        mode = agg_acc['mode']
+        params = agg_acc['params']
+        field = agg_acc['processed_field']
+        # multiple sets of params (e.g. thresholds) are evaluated at once
+        try:
+            split_params(mode, params)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # statistics over all times instead of the results of each time
+    statistics = None
+    if postproc['statistics']['active']:
+        statistics = postproc['statistics']
+        if [p for p in statistics['percentiles'] if not 0 <= p <= 100]:
+            parser.error('percentiles have to be between 0 and 100')
 
     # system settings
     sys_settings = config.settings['system']
-    n_threads = int(sys_settings['n_threads'])
+    n_threads = sys_settings['n_threads']
+    n_parallel_times = sys_settings['n_parallel_times']
 
     # results will be stored 2 dimensional to determine to which time the
     # results belong, flattened later
     results = []
 
-    otpEval = OTPEvaluation(graph_path, router, print_every_n_lines,
-                            calculate_details, smart_search)
+    if server is not None:
+        otpEval = server.get_evaluation(graph_path, router,
+                                        print_every_n_lines=print_every_n_lines,
+                                        calculate_details=calculate_details,
+                                        smart_search=smart_search)
+    else:
+        otpEval = OTPEvaluation(graph_path, router, print_every_n_lines,
+                                calculate_details, smart_search)
 
     otpEval.setup(max_walk=max_walk,
                   walk_speed=walk_speed,
@@ -173,23 +295,64 @@ if __name__ == '__main__':
                   max_pre_transit_time=pre_transit_time,
                   wheel_chair_accessible=wheel_chair_accessible,
                   max_slope=max_slope,
-                  n_threads=n_threads)
+                  n_threads=n_threads,
+                  n_parallel_times=n_parallel_times)
 
     # merge results over time, if aggregation or accumulation is requested or
     # bestof
     do_merge = True if mode is not None or bestof else False
 
-    csv_writer = CSVWriter(target_csv, oid, did, mode, field,
-                           params, bestof, arrive_by=arrive_by,
-                           write_dest_data=write_dest_data,
-                           calculate_details=calculate_details)
+    if statistics is not None:
+        if mode is not None or bestof or output_format != 'csv':
+            parser.error('statistics over time can only be written as csv ' +
+                         'and not combined with aggregation, accumulation ' +
+                         'or best of')
+        csv_writer = StatisticsWriter(target_csv, oid, did, max_time=max_time,
+                                      percentiles=statistics['percentiles'],
+                                      thresholds=statistics['thresholds'],
+                                      arrive_by=arrive_by)
+    elif output_format in ['matrix', 'sparse']:
+        if mode is not None or bestof:
+            parser.error('binary matrices can only be written for plain ' +
+                         'origin destination travel times (no aggregation, ' +
+                         'accumulation or best of)')
+        writer_class = MatrixWriter if output_format == 'matrix' else SparseWriter
+        csv_writer = writer_class(target_csv, oid, did, arrive_by=arrive_by,
+                                  shard=options.shard)
+    else:
+        writer_class = ArrowWriter if output_format == 'arrow' else CSVWriter
+        csv_writer = writer_class(target_csv, oid, did, mode, field,
+                                  params, bestof, arrive_by=arrive_by,
+                                  write_dest_data=write_dest_data,
+                                  calculate_details=calculate_details)
+
+    # progress is committed after each finished unit, the checkpoint is
+    # removed when the run is complete
+    checkpoint = Checkpoint(
+        target_csv + '.checkpoint',
+        job_fingerprint(config, origins_csv, destinations_csv,
+                        target_csv, output_format, shard=options.shard),
+        resume=options.resume)
 
     results = otpEval.evaluate(date_times, long(max_time),
                                origins_csv, destinations_csv,
                                csv_writer,
-                               do_merge=do_merge)
+                               do_merge=do_merge,
+                               checkpoint=checkpoint,
+                               shard=options.shard)
 
     #otpEval.results_to_csv(results, target_csv, oid, did, mode, field, params,
     #                       bestof, arrive_by=arrive_by,
     #                       write_dest_data=write_dest_data)
 
+
+if __name__ == '__main__':
+    options = get_parser().parse_args()
+    if options.serve:
+        OTPServer(port=options.port).serve_forever(run)
+    elif options.server:
+        # the arguments are passed as they are, run() ignores the server
+        # option (parsed above in whatever form it was given)
+        sys.exit(submit(options.server, sys.argv[1:]))
+    else:
+        run()
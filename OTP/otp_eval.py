@@ -10,16 +10,286 @@ to be used with Jython (Java Bindings!)
 
 from java.text import SimpleDateFormat
 from java.util import TimeZone
+from java.lang import (System, Throwable, Runtime, String, Class,
+                       ClassNotFoundException)
+from java.lang.management import ManagementFactory, MemoryType
+from java.util.concurrent import Callable, Executors
+from java.net import ServerSocket, InetAddress, SocketTimeoutException
+from java.io import (PrintStream, BufferedReader, InputStreamReader,
+                     IOException,
+                     RandomAccessFile, FileOutputStream)
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from java.nio.file import Files, Paths, StandardCopyOption
+from java.util.zip import ZipOutputStream, ZipEntry
 from org.opentripplanner.scripting.api import OtpsEntryPoint
 from org.opentripplanner.scripting.api import OtpsAggregate, OtpsAccumulate
+from arrow_ipc import ArrowFileWriter, Column, dictionary_encode
+from points import read_points, EXTENSION as POINTS_EXTENSION
+from smart_search import smart_search, signature, UNREACHABLE, NO_TRANSIT
+from travel_times import TravelTimeStatistics
 from config import (LONGITUDE_COLUMN, LATITUDE_COLUMN, DATETIME_FORMAT,
-                    AGGREGATION_MODES, ACCUMULATION_MODES, OUTPUT_DATE_FORMAT)
+                    AGGREGATION_MODES, ACCUMULATION_MODES, OUTPUT_DATE_FORMAT,
+                    SERVER_PORT, SERVER_EXIT_MARKER, SERVER_MAX_ROUTERS,
+                    PROGRESS_MARKER, RESULT_BYTES, RESULT_DETAILS_BYTES,
+                    RESULT_DEST_DATA_BYTES, HEAP_FRACTION,
+                    held_result_sets, split_params, mode_columns, shard_units)
+from collections import OrderedDict
 from datetime import datetime
+from array import array
+import traceback
+import tempfile
+import shutil
+import struct
+import json
+import time
 import csv
+import sys
 import os
 
+NAN = float('nan')
 
-class CSVWriter(object):
+# details of the results: name of column, getter of the result, type
+# (getters of the times are called with OUTPUT_DATE_FORMAT)
+RESULT_DETAILS = [
+    ('boardings', 'getBoardings', 'int32'),
+    ('walk/bike distance (m)', 'getWalkDistance', 'float64'),
+    ('start time', 'getStartTime', 'timestamp'),
+    ('arrival time', 'getArrivalTime', 'timestamp'),
+    ('start transit', 'getStartTransit', 'timestamp'),
+    ('arrival transit', 'getArrivalTransit', 'timestamp'),
+    ('distance (m)', 'getDistance', 'float64'),
+    ('transit time', 'getTransitTime', 'int64'),
+    ('traverse modes', 'getModes', 'utf8'),
+    ('waiting time (sec)', 'getWaitingTime', 'int64'),
+    ('elevation gained (m)', 'getElevationGained', 'float64'),
+    ('elevation lost (m)', 'getElevationLost', 'float64')
+]
+
+
+class ResultExtractor(object):
+    '''
+    extracts the values of the results of a result set column by column
+    instead of result by result
+
+    the getters are looked up once per column and mapped over all results,
+    which saves most of the costly attribute lookups on the java objects
+
+    Parameters
+    ----------
+    id_field: name of the field of the ids of the individuals the results lead to
+    calculate_details: optional, if True the details (see RESULT_DETAILS) are extracted
+    data_fields: optional, names of the fields of the individuals to extract
+    timestamps: optional, if True times of the details are converted to seconds since epoch (without timezone), else they are kept formatted with OUTPUT_DATE_FORMAT
+    '''
+    def __init__(self, id_field, calculate_details=False, data_fields=[],
+                 timestamps=False):
+        self.id_field = id_field
+        self.calculate_details = calculate_details
+        self.data_fields = data_fields
+        self.timestamps = timestamps
+        self.date_format = SimpleDateFormat(OUTPUT_DATE_FORMAT)
+        self.date_format.setTimeZone(TimeZone.getTimeZone('UTC'))
+        # the results share few distinct times, each is parsed only once
+        self.epochs = {}
+
+    def epoch(self, formatted):
+        '''
+        return the seconds since epoch of the formatted time, None if not set
+        '''
+        if not formatted:
+            return None
+        seconds = self.epochs.get(formatted)
+        if seconds is None:
+            seconds = self.date_format.parse(formatted).getTime() // 1000
+            self.epochs[formatted] = seconds
+        return seconds
+
+    def extract(self, results):
+        '''
+        extract the values of the reachable results (unreachable ones are
+        None and skipped)
+
+        returns the ids of the individuals of the results and an OrderedDict
+        with the names of the columns as keys and lists of values
+        '''
+        results = [r for r in results if r is not None]
+        columns = OrderedDict()
+        if not results:
+            return [], columns
+        # unbound methods of the result class
+        cls = type(results[0])
+        individuals = map(cls.getIndividual, results)
+        get_data = type(individuals[0]).getStringData
+        ids = [get_data(i, self.id_field) for i in individuals]
+        columns['travel time (sec)'] = map(cls.getTime, results)
+        if self.calculate_details:
+            for name, getter, dtype in RESULT_DETAILS:
+                method = getattr(cls, getter)
+                if dtype == 'timestamp':
+                    values = [method(r, OUTPUT_DATE_FORMAT) for r in results]
+                    if self.timestamps:
+                        values = map(self.epoch, values)
+                else:
+                    values = map(method, results)
+                columns[name] = values
+        for field in self.data_fields:
+            columns['destination_' + field] = [get_data(i, field)
+                                               for i in individuals]
+        return ids, columns
+
+
+class Accumulation(object):
+    '''
+    accumulates the amounts of the sources onto the targets over all written
+    slices of sources, the accumulations of the result sets of every slice
+    are summed up in place (the decay accumulation is additive over the
+    sources), so that the sums can be checkpointed and resumed
+
+    Parameters
+    ----------
+    mode: the accumulation mode (see config.ACCUMULATION_MODES)
+    field: the field of the sources holding the amounts
+    params: params of the mode, multiple sets of params are accumulated at once (see config.split_params)
+    '''
+    def __init__(self, mode, field, params):
+        self.mode = mode
+        self.field = field
+        self.param_sets = split_params(mode, params)
+        # sums per set of params, in order of the population of the targets
+        self.sums = None
+
+    def add(self, result_sets):
+        '''
+        accumulate the amounts of the roots of the result sets onto the
+        individuals they reach
+        '''
+        accumulators = [OtpsAccumulate(self.mode, params)
+                        for params in self.param_sets]
+        accumulated = False
+        for result_set in result_sets:
+            if result_set is None:
+                continue
+            amount = result_set.getRoot().getFloatData(self.field)
+            for accumulator in accumulators:
+                accumulator.accumulate(result_set, amount)
+            accumulated = True
+        if not accumulated:
+            return
+        for i, accumulator in enumerate(accumulators):
+            values = accumulator.getResults()
+            if self.sums is None:
+                self.sums = [array('d', [0]) * len(values)
+                             for params in self.param_sets]
+            sums = self.sums[i]
+            for j, value in enumerate(values):
+                sums[j] += value
+
+    def rows(self):
+        '''
+        yield the index of the target in its population and the accumulated
+        values (one per set of params) of all targets
+        '''
+        if self.sums is None:
+            return
+        for j, values in enumerate(zip(*self.sums)):
+            yield j, list(values)
+
+    def state(self):
+        '''
+        return the sums accumulated so far (json serializable)
+        '''
+        if self.sums is None:
+            return None
+        return [list(sums) for sums in self.sums]
+
+    def restore(self, state):
+        '''
+        continue accumulating from the given state (see state())
+        '''
+        self.sums = None
+        if state is not None:
+            self.sums = [array('d', sums) for sums in state]
+
+
+class ResultWriter(object):
+    '''
+    base class of the writers the result sets of OTPEvaluation.evaluate are
+    passed to
+
+    evaluate() calls open() before the first and close() after the last
+    result sets are written, write() is called for every evaluated slice of
+    sources (and time, if the results are not merged)
+
+    writers reducing the results of all times of a slice themselves
+    (reduces_times) get the results of every time of a slice, followed by
+    finish_slice() after the last one
+    '''
+    write_dest_data = False
+    reduces_times = False
+    # memory held by the writer per pair of a slice in bytes
+    pair_bytes = 0
+
+    def open(self, origins, destinations, times, merged=False):
+        '''
+        prepare writing the results
+
+        Parameters
+        ----------
+        origins: population of all origins
+        destinations: population of all destinations
+        times: list of the evaluated date times
+        merged: optional, if True the results of all times are merged and written only once per slice
+        '''
+        pass
+
+    def write(self, result_sets, append=True, additional_columns={},
+              from_index=0, time_index=0):
+        '''
+        write result sets
+
+        Parameters
+        ----------
+        result_sets: list of result_sets
+        append: optional, if True append results, else overwrite
+        additional_columns: optional, dict with column-names/values as key/value pairs
+        from_index: optional, index of the first source of the result sets in the population of all sources
+        time_index: optional, index of the time the result sets were evaluated at
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        finish writing the results
+        '''
+        pass
+
+    def finish_slice(self, from_index=0):
+        '''
+        called after the results of all times of the slice of sources
+        starting at from_index were written (only if reduces_times)
+        '''
+        pass
+
+    def checkpoint(self):
+        '''
+        make the results written so far durable
+
+        returns the state of the writer (json serializable) to resume
+        writing from after an interruption, see resume()
+        '''
+        return {}
+
+    def resume(self, origins, destinations, times, merged=False, state={}):
+        '''
+        prepare writing the results like open() but continue the output of an
+        interrupted evaluation from the given state (see checkpoint()), the
+        results written after the state was taken are discarded
+        '''
+        raise NotImplementedError
+
+
+class CSVWriter(ResultWriter):
     '''
     Parameters
     ----------
@@ -28,10 +298,13 @@ class CSVWriter(object):
     did: name of the field of the destination ids
     mode: optional, the aggregation or accumulation mode (see config.AGGREGATION_MODES resp. config.ACCUMULATION_MODES)
     field: optional, the field to aggregate/accumulate
-    params: optional, params needed by the aggregation/accumulation mode (e.g. thresholds)
+    params: optional, params needed by the aggregation/accumulation mode (e.g. thresholds), multiple sets of params are aggregated/accumulated at once into one column per set (see config.split_params)
     write_dest_data: optional, if True write the original columns of the destinations to the target_csv
     calculate_details: optional, if True write details like departure and arrival time to target_csv
     '''
+    # size of the write buffer in bytes
+    BUFFER_SIZE = 4 * 1024 * 1024
+
     def __init__(self, target_csv, oid, did, mode, field,
                  params, bestof=None, arrive_by=False,
                  write_dest_data=False, calculate_details=False):
@@ -45,18 +318,127 @@ class CSVWriter(object):
         self.field = field
         self.params = params
         self.calculate_details = calculate_details
-        if os.path.exists(target_csv):
-            os.remove(target_csv)
+        self.file = None
+        self.writer = None
+        self.header_written = False
+        self.data_fields = None
+        self.accumulation = None
+        self.accumulated_ids = None
+
+    def open(self, origins=None, destinations=None, times=None, merged=False):
+        '''
+        open the target_csv for writing, it stays open until close() is
+        called, the header is written with the first results
+        '''
+        self.close()
+        self.file = open(self.target_csv, 'wb', self.BUFFER_SIZE)
+        self.writer = csv.writer(self.file, delimiter=';')
+        self.header_written = False
+        self.set_data_fields(destinations)
+        self.start_accumulation(origins, destinations)
+
+    def set_data_fields(self, destinations=None):
+        '''
+        set the names of the fields of the destinations written with the
+        results (except the id) from the population of the destinations,
+        if not given they are taken from the first written results
+        '''
+        self.data_fields = None
+        if destinations is not None:
+            self.data_fields = [f for f in destinations.getDataFields()
+                                if f != self.did]
 
-    def write(self, result_sets, append=True, additional_columns={}):
+    def start_accumulation(self, origins=None, destinations=None, state=None):
+        '''
+        reset the accumulation (if accumulating) to the given state, the
+        ids of the targets are taken from the populations if given (else
+        from the first written results)
+        '''
+        self.accumulation = None
+        self.accumulated_ids = None
+        if self.mode not in ACCUMULATION_MODES:
+            return
+        self.accumulation = Accumulation(self.mode, self.field, self.params)
+        self.accumulation.restore(state)
+        targets = origins if self.arrive_by else destinations
+        if targets is not None:
+            self.accumulated_ids = [t.getStringData(self.target_field)
+                                    for t in targets]
+
+    @property
+    def target_field(self):
+        '''
+        name of the field of the ids of the targets (the individuals the
+        results lead to)
+        '''
+        return self.oid if self.arrive_by else self.did
+
+    def close(self):
+        '''
+        write the accumulated results (if accumulating), flush the buffered
+        results and close the target_csv
+        '''
+        if self.file is not None:
+            if self.accumulation is not None:
+                self.write_accumulated()
+            self.file.close()
+            self.file = None
+            self.writer = None
+
+    def write_accumulated(self):
+        '''
+        write a row per target with the values accumulated over all slices
+        '''
+        n_rows = 0
+        for j, values in self.accumulation.rows():
+            self.writer.writerow([self.accumulated_ids[j]] + values)
+            n_rows += 1
+        self.accumulation = None
+        if n_rows:
+            print 'accumulated results of {} target(s) written to "{}"'.format(
+                n_rows, self.target_csv)
+
+    def checkpoint(self):
+        accumulated = (self.accumulation.state()
+                       if self.accumulation is not None else None)
+        if self.file is None:
+            return {'offset': 0, 'header_written': False,
+                    'accumulated': accumulated}
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'offset': self.file.tell(),
+                'header_written': self.header_written,
+                'accumulated': accumulated}
+
+    def resume(self, origins=None, destinations=None, times=None,
+               merged=False, state={}):
+        self.close()
+        if not os.path.exists(self.target_csv):
+            open(self.target_csv, 'wb').close()
+        self.file = open(self.target_csv, 'r+b', self.BUFFER_SIZE)
+        self.file.truncate(state.get('offset', 0))
+        self.file.seek(0, os.SEEK_END)
+        self.writer = csv.writer(self.file, delimiter=';')
+        self.header_written = state.get('header_written', False)
+        self.set_data_fields(destinations)
+        self.start_accumulation(origins, destinations,
+                                state=state.get('accumulated'))
+
+    def write(self, result_sets, append=True, additional_columns={},
+              from_index=0, time_index=0):
         '''
         write result sets to csv file, may aggregate/accumulate before writing results
 
+        the results are streamed into the file opened with open() (opened
+        automatically if not done before)
+
         Parameters
         ----------
         result_sets: list of result_sets
-        append: optional, if True append results to target_csv, else overwrite
+        append: optional, not used (all results are appended to the opened file)
         additional_columns: optional, dict with column-names/values as key/value pairs
+        from_index: optional, not used (rows are identified by their ids)
+        time_index: optional, not used (see additional_columns)
         '''
         print 'post processing results...'
 
@@ -67,122 +449,1163 @@ class CSVWriter(object):
         if not self.mode:
             header += [ 'destination id', 'travel time (sec)'] + additional_columns.keys()
             if self.calculate_details:
-                details = ['boardings', 'walk/bike distance (m)',
-                           'start time', 'arrival time', 'start transit', 'arrival transit', 'distance (m)',
-                           'transit time', 'traverse modes', 'waiting time (sec)', 'elevation gained (m)',
-                           'elevation lost (m)']
-                header += details
+                header += [name for name, getter, dtype in RESULT_DETAILS]
         elif self.mode in AGGREGATION_MODES.keys():
-            header += [self.field + '-aggregated']
             do_aggregate = True
         elif self.mode in ACCUMULATION_MODES.keys():
-            header += [self.field + '-accumulated']
             do_accumulate = True
+            # the values are accumulated onto the targets
+            if not self.arrive_by:
+                header = [ 'destination id' ]
+        if do_aggregate or do_accumulate:
+            param_sets = split_params(self.mode, self.params)
+            header += mode_columns(self.field, self.mode, param_sets)
 
         # add header for data of destinations
-        if self.write_dest_data and not (do_accumulate or do_aggregate):
-            # all results share the same data names, cause they originate from the same csv file
-            # you just have to find a valid result
-            for i, res in enumerate(result_sets):
-                if res is None:
-                    continue
+        write_dest_data = self.write_dest_data and not (do_accumulate or
+                                                        do_aggregate)
+        if write_dest_data:
+            if self.data_fields is None:
+                # all results share the same data names, cause they originate
+                # from the same csv file, you just have to find a valid result
+                reached = [r for r in result_sets if r is not None]
+                if not reached:
+                    return
                 if self.arrive_by:
-                    data_fields = result_sets[i].getRoot().getDataFields()
+                    data_fields = reached[0].getRoot().getDataFields()
                 else:
-                    data_fields = result_sets[i].getPopulation().getDataFields()
-                data_fields.remove(self.did)
-                for field in data_fields:
-                    header.append('destination_' + field)
-                break # found one -> break
-
-        write_header = True
-        if not append:
-            fmode = 'wb'
+                    data_fields = reached[0].getPopulation().getDataFields()
+                self.data_fields = [f for f in data_fields if f != self.did]
+            header += ['destination_' + field for field in self.data_fields]
+
+        if self.file is None:
+            self.open()
+        writer = self.writer
+
+        if not self.header_written:
+            writer.writerow(header)
+            self.header_written = True
+
+        # the accumulated values are written once after all slices (close())
+        if do_accumulate:
+            reached = [r for r in result_sets if r is not None]
+            if reached and self.accumulated_ids is None:
+                self.accumulated_ids = [i.getStringData(self.target_field)
+                                        for i in reached[0].getPopulation()]
+            self.accumulation.add(result_sets)
+            return
+
+        # all sets of params are processed with the same result sets
+        if do_aggregate:
+            aggregators = [OtpsAggregate(self.mode, params)
+                           for params in param_sets]
         else:
-            fmode = 'a'
-            if os.path.exists(self.target_csv):
-                write_header = False
+            # the data of the destinations is taken from the results only if
+            # they lead to the destinations
+            extractor = ResultExtractor(
+                self.oid if self.arrive_by else self.did,
+                calculate_details=self.calculate_details,
+                data_fields=self.data_fields if (write_dest_data and
+                                                 not self.arrive_by) else [])
 
-        with open(self.target_csv, fmode) as f_csv:
-            writer = csv.writer(f_csv, delimiter=';')
+        for result_set in result_sets:
+            if result_set is None:
+                continue
 
-            if write_header:
-                writer.writerow(header)
+            if self.arrive_by:
+                destination = result_set.getRoot()
+                dest_id = destination.getStringData(self.did)
+            else:
+                origin_id = result_set.getRoot().getStringData(self.oid)
 
-            if do_accumulate:
-                accumulator = OtpsAccumulate(self.mode, self.params)
+            if do_aggregate:
+                aggregated = [aggregator.aggregate(result_set, self.field)
+                              for aggregator in aggregators]
+                # origin_id is known here, because !arriveby when aggregating
+                writer.writerow([origin_id] + aggregated)
+                continue
 
-            for result_set in result_sets:
+            if self.bestof is not None:
+                results = result_set.getBestResults(self.bestof)
+            else:
+                results = result_set.getResults();
+
+            ids, columns = extractor.extract(results)
+            n = len(ids)
+            if n == 0:
+                continue
+            if self.arrive_by:
+                rows = [ids, [dest_id] * n]
+            else:
+                rows = [[origin_id] * n, ids]
+            rows += columns.values()
+            rows[3:3] = [[value] * n for value in additional_columns.values()]
+            if write_dest_data and self.arrive_by:
+                # all results lead to the root
+                for field in self.data_fields:
+                    rows.append([destination.getStringData(field)] * n)
+
+            writer.writerows(zip(*rows))
+
+        print 'results written to "{}"'.format(self.target_csv)
+
+
+def npy_header(descr, shape, fortran_order=False, size=None):
+    '''
+    return the header of a numpy file (format version 1.0) for an array of
+    given type description (e.g. '<f4') and shape
+
+    the header is padded to a multiple of 64 bytes or to the given size
+    (allows rewriting it later on, when the final shape is known)
+    '''
+    shape_repr = ', '.join(str(int(n)) for n in shape)
+    if len(shape) == 1:
+        shape_repr += ','
+    header = "{{'descr': '{}', 'fortran_order': {}, 'shape': ({}), }}".format(
+        descr, fortran_order, shape_repr)
+    # magic string, version and length of header take 10 bytes, the header
+    # is padded with spaces and terminated by a newline
+    if size is None:
+        size = 10 + len(header) + 1
+        size += (64 - size % 64) % 64
+    header += ' ' * (size - 10 - len(header) - 1) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+
+def npy_strings(strings):
+    '''
+    return the content of a numpy file with the given strings as array of
+    fixed-width unicode type
+    '''
+    width = max([len(s) for s in strings] + [1])
+    content = [npy_header('<U{}'.format(width), (len(strings), ))]
+    for s in strings:
+        codes = [ord(c) for c in s] + [0] * (width - len(s))
+        content.append(struct.pack('<{}I'.format(width), *codes))
+    return ''.join(content)
+
+
+def write_npy_strings(filename, strings):
+    '''
+    write a list of strings as numpy file with a fixed-width unicode type
+    '''
+    with open(filename, 'wb') as f:
+        f.write(npy_strings(strings))
+
+
+class BinaryWriter(ResultWriter):
+    '''
+    base class of the writers storing the travel times (in seconds) in numpy
+    formats
+
+    the rows are the sources (origins resp. destinations if arrive by), the
+    columns the targets, both in the order of the input files. The ids are
+    written to the sidecar files "<name>-origins.npy" and
+    "<name>-destinations.npy", the layout of the results is described in
+    "<name>.json"
+
+    Parameters
+    ----------
+    target: filename of the file to write to
+    oid: name of the field of the origin ids
+    did: name of the field of the destination ids
+    dtype: optional, type of the travel times, 'float32' or 'int32'
+    arrive_by: optional, True if the sources are the destinations
+    shard: optional, tuple (index, count) of the shard the results are
+           evaluated by (see config.shard_units), recorded in the sidecar file
+           for merging the shards
+    '''
+    DTYPES = {
+        'float32': ('<f4', 4),
+        'int32': ('<i4', 4)
+    }
+
+    def __init__(self, target, oid, did, dtype='float32', arrive_by=False,
+                 shard=None):
+        if dtype not in self.DTYPES:
+            raise ValueError('unsupported dtype {}'.format(dtype))
+        self.target = target
+        self.oid = oid
+        self.did = did
+        self.dtype = dtype
+        self.descr, self.item_size = self.DTYPES[dtype]
+        self.arrive_by = arrive_by
+        self.shard = shard
+        self.base = os.path.splitext(target)[0]
+
+    def open(self, origins, destinations, times, merged=False):
+        origin_ids = [o.getStringData(self.oid) for o in origins]
+        destination_ids = [d.getStringData(self.did) for d in destinations]
+        write_npy_strings(self.base + '-origins.npy', origin_ids)
+        write_npy_strings(self.base + '-destinations.npy', destination_ids)
+        if self.arrive_by:
+            self.axes = ['destination', 'origin']
+            self.n_rows, self.n_cols = len(destination_ids), len(origin_ids)
+        else:
+            self.axes = ['origin', 'destination']
+            self.n_rows, self.n_cols = len(origin_ids), len(destination_ids)
+        self.times = times
+        self.merged = merged
+
+    def write_meta(self, **meta):
+        '''
+        write the description of the results to the json sidecar file
+        '''
+        description = OrderedDict([
+            ('file', os.path.basename(self.target)),
+            ('dtype', self.dtype),
+            ('unit', 'seconds'),
+            ('times', [t.strftime(DATETIME_FORMAT) for t in self.times]),
+            ('merged', self.merged),
+            ('origin_ids', os.path.basename(self.base + '-origins.npy')),
+            ('destination_ids', os.path.basename(self.base + '-destinations.npy'))
+        ])
+        if self.shard is not None:
+            description['shard'] = list(self.shard)
+        description.update(meta)
+        with open(self.base + '.json', 'w') as f:
+            json.dump(description, f, indent=2)
+
+
+class MatrixWriter(BinaryWriter):
+    '''
+    writes the travel times (in seconds) into a dense matrix stored as
+    numpy file (.npy) that can be memory-mapped by downstream tools without
+    parsing (e.g. numpy.load(target, mmap_mode='r'))
+
+    If the results of multiple times are not merged, the times are the first
+    axis. The file is filled slice by slice through memory-mapped regions,
+    so the full matrix is never held in memory. Unreachable targets are NaN
+    (float32) resp. -1 (int32).
+
+    For the parameters see BinaryWriter
+    '''
+    # max. size of a mapped region in bytes, a single mapping is limited to
+    # 2 GB (Integer.MAX_VALUE), larger slices are mapped row chunk by chunk
+    MAP_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, target, oid, did, dtype='float32', arrive_by=False,
+                 shard=None):
+        super(MatrixWriter, self).__init__(target, oid, did, dtype=dtype,
+                                           arrive_by=arrive_by, shard=shard)
+        self.file = None
+
+    def open(self, origins, destinations, times, merged=False):
+        if os.path.exists(self.target):
+            os.remove(self.target)
+        self.resume(origins, destinations, times, merged=merged)
+
+    def resume(self, origins, destinations, times, merged=False, state={}):
+        '''
+        map the existing file, the slices written before are kept, the ones
+        written after the state was taken are overwritten when evaluated
+        again
+        '''
+        super(MatrixWriter, self).open(origins, destinations, times,
+                                       merged=merged)
+        axes = list(self.axes)
+        shape = [self.n_rows, self.n_cols]
+        if not merged and len(times) > 1:
+            axes.insert(0, 'time')
+            shape.insert(0, len(times))
+
+        header = npy_header(self.descr, shape)
+        self.offset = len(header)
+        n_items = 1
+        for n in shape:
+            n_items *= n
+        self.file = RandomAccessFile(self.target, 'rw')
+        # the file is created sparse, the slices are mapped into it later on
+        self.file.setLength(self.offset + n_items * self.item_size)
+        self.file.writeBytes(header)
+
+        unreachable = 'NaN' if self.dtype == 'float32' else -1
+        self.write_meta(format='dense', shape=shape, axes=axes,
+                        unreachable=unreachable)
+
+    def write(self, result_sets, append=True, additional_columns={},
+              from_index=0, time_index=0):
+        '''
+        write result sets into the rows of the matrix starting at from_index
+        '''
+        if len(result_sets) == 0:
+            return
+        n_cols = self.n_cols
+        row_bytes = n_cols * self.item_size
+        position = (self.offset +
+                    (time_index * self.n_rows + from_index) * row_bytes)
+        rows_per_chunk = max(1, self.MAP_BYTES // row_bytes)
+        channel = self.file.getChannel()
+        is_float = self.dtype == 'float32'
+        unreachable = NAN if is_float else -1
+        convert = float if is_float else int
+
+        for start in xrange(0, len(result_sets), rows_per_chunk):
+            chunk = result_sets[start:start + rows_per_chunk]
+            buffer = channel.map(FileChannel.MapMode.READ_WRITE,
+                                 position + start * row_bytes,
+                                 len(chunk) * row_bytes)
+            buffer.order(ByteOrder.LITTLE_ENDIAN)
+            put = buffer.putFloat if is_float else buffer.putInt
+            for result_set in chunk:
                 if result_set is None:
+                    for j in xrange(n_cols):
+                        put(unreachable)
                     continue
+                for result in result_set.getResults():
+                    if result is None:
+                        put(unreachable)
+                    else:
+                        put(convert(result.getTime()))
+            buffer.force()
+            buffer = None
+        print 'results written to "{}"'.format(self.target)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SparseWriter(BinaryWriter):
+    '''
+    writes the travel times (in seconds) of the reachable pairs only, as
+    compressed sparse row matrix (CSR) to a numpy archive (.npz) that can be
+    loaded with scipy.sparse.load_npz(target)
+
+    the column indices, travel times and row pointers are appended to
+    temporary files slice by slice, the archive is assembled when closing,
+    so storage and writing time scale with the number of reachable pairs.
+    If the results of multiple times are not merged, the rows of all times
+    are stacked (row = time index * number of sources + source index).
+
+    For the parameters see BinaryWriter
+    '''
+    # number of row pointers read at once when assembling the archive
+    CHUNK_ROWS = 65536
+
+    def open(self, origins, destinations, times, merged=False):
+        if os.path.exists(self.target):
+            os.remove(self.target)
+        # parts of an interrupted evaluation
+        if os.path.exists(self.target + '.parts'):
+            shutil.rmtree(self.target + '.parts')
+        self.resume(origins, destinations, times, merged=merged)
+
+    def resume(self, origins, destinations, times, merged=False, state={}):
+        super(SparseWriter, self).open(origins, destinations, times,
+                                       merged=merged)
+        n_times = 1 if merged else len(times)
+        # the parts are kept next to the target until closing
+        self.tmp_dir = self.target + '.parts'
+        if not os.path.exists(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        sizes = state.get('parts', [])
+        # one part per time, the slices of each part are written in order
+        self.parts = []
+        for t in range(n_times):
+            # number of row pointers and pairs written (the pointers are the
+            # number of pairs up to each row, starting with 0)
+            rows, nnz = sizes[t] if t < len(sizes) else (0, 0)
+            part = {
+                'indices': os.path.join(self.tmp_dir, 'indices_{}'.format(t)),
+                'data': os.path.join(self.tmp_dir, 'data_{}'.format(t)),
+                'indptr': os.path.join(self.tmp_dir, 'indptr_{}'.format(t)),
+                'rows': rows,
+                'nnz': nnz
+            }
+            # discard the pairs written after the state was taken
+            for filename, size in [(part['indices'], nnz * 4),
+                                   (part['data'], nnz * self.item_size),
+                                   (part['indptr'], rows * 8)]:
+                with open(filename, 'ab') as f:
+                    pass
+                with open(filename, 'r+b') as f:
+                    f.truncate(size)
+            if rows == 0:
+                with open(part['indptr'], 'ab') as f:
+                    f.write(struct.pack('<q', 0))
+                part['rows'] = 1
+            self.parts.append(part)
+
+    def checkpoint(self):
+        '''
+        the row pointers stay on disk, only the sizes of the parts are
+        returned (number of row pointers and pairs per part)
+        '''
+        return {'parts': [[p['rows'], p['nnz']] for p in self.parts]}
+
+    def write(self, result_sets, append=True, additional_columns={},
+              from_index=0, time_index=0):
+        '''
+        append the reachable pairs of the result sets to the rows starting
+        at from_index
+        '''
+        part = self.parts[0 if self.merged else time_index]
+        if from_index < part['rows'] - 1:
+            raise ValueError('slices have to be written in order of the sources')
+        nnz = part['nnz']
+        # pointers of the written rows, sources skipped (evaluated by other
+        # shards) have no pairs
+        indptr = [nnz] * (from_index - part['rows'] + 1)
+        convert = float if self.dtype == 'float32' else int
+        value_format = self.descr[1]
+        with open(part['indices'], 'ab') as f_indices, \
+             open(part['data'], 'ab') as f_data:
+            for result_set in result_sets:
+                if result_set is not None:
+                    indices = []
+                    values = []
+                    for j, result in enumerate(result_set.getResults()):
+                        if result is None:
+                            continue
+                        indices.append(j)
+                        values.append(convert(result.getTime()))
+                    n = len(indices)
+                    if n:
+                        f_indices.write(struct.pack('<{}i'.format(n), *indices))
+                        f_data.write(struct.pack(
+                            '<{}{}'.format(n, value_format), *values))
+                        nnz += n
+                indptr.append(nnz)
+        with open(part['indptr'], 'ab') as f_indptr:
+            f_indptr.write(struct.pack('<{}q'.format(len(indptr)), *indptr))
+        part['rows'] += len(indptr)
+        part['nnz'] = nnz
+        print 'results written to "{}"'.format(self.target)
+
+    def close(self):
+        if not self.parts:
+            return
+        nnz = sum(part['nnz'] for part in self.parts)
+        shape = (len(self.parts) * self.n_rows, self.n_cols)
+
+        zip_stream = ZipOutputStream(FileOutputStream(self.target))
+        try:
+            def write(content):
+                zip_stream.write(String(content).getBytes('ISO-8859-1'))
+
+            def add(name, header, files=[], content=''):
+                zip_stream.putNextEntry(ZipEntry(name + '.npy'))
+                write(header + content)
+                for filename in files:
+                    if os.path.exists(filename):
+                        Files.copy(Paths.get(filename), zip_stream)
+                zip_stream.closeEntry()
+
+            add('format', npy_strings(['csr']))
+            add('shape', npy_header('<i8', (2, )),
+                content=struct.pack('<2q', *shape))
+            # stack the row pointers of the parts of all times, streamed
+            # from the files in chunks
+            zip_stream.putNextEntry(ZipEntry('indptr.npy'))
+            write(npy_header('<i8', (shape[0] + 1, )) + struct.pack('<q', 0))
+            offset = 0
+            for part in self.parts:
+                with open(part['indptr'], 'rb') as f:
+                    # the leading 0 of the part is already written
+                    f.seek(8)
+                    while True:
+                        chunk = f.read(self.CHUNK_ROWS * 8)
+                        if not chunk:
+                            break
+                        rows = struct.unpack('<{}q'.format(len(chunk) // 8),
+                                             chunk)
+                        write(struct.pack('<{}q'.format(len(rows)),
+                                          *[r + offset for r in rows]))
+                # sources that were not evaluated have no pairs
+                n_missing = self.n_rows + 1 - part['rows']
+                offset += part['nnz']
+                for start in xrange(0, n_missing, self.CHUNK_ROWS):
+                    n = min(self.CHUNK_ROWS, n_missing - start)
+                    write(struct.pack('<{}q'.format(n), *([offset] * n)))
+            zip_stream.closeEntry()
+            add('indices', npy_header('<i4', (nnz, )),
+                files=[p['indices'] for p in self.parts])
+            add('data', npy_header(self.descr, (nnz, )),
+                files=[p['data'] for p in self.parts])
+        finally:
+            zip_stream.close()
+            shutil.rmtree(self.tmp_dir)
+        self.parts = []
+
+        # rows of the times are stacked
+        self.write_meta(format='csr', shape=list(shape), axes=self.axes,
+                        rows_per_time=self.n_rows, nnz=nnz)
+        print '{} reachable pairs written to "{}"'.format(nnz, self.target)
+
+
+class ArrowWriter(ResultWriter):
+    '''
+    writes the results with the same columns as the CSVWriter but typed, as
+    table in Arrow IPC file format (Feather V2) that can be loaded without
+    parsing (e.g. pandas.read_feather(target))
+
+    the ids of the origins and destinations are dictionary-encoded, every
+    written slice of sources (and time, if not merged) is appended as one
+    record batch. The times of the details are stored as timestamps (in
+    seconds, without timezone), missing values as nulls.
+
+    For the parameters see CSVWriter
+    '''
+    ORIGIN_IDS, DESTINATION_IDS = 0, 1
+
+    def __init__(self, target, oid, did, mode, field,
+                 params, bestof=None, arrive_by=False,
+                 write_dest_data=False, calculate_details=False):
+        self.oid = oid
+        self.did = did
+        self.target = target
+        self.arrive_by = arrive_by
+        self.write_dest_data = write_dest_data
+        self.bestof = bestof
+        self.mode = mode
+        self.field = field
+        self.params = params
+        self.calculate_details = calculate_details
+        self.writer = None
+        self.columns = None
+        self.accumulation = None
+
+    def open(self, origins, destinations, times, merged=False):
+        '''
+        collect the ids of the origins and destinations, the file is created
+        with the first results (the additional columns are not known before)
+        '''
+        self.close()
+        self.columns = None
+        origin_ids = [o.getStringData(self.oid) for o in origins]
+        destination_ids = [d.getStringData(self.did) for d in destinations]
+        self.origin_dictionary, self.origin_index = dictionary_encode(
+            origin_ids)
+        self.destination_dictionary, self.destination_index = \
+            dictionary_encode(destination_ids)
+        # ids of the targets in order of their population, the values are
+        # accumulated onto
+        self.target_ids = origin_ids if self.arrive_by else destination_ids
+        self.data_fields = [f for f in destinations.getDataFields()
+                            if f != self.did]
+        # the accumulated values are written once after all slices (close())
+        self.accumulation = None
+        if self.mode in ACCUMULATION_MODES:
+            self.accumulation = Accumulation(self.mode, self.field,
+                                             self.params)
+
+    def resume(self, origins, destinations, times, merged=False, state={}):
+        self.open(origins, destinations, times, merged=merged)
+        if state.get('file') is not None:
+            additional_columns = OrderedDict(
+                (name, None) for name in state['additional_columns'])
+            self.create(additional_columns, resume=state['file'])
+        if self.accumulation is not None:
+            self.accumulation.restore(state.get('accumulated'))
+
+    def checkpoint(self):
+        state = {}
+        if self.writer is not None:
+            state = {'additional_columns': self.additional_columns,
+                     'file': self.writer.state()}
+        if self.accumulation is not None:
+            state['accumulated'] = self.accumulation.state()
+        return state
+
+    def create(self, additional_columns={}, resume=None):
+        '''
+        create the target file with the columns of the results (continue it
+        from the given state of the file, if resumed)
+        '''
+        self.additional_columns = []
+        if self.accumulation is not None and not self.arrive_by:
+            # accumulated onto the destinations
+            columns = [Column('destination id', 'utf8',
+                              dictionary=self.DESTINATION_IDS)]
+        else:
+            columns = [Column('origin id', 'utf8',
+                              dictionary=self.ORIGIN_IDS)]
+        if not self.mode:
+            columns += [
+                Column('destination id', 'utf8',
+                       dictionary=self.DESTINATION_IDS),
+                Column('travel time (sec)', 'int64')]
+            self.additional_columns = list(additional_columns.keys())
+            columns += [Column(name, 'utf8')
+                        for name in self.additional_columns]
+            if self.calculate_details:
+                columns += [Column(name, dtype)
+                            for name, getter, dtype in RESULT_DETAILS]
+            if self.write_dest_data:
+                columns += [Column('destination_' + field, 'utf8')
+                            for field in self.data_fields]
+        else:
+            param_sets = split_params(self.mode, self.params)
+            columns += [Column(name, 'float64') for name in
+                        mode_columns(self.field, self.mode, param_sets)]
+        self.columns = columns
+        # the data of the destinations is taken from the results only if
+        # they lead to the destinations
+        self.extractor = ResultExtractor(
+            self.oid if self.arrive_by else self.did,
+            calculate_details=self.calculate_details,
+            data_fields=self.data_fields if (self.write_dest_data and
+                                             not self.arrive_by) else [],
+            timestamps=True)
+        self.writer = ArrowFileWriter(self.target, columns, dictionaries={
+            self.ORIGIN_IDS: self.origin_dictionary,
+            self.DESTINATION_IDS: self.destination_dictionary
+        }, resume=resume)
+
+    def write(self, result_sets, append=True, additional_columns={},
+              from_index=0, time_index=0):
+        '''
+        append the result sets as record batch, may aggregate/accumulate
+        before writing results
+
+        Parameters
+        ----------
+        result_sets: list of result_sets
+        append: optional, not used (all results are appended to the opened file)
+        additional_columns: optional, dict with column-names/values as key/value pairs
+        from_index: optional, not used (rows are identified by their ids)
+        time_index: optional, not used (see additional_columns)
+        '''
+        print 'post processing results...'
 
-                if do_accumulate:
-                    amount = result_set.getRoot().getFloatData(self.field)
-                    accumulator.accumulate(result_set, amount)
+        if len(result_sets) == 0:
+            return
+        if self.writer is None:
+            self.create(additional_columns)
+        rows = [[] for c in self.columns]
+        origin_col = rows[0]
+
+        if self.accumulation is not None:
+            self.accumulation.add(result_sets)
+            return
+
+        if self.mode in AGGREGATION_MODES.keys():
+            aggregators = [OtpsAggregate(self.mode, params) for params
+                           in split_params(self.mode, self.params)]
+            for result_set in result_sets:
+                if result_set is None:
                     continue
+                origin_id = result_set.getRoot().getStringData(self.oid)
+                origin_col.append(self.origin_index[origin_id])
+                for col, aggregator in zip(rows[1:], aggregators):
+                    col.append(aggregator.aggregate(result_set, self.field))
 
+        else:
+            dest_col = rows[1]
+            # the additional columns are fixed with the first results
+            additional = []
+            for name in self.additional_columns:
+                value = additional_columns.get(name)
+                additional.append(None if value is None else unicode(value))
+
+            for result_set in result_sets:
+                if result_set is None:
+                    continue
                 if self.arrive_by:
                     destination = result_set.getRoot()
-                    dest_id = destination.getStringData(self.did)
+                    dest_index = self.destination_index[
+                        destination.getStringData(self.did)]
                 else:
-                    origin_id = result_set.getRoot().getStringData(self.oid)
+                    origin_index = self.origin_index[
+                        result_set.getRoot().getStringData(self.oid)]
 
-                if do_aggregate:
-                    aggregator = OtpsAggregate(self.mode, self.params)
-                    aggregated = aggregator.aggregate(result_set, self.field)
-                    # origin_id is known here, because !arriveby when aggregating
-                    writer.writerow([origin_id, aggregated])
+                if self.bestof is not None:
+                    results = result_set.getBestResults(self.bestof)
+                else:
+                    results = result_set.getResults()
 
+                ids, columns = self.extractor.extract(results)
+                n = len(ids)
+                if n == 0:
+                    continue
+                if self.arrive_by:
+                    origin_col.extend([self.origin_index[i] for i in ids])
+                    dest_col.extend([dest_index] * n)
                 else:
-                    if self.bestof is not None:
-                        results = result_set.getBestResults(self.bestof)
-                    else:
-                        results = result_set.getResults();
+                    origin_col.extend([origin_index] * n)
+                    dest_col.extend([self.destination_index[i] for i in ids])
+                values = columns.values()
+                values[1:1] = [[value] * n for value in additional]
+                if self.write_dest_data and self.arrive_by:
+                    # all results lead to the root
+                    for field in self.data_fields:
+                        values.append([destination.getStringData(field)] * n)
+                for col, column_values in zip(rows[2:], values):
+                    col.extend(column_values)
 
-                    for result in results:
+        if origin_col:
+            self.writer.write_batch(rows)
+        print 'results written to "{}"'.format(self.target)
 
-                        if result is None: #unreachable
-                            continue
+    def write_accumulated(self):
+        '''
+        append a record batch with the values accumulated over all slices,
+        one row per target
+        '''
+        rows = [[] for c in self.columns]
+        index = (self.origin_index if self.arrive_by
+                 else self.destination_index)
+        for j, values in self.accumulation.rows():
+            rows[0].append(index[self.target_ids[j]])
+            for col, value in zip(rows[1:], values):
+                col.append(value)
+        self.accumulation = None
+        if rows[0]:
+            self.writer.write_batch(rows)
+            print 'accumulated results of {} target(s) written to "{}"'.format(
+                len(rows[0]), self.target)
 
-                        if self.arrive_by:
-                            origin_id = result.getIndividual().getStringData(self.oid)
-                        else:
-                            destination = result.getIndividual()
-                            dest_id = destination.getStringData(self.did)
-
-                        row = [origin_id,
-                               dest_id,
-                               result.getTime()]
-                        if additional_columns:
-                            row += additional_columns.values()
-                        if self.calculate_details:
-                            details = [result.getBoardings(),
-                                       result.getWalkDistance(),
-                                       result.getStartTime(OUTPUT_DATE_FORMAT),
-                                       result.getArrivalTime(OUTPUT_DATE_FORMAT),
-                                       result.getStartTransit(OUTPUT_DATE_FORMAT),
-                                       result.getArrivalTransit(OUTPUT_DATE_FORMAT),
-                                       result.getDistance(),
-                                       result.getTransitTime(),
-                                       result.getModes(),
-                                       result.getWaitingTime(),
-                                       result.getElevationGained(),
-                                       result.getElevationLost()]
-                            row += details
-
-                        if self.write_dest_data:
-                            for field in data_fields:
-                                row.append(destination.getStringData(field))
-
-                        writer.writerow(row)
-
-            if do_accumulate:
-                results = accumulator.getResults()
-                for i, individual in enumerate(result_sets[0].getPopulation()):
-                    origin_id = individual.getStringData(self.oid)
-                    writer.writerow([origin_id, results[i]])
+    def close(self):
+        '''
+        write the accumulated results (if accumulating) and the footer of
+        the target file and close it
+        '''
+        if self.columns is None and hasattr(self, 'origin_index'):
+            # no results at all, the file has a schema anyway
+            self.create()
+        if self.accumulation is not None:
+            self.write_accumulated()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
-        print 'results written to "{}"'.format(self.target_csv)
+
+class StatisticsWriter(CSVWriter):
+    '''
+    writes statistics of the travel times of every pair over all evaluated
+    times instead of the results of each time, one row per pair reachable
+    at least once (see TravelTimeStatistics)
+
+    the travel times of the times are reduced slice by slice, only the
+    accumulators of the pairs of the current slice are held in memory
+
+    Parameters
+    ----------
+    target_csv: filename of the file to write to
+    oid: name of the field of the origin ids
+    did: name of the field of the destination ids
+    max_time: optional, maximum travel time in seconds
+    percentiles: optional, percentiles of the travel times to write (0 - 100)
+    thresholds: optional, travel times in seconds, the shares of the times with travel times within them are written
+    arrive_by: optional, True if the sources are the destinations
+    '''
+    reduces_times = True
+
+    def __init__(self, target_csv, oid, did, max_time=None,
+                 percentiles=[10, 50, 90], thresholds=[], arrive_by=False):
+        super(StatisticsWriter, self).__init__(target_csv, oid, did, None,
+                                               None, None,
+                                               arrive_by=arrive_by)
+        self.max_time = max_time
+        self.percentiles = percentiles
+        self.thresholds = thresholds
+        self.pair_bytes = TravelTimeStatistics.pair_bytes(thresholds,
+                                                          max_time)
+        self.statistics = None
+
+    def open(self, origins=None, destinations=None, times=None, merged=False):
+        super(StatisticsWriter, self).open()
+        self.collect_ids(origins, destinations)
+
+    def resume(self, origins=None, destinations=None, times=None,
+               merged=False, state={}):
+        super(StatisticsWriter, self).resume(state=state)
+        self.collect_ids(origins, destinations)
+
+    def collect_ids(self, origins, destinations):
+        origin_ids = [o.getStringData(self.oid) for o in origins]
+        destination_ids = [d.getStringData(self.did) for d in destinations]
+        if self.arrive_by:
+            self.source_ids, self.target_ids = destination_ids, origin_ids
+        else:
+            self.source_ids, self.target_ids = origin_ids, destination_ids
+        self.statistics = None
+
+    def write(self, result_sets, append=True, additional_columns={},
+              from_index=0, time_index=0):
+        '''
+        add the result sets of a time to the statistics of the slice of
+        sources starting at from_index
+        '''
+        if self.statistics is None:
+            self.statistics = TravelTimeStatistics(
+                len(result_sets), len(self.target_ids),
+                max_time=self.max_time, percentiles=self.percentiles,
+                thresholds=self.thresholds)
+        self.statistics.add(
+            None if result_set is None else
+            [None if result is None else result.getTime()
+             for result in result_set.getResults()]
+            for result_set in result_sets)
+
+    def finish_slice(self, from_index=0):
+        '''
+        write the statistics of the pairs of the slice
+        '''
+        statistics = self.statistics
+        self.statistics = None
+        if statistics is None:
+            return
+        if self.file is None:
+            super(StatisticsWriter, self).open()
+        if not self.header_written:
+            self.writer.writerow(
+                ['origin id', 'destination id'] +
+                TravelTimeStatistics.columns(self.percentiles,
+                                             self.thresholds))
+            self.header_written = True
+        n_rows = 0
+        for i, j, values in statistics.pairs():
+            source_id = self.source_ids[from_index + i]
+            target_id = self.target_ids[j]
+            if self.arrive_by:
+                self.writer.writerow([target_id, source_id] + values)
+            else:
+                self.writer.writerow([source_id, target_id] + values)
+            n_rows += 1
+        print 'statistics of {} pair(s) written to "{}"'.format(
+            n_rows, self.target_csv)
+
+
+class SliceSizer(object):
+    '''
+    determines how many sources are evaluated at once in OTPEvaluation.evaluate
+
+    the initial size is estimated from the free heap of the JVM and the
+    memory the results of a single source are expected to take (depending
+    on the number of targets, details and parallel times). After each slice
+    the size is adapted to the measured memory usage and duration: slices
+    using too much of the heap shrink, slices finishing quickly grow.
+
+    Parameters
+    ----------
+    n_sources: number of sources (origins resp. destinations if arrive by)
+    n_targets: number of targets each source is routed to
+    n_threads: optional, number of threads evaluating a slice
+    n_parallel: optional, number of times evaluated at once
+    calculate_details: optional, if True the results carry itinerary details
+    write_dest_data: optional, if True the data of the destinations is written
+    merged: optional, if True the merged results of the previous times are held in addition
+    pair_bytes: optional, memory held per pair in addition to the results (e.g. by the writer)
+    split: optional, fixed size of the slices, disables the adaption
+    '''
+    # slices finishing faster than this (in seconds) are enlarged
+    MIN_SECONDS = 30
+    MIN_SIZE = 10
+    MAX_SIZE = 50000
+
+    def __init__(self, n_sources, n_targets, n_threads=1, n_parallel=1,
+                 calculate_details=False, write_dest_data=False, merged=False,
+                 pair_bytes=0, split=None):
+        self.n_sources = n_sources
+        self.n_parallel = n_parallel
+        self.adaptive = split is None
+        result_bytes = RESULT_BYTES
+        if calculate_details:
+            result_bytes += RESULT_DETAILS_BYTES
+        if write_dest_data:
+            result_bytes += RESULT_DEST_DATA_BYTES
+        # memory needed by the results of a single source
+        n_held = held_result_sets(n_parallel, merged)
+        self.source_bytes = max(n_targets, 1) * (result_bytes * n_held +
+                                                 pair_bytes)
+        # keep all threads busy
+        self.min_size = max(self.MIN_SIZE, n_threads * 2)
+        if split is not None:
+            self.split = split
+        else:
+            self.split = self.clamp(self.heap_budget() / self.source_bytes)
+            print 'evaluating {} source(s) at once (estimated from {} MB available heap)'.format(
+                self.split, self.heap_budget() / (1024 * 1024))
+        self.start_time = None
+        self.used_before = 0
+        self.peak = 0
+
+    def used(self):
+        runtime = Runtime.getRuntime()
+        return runtime.totalMemory() - runtime.freeMemory()
+
+    def heap_budget(self):
+        '''
+        bytes of the heap that may be used by the results of a slice
+        '''
+        runtime = Runtime.getRuntime()
+        free = runtime.maxMemory() - self.used()
+        return long(free * HEAP_FRACTION)
+
+    def clamp(self, size):
+        size = max(self.min_size, min(self.MAX_SIZE, int(size)))
+        return min(size, max(self.n_sources, 1))
+
+    def size(self):
+        return self.split
+
+    def start(self):
+        '''
+        call before evaluating a slice
+        '''
+        self.start_time = time.time()
+        self.used_before = self.used()
+        self.peak = self.used_before
+
+    def sample(self):
+        '''
+        call whenever results of the current slice are held in memory
+        '''
+        self.peak = max(self.peak, self.used())
+
+    def finish(self, size):
+        '''
+        call after a slice of given size was evaluated and written,
+        adapts the size of the next slices
+        '''
+        if not self.adaptive or size <= 0:
+            return
+        seconds = time.time() - self.start_time
+        measured = float(self.peak - self.used_before) / size
+        # measurements are distorted by the garbage collector, only trust
+        # them if they are not far below the estimation
+        if measured > self.source_bytes * 0.5:
+            self.source_bytes = (self.source_bytes + measured) / 2
+        by_memory = self.heap_budget() / self.source_bytes
+        new_split = self.split
+        if new_split > by_memory:
+            new_split = by_memory
+        elif seconds < self.MIN_SECONDS:
+            new_split = min(self.split * 2, by_memory)
+        new_split = self.clamp(new_split)
+        if new_split != self.split:
+            print 'part took {:.1f}s and ~{} MB heap, evaluating {} source(s) at once from now on'.format(
+                seconds, (self.peak - self.used_before) / (1024 * 1024), new_split)
+        self.split = new_split
+
+
+def merge_result_sets(merged, result_sets):
+    '''
+    merge the result sets of a time into the merged result sets of the
+    previous times (in place, both in order of the sources), the best
+    connection to each target is kept
+
+    returns the merged result sets, the given result sets if there are no
+    merged ones yet
+    '''
+    if merged is None:
+        return list(result_sets)
+    for i, result_set in enumerate(result_sets):
+        if result_set is None:
+            continue
+        if merged[i] is None:
+            merged[i] = result_set
+        else:
+            merged[i].merge(result_set)
+    return merged
+
+
+def result_signatures(result_sets):
+    '''
+    return a digest per result set of the connections its results use: the
+    times of boarding the first and alighting the last transit vehicle
+    (None for missing result sets and ones with results not using transit,
+    see smart_search.signature)
+
+    equal digests of the same sources at two departure times mean that the
+    same connections are taken at both times
+    '''
+    signatures = []
+    for result_set in result_sets:
+        if result_set is None:
+            signatures.append(None)
+            continue
+        parts = []
+        for result in result_set.getResults():
+            if result is None:
+                parts.append(UNREACHABLE)
+                continue
+            start = result.getStartTransit(OUTPUT_DATE_FORMAT)
+            if not start:
+                parts.append(NO_TRANSIT)
+                continue
+            parts.append(start + '/' +
+                         result.getArrivalTransit(OUTPUT_DATE_FORMAT))
+        signatures.append(signature(parts))
+    return signatures
+
+
+def reset_heap_peak():
+    '''
+    reset the peak usage of the heap, the server evaluates several jobs in
+    the same JVM
+    '''
+    for pool in ManagementFactory.getMemoryPoolMXBeans():
+        if pool.getType() == MemoryType.HEAP:
+            pool.resetPeakUsage()
+
+
+def heap_peak():
+    '''
+    return the peak usage of the heap since the last reset in MB (sum of the
+    peaks of the memory pools of the heap, the pools may peak at different
+    times, so this is an upper bound)
+    '''
+    peak = 0
+    for pool in ManagementFactory.getMemoryPoolMXBeans():
+        if pool.getType() == MemoryType.HEAP:
+            peak += pool.getPeakUsage().getUsed()
+    return int(peak / (1024 * 1024))
+
+
+def creates_populations():
+    '''
+    return True if the OTP build allows to create populations from scripts
+    (a public constructor OtpsIndividual(lat, lon, data, population) and
+    OtpsPopulation.addIndividual), older builds only load them from csv
+    '''
+    api = 'org.opentripplanner.scripting.api.'
+    try:
+        individual = Class.forName(api + 'OtpsIndividual')
+        population = Class.forName(api + 'OtpsPopulation')
+    except ClassNotFoundException:
+        return False
+    has_constructor = any(len(c.getParameterTypes()) == 4
+                          for c in individual.getConstructors())
+    has_add = any(m.getName() == 'addIndividual'
+                  for m in population.getMethods())
+    return has_constructor and has_add
+
+
+class ProgressReporter(object):
+    '''
+    writes machine-readable progress events to stdout, one line per event:
+    PROGRESS_MARKER followed by the event as compact json with the sources
+    of the slice, the index of the time, the pairs of sources and times done
+    and in total, the elapsed seconds, the rate (pairs per second) and the
+    peak usage of the heap in MB
+
+    the peak usage of the heap is measured from the creation of the reporter
+    on
+
+    Parameters
+    ----------
+    total: number of pairs of sources and times to evaluate
+    done: optional, number of pairs evaluated before (resumed evaluation)
+    '''
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.initial = done
+        self.start_time = time.time()
+        reset_heap_peak()
+
+    def add(self, n, from_index, to_index, time_index):
+        '''
+        report that n pairs of sources and times were evaluated
+        '''
+        self.done += n
+        self.report([from_index, to_index], time_index)
+
+    def finish(self):
+        '''
+        report the end of the evaluation (after the results are written)
+        '''
+        self.report(None, None)
+        print 'peak heap usage: {} MB'.format(heap_peak())
+
+    def report(self, sources, time_index):
+        elapsed = time.time() - self.start_time
+        rate = (self.done - self.initial) / elapsed if elapsed > 0 else 0
+        event = OrderedDict([
+            ('sources', sources),
+            ('time', time_index),
+            ('done', self.done),
+            ('total', self.total),
+            ('elapsed', round(elapsed, 1)),
+            ('rate', round(rate, 2)),
+            ('heap_peak_mb', heap_peak())
+        ])
+        print PROGRESS_MARKER + json.dumps(event, separators=(',', ':'))
+        sys.stdout.flush()
+
+
+class Checkpoint(object):
+    '''
+    manifest of the progress of an evaluation, committed after each finished
+    unit (slice of sources and time) together with the state of the writer,
+    so that an interrupted evaluation can be resumed
+
+    Parameters
+    ----------
+    filename: file the manifest is written to
+    job: json serializable description of the job, a manifest is only
+         resumed for the same job
+    resume: optional, if True the state of the existing manifest is loaded
+    '''
+    def __init__(self, filename, job, resume=False):
+        self.filename = filename
+        self.job = job
+        self.state = None
+        if resume and os.path.exists(filename):
+            with open(filename) as f:
+                manifest = json.load(f)
+            if manifest.get('job') == json.loads(json.dumps(job)):
+                self.state = manifest
+            else:
+                print 'checkpoint "{}" belongs to another job, starting from scratch'.format(
+                    filename)
+
+    def commit(self, from_index, to_index, times_done, writer_state):
+        '''
+        commit the progress, the sources before from_index are finished, of
+        the sources from_index to to_index (if not None) the times with the
+        indices times_done are finished
+        '''
+        manifest = OrderedDict([
+            ('job', self.job),
+            ('from_index', from_index),
+            ('to_index', to_index),
+            ('times_done', list(times_done)),
+            ('writer', writer_state)
+        ])
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(manifest, f)
+        # replace the previous manifest at once
+        Files.move(Paths.get(tmp_filename), Paths.get(self.filename),
+                   StandardCopyOption.REPLACE_EXISTING,
+                   StandardCopyOption.ATOMIC_MOVE)
+
+    def remove(self):
+        '''
+        remove the manifest (evaluation finished)
+        '''
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class JobCanceled(Exception):
+    '''
+    raised by OTPEvaluation.evaluate if the job was canceled
+    '''
+
+
+class TimeEvaluation(Callable):
+    '''
+    task evaluating a request of an OTPEvaluation with a batch processor
+    at a single time, to be run in a java thread pool
+    '''
+    def __init__(self, evaluation, request, batch_processor, date_time,
+                 max_time):
+        self.evaluation = evaluation
+        self.request = request
+        self.batch_processor = batch_processor
+        self.date_time = date_time
+        self.max_time = max_time
+
+    def call(self):
+        return self.evaluation.evaluate_time(
+            self.request, self.date_time, self.max_time,
+            batch_processor=self.batch_processor)
 
 
 class OTPEvaluation(object):
@@ -198,24 +1621,41 @@ class OTPEvaluation(object):
     '''
     def __init__(self, graph_path, router, print_every_n_lines=50, calculate_details=False, smart_search=False):
         self.otp = OtpsEntryPoint.fromArgs([ "--graphs", graph_path, "--router", router])
-        router = self.otp.getRouter()
-        self.batch_processor = self.otp.createBatchProcessor(router)
-        self.request = self.otp.createBatchRequest()
-        self.request.setEvalItineraries(calculate_details)
+        self.router = self.otp.getRouter()
+        self.batch_processor = self.otp.createBatchProcessor(self.router)
+        self.reset(print_every_n_lines=print_every_n_lines,
+                   calculate_details=calculate_details,
+                   smart_search=smart_search)
+
+    def reset(self, print_every_n_lines=50, calculate_details=False, smart_search=False):
+        '''
+        discard the current routing request and create a new one,
+        the loaded graph and the batch processor are kept
+        '''
         # smart search needs details (esp. start/arrival times),
         # even if not wanted explicitly
         if smart_search:
             calculate_details = True
+        self.request = self.otp.createBatchRequest()
+        self.request.setEvalItineraries(calculate_details)
+        self.eval_itineraries = calculate_details
+        self.settings = {}
+        self.n_threads = 1
+        self.n_parallel_times = 1
         self.calculate_details = calculate_details
         self.smart_search = smart_search
         self.arrive_by = False
         self.print_every_n_lines = print_every_n_lines
+        # function returning True if the job was canceled, checked between
+        # the slices and times (set by the OTPServer)
+        self.canceled = None
 
     def setup(self,
               date_time=None, max_walk=None, walk_speed=None,
               bike_speed=None, clamp_wait=None, banned='', modes=None,
               arrive_by=False, max_transfers=None, max_pre_transit_time=None,
-              wheel_chair_accessible=False, max_slope=None, n_threads=None):
+              wheel_chair_accessible=False, max_slope=None, n_threads=None,
+              n_parallel_times=1):
         '''
         sets up the routing request
 
@@ -234,39 +1674,232 @@ class OTPEvaluation(object):
         wheel_chair_accessible: optional, if True, the trip must be wheelchair accessible (defaults to False)
         max_slope: optional, maximum slope of streets for wheelchair trips
         n_threads: optional, number of threads to be used in evaluation
+        n_parallel_times: optional, number of times of a time batch to evaluate at once, the threads are split between them (defaults to 1)
         '''
 
         if date_time is not None:
             self.request.setDateTime(date_time.year, date_time.month, date_time.day, date_time.hour, date_time.minute, date_time.second)
 
-        self.request.setArriveBy(arrive_by)
         self.arrive_by = arrive_by
-        self.request.setWheelchairAccessible(wheel_chair_accessible)
+        self.n_threads = n_threads or 1
+        self.n_parallel_times = max(n_parallel_times or 1, 1)
+        # keep the settings to set up copies of the request when evaluating
+        # multiple times in parallel
+        self.settings = dict(
+            max_walk=max_walk, walk_speed=walk_speed, bike_speed=bike_speed,
+            clamp_wait=clamp_wait, banned=banned, modes=modes,
+            arrive_by=arrive_by, max_transfers=max_transfers,
+            max_pre_transit_time=max_pre_transit_time,
+            wheel_chair_accessible=wheel_chair_accessible,
+            max_slope=max_slope)
+        self.configure(self.request, n_threads=n_threads, **self.settings)
+
+    def configure(self, request,
+                  max_walk=None, walk_speed=None,
+                  bike_speed=None, clamp_wait=None, banned='', modes=None,
+                  arrive_by=False, max_transfers=None, max_pre_transit_time=None,
+                  wheel_chair_accessible=False, max_slope=None, n_threads=None):
+        '''
+        apply the routing options to the given request (for the parameters see setup())
+        '''
+        request.setArriveBy(arrive_by)
+        request.setWheelchairAccessible(wheel_chair_accessible)
         if n_threads is not None:
-            self.request.setThreads(n_threads)
+            request.setThreads(n_threads)
         if max_walk is not None:
-            self.request.setMaxWalkDistance(max_walk)
+            request.setMaxWalkDistance(max_walk)
         if walk_speed is not None:
-            self.request.setWalkSpeedMs(walk_speed)
+            request.setWalkSpeedMs(walk_speed)
         if bike_speed is not None:
-            self.request.setBikeSpeedMs(bike_speed)
+            request.setBikeSpeedMs(bike_speed)
         if clamp_wait is not None:
-            self.request.setClampInitialWait(clamp_wait)
+            request.setClampInitialWait(clamp_wait)
         if banned:
-            self.request.setBannedRoutes(banned)
+            request.setBannedRoutes(banned)
         if max_slope is not None:
-            self.request.setMaxSlope(max_slope)
+            request.setMaxSlope(max_slope)
         if max_transfers is not None:
-            self.request.setMaxTransfers(max_transfers)
+            request.setMaxTransfers(max_transfers)
         if max_pre_transit_time is not None:
-            self.request.setMaxPreTransitTime(max_pre_transit_time)
+            request.setMaxPreTransitTime(max_pre_transit_time)
 
         if modes:
             if isinstance(modes, list):
                 modes = ','.join(modes)
-            self.request.setModes(modes)
+            request.setModes(modes)
+
+    def clone_request(self, n_threads):
+        '''
+        create a new request with the same routing options as the one set up,
+        using the given number of threads
+        '''
+        request = self.otp.createBatchRequest()
+        request.setEvalItineraries(self.eval_itineraries)
+        self.configure(request, n_threads=n_threads, **self.settings)
+        return request
+
+    def load_population(self, filename):
+        '''
+        load the points of the given file (csv or points file, see points.py)
+        as population
+        '''
+        if os.path.splitext(filename)[1].lower() != POINTS_EXTENSION:
+            return self.otp.loadCSVPopulation(filename, LATITUDE_COLUMN,
+                                              LONGITUDE_COLUMN)
+        fields, latitudes, longitudes, columns = read_points(filename)
+        if creates_populations():
+            from org.opentripplanner.scripting.api import OtpsIndividual
+            population = self.otp.createEmptyPopulation()
+            population.setHeaders(fields)
+            for i in xrange(len(latitudes)):
+                data = [values[i] for values in columns]
+                population.addIndividual(OtpsIndividual(
+                    latitudes[i], longitudes[i], data, population))
+            return population
+        # the OTP build does not allow to create populations from scripts,
+        # take the detour via csv
+        print 'populations can not be created directly, converting "{}" to csv'.format(
+            filename)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_filename = os.path.join(tmp_dir, 'points.csv')
+            with open(csv_filename, 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow([LATITUDE_COLUMN, LONGITUDE_COLUMN] +
+                                [field.encode('utf-8') for field in fields])
+                for i in xrange(len(latitudes)):
+                    writer.writerow([repr(latitudes[i]), repr(longitudes[i])] +
+                                    [values[i].encode('utf-8')
+                                     for values in columns])
+            return self.otp.loadCSVPopulation(csv_filename, LATITUDE_COLUMN,
+                                              LONGITUDE_COLUMN)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def evaluate_time(self, request, date_time, max_time,
+                      batch_processor=None):
+        '''
+        evaluate the given request at the given start/arrival time with the
+        given batch processor (the one of the evaluation if not given),
+        returns the result sets
+        '''
+        request.setDateTime(date_time.year, date_time.month, date_time.day, date_time.hour, date_time.minute, date_time.second)
+        # has to be set every time after setting datetime (and also AFTER setting arriveby)
+        request.setMaxTimeSec(max_time)
+
+        time_note = 'arrival time ' if self.arrive_by else 'start time '
+        msg = 'Starting evaluation of routes with ' + time_note + date_time.strftime(DATETIME_FORMAT)
+        print msg
+
+        return (batch_processor or self.batch_processor).evaluate(request)
+
+    def evaluate_times(self, times, max_time, origins, destinations,
+                       indices=None):
+        '''
+        evaluate the routes between the given origins and destinations at all
+        given times, yields the index of the time, the time and the result sets
+        in order of the given times
+
+        only the times with the given indices are evaluated, if indices are
+        given
+
+        if more than one parallel time is set up, the times are evaluated
+        concurrently on copies of the request, the set up threads are split
+        between them. Each concurrent time is evaluated by a batch processor
+        of its own (the batch processors are not meant to be shared between
+        threads, they only share the loaded graph of the router). The next
+        time is submitted as soon as the results of a time are taken, so
+        up to one result set more than times evaluated at once is held in
+        memory (see config.held_result_sets).
+        '''
+        if indices is None:
+            indices = range(len(times))
+        indices = list(indices)
+        n_parallel = min(self.n_parallel_times, len(indices), self.n_threads)
+        if n_parallel <= 1:
+            for t in indices:
+                yield t, times[t], self.evaluate_time(self.request, times[t],
+                                                      max_time)
+            return
+
+        threads_per_time = self.n_threads / n_parallel
+        print 'Evaluating {} times at once with {} thread(s) each'.format(
+            n_parallel, threads_per_time)
+        requests = []
+        processors = []
+        for i in range(n_parallel):
+            request = self.clone_request(threads_per_time)
+            request.setOrigins(origins)
+            request.setDestinations(destinations)
+            request.setLogProgress(self.print_every_n_lines)
+            requests.append(request)
+            processors.append(self.otp.createBatchProcessor(self.router))
+
+        pool = Executors.newFixedThreadPool(n_parallel)
+        futures = {}
+
+        def submit(i):
+            # a request and its processor are reused not before the time
+            # evaluated with them was taken from the futures
+            task = TimeEvaluation(self, requests[i % n_parallel],
+                                  processors[i % n_parallel],
+                                  times[indices[i]], max_time)
+            futures[i] = pool.submit(task)
+
+        try:
+            for i in range(n_parallel):
+                submit(i)
+            for i, t in enumerate(indices):
+                result_sets = futures.pop(i).get()
+                if i + n_parallel < len(indices):
+                    submit(i + n_parallel)
+                yield t, times[t], result_sets
+        finally:
+            pool.shutdownNow()
+
+    def smart_search_times(self, times, max_time, indices):
+        '''
+        profile search over the times with the given indices for results
+        merged over time, reusing the searches of earlier times: the step to
+        the next searched time grows as long as the connections found at
+        both ends of a step are the same, the times in between lead to the
+        same connections then and are skipped (their merged best results
+        equal the ones of the searched times). If the connections differ,
+        the step is shortened and searched again (see smart_search).
+
+        steps are only skipped if all results of the slice use transit,
+        results that are unreachable or walking/cycling only at both ends
+        might use transit in between
+
+        yields the index of the time, the time, the result sets and the
+        number of times the results stand for (the searched one and the
+        skipped ones before it), the numbers of searches and skipped times
+        are counted in n_searches resp. n_skipped
+        '''
+        self.n_searches = 0
+        self.n_skipped = 0
+
+        def search(i):
+            self.n_searches += 1
+            result_sets = self.evaluate_time(self.request, times[indices[i]],
+                                             max_time)
+            return result_sets, result_signatures(result_sets)
+
+        for pos, result_sets, n_times in smart_search(len(indices), search):
+            self.n_skipped += n_times - 1
+            yield indices[pos], times[indices[pos]], result_sets, n_times
 
-    def evaluate(self, times, max_time, origins_csv, destinations_csv, csv_writer, split=500, do_merge=False):
+    def check_canceled(self, csv_writer):
+        '''
+        close the writer and raise JobCanceled if the job was canceled,
+        the checkpoint is kept
+        '''
+        if self.canceled is None or not self.canceled():
+            return
+        csv_writer.close()
+        raise JobCanceled('evaluation canceled')
+
+    def evaluate(self, times, max_time, origins_csv, destinations_csv, csv_writer, split=None, do_merge=False, checkpoint=None, shard=None):
         '''
         evaluate the shortest paths between origins and destinations
         uses the routing options set in setup() (run it first!)
@@ -274,91 +1907,345 @@ class OTPEvaluation(object):
         Parameters
         ----------
         times: list of date times, the desired start/arrival times for evaluation
-        origins_csv: file with origin points
-        destinations_csv: file with destination points
+        origins_csv: file with origin points (csv or points file, see points.py)
+        destinations_csv: file with destination points (csv or points file, see points.py)
         csv_writer: CSVWriter, configured writer to write results
+        split: optional, fixed number of sources to evaluate at once, if not given the number is derived from the available memory and adapted while running (see SliceSizer)
         do_merge: merge the results over time, only keeping the best connections
         max_time: maximum travel-time in seconds (the smaller this value, the smaller the shortest path tree, that has to be created; saves processing time)
+        checkpoint: optional, Checkpoint, the finished slices and times are committed to it, if it holds the state of an interrupted evaluation the evaluation is resumed from there
+        shard: optional, tuple (index, count), only the share of the sources and times of the shard with the given index is evaluated (see config.shard_units)
         '''
 
-        origins = self.otp.loadCSVPopulation(origins_csv, LATITUDE_COLUMN, LONGITUDE_COLUMN)
-        destinations = self.otp.loadCSVPopulation(destinations_csv, LATITUDE_COLUMN, LONGITUDE_COLUMN)
+        origins = self.load_population(origins_csv)
+        destinations = self.load_population(destinations_csv)
 
         sources = origins if not self.arrive_by else destinations
-        n_slices = (sources.size() / split) + 1
-
-        if n_slices > 1:
-            print 'Splitting sources into {} part(s) with {} points each part'.format(n_slices, split)
-
-        from_index = 0;
-        to_index = 0;
-        i = 1
-
-        while True:
-            if to_index >= sources.size():
-                break
-            from_index = to_index
-            to_index += split
-            if to_index >= sources.size():
-                to_index = sources.size()
-            sliced_sources = sources.get_slice(from_index, to_index)
-            if n_slices > 1:
-                print('calculating part {}/{}'.format(i, n_slices))
-            i += 1
+        targets = destinations if not self.arrive_by else origins
+        n_parallel = min(self.n_parallel_times, len(times), self.n_threads)
+        sizer = SliceSizer(sources.size(), targets.size(),
+                           n_threads=self.n_threads,
+                           n_parallel=max(n_parallel, 1),
+                           calculate_details=self.calculate_details,
+                           write_dest_data=getattr(csv_writer, 'write_dest_data', False),
+                           merged=do_merge,
+                           pair_bytes=csv_writer.pair_bytes,
+                           split=split)
+        # all times of a slice are evaluated before its results are written
+        per_slice = do_merge or csv_writer.reduces_times
 
-            if not self.arrive_by:
-                origins = sliced_sources
-            else:
-                destinations = sliced_sources
-            self.request.setOrigins(origins)
-            self.request.setDestinations(destinations)
-            self.request.setLogProgress(self.print_every_n_lines)
+        shard_index, shard_count = shard or (0, 1)
+        units = shard_units(sources.size(), len(times), shard_index,
+                            shard_count, merged=per_slice)
+        if shard is not None:
+            print 'evaluating shard {} of {} ({} of {} sources)'.format(
+                shard_index + 1, shard_count,
+                sum(u[1] - u[0] for u in units), sources.size())
 
-            if self.arrive_by:
-                time_note = ' arrival time '
-            else:
-                time_note = 'start time '
-
-    #         # if evaluation is performed in a time window, routes exceeding the window will be ignored
-    #         # (worstTime already takes care of this, but the time needed to reach the snapped the OSM point is also taken into account here)
-    #         if len(times) > 1:
-    #             print 'Cutoff set: routes with {}s exceeding the time window ({}) will be ignored (incl. time to reach OSM-net)'.format(time_note, times[-1])
-    #             cutoff = times[-1]
-    #             self.request.setCutoffTime(cutoff.year, cutoff.month, cutoff.day, cutoff.hour, cutoff.minute, cutoff.second)
-
-            # iterate all times
-            results = [] # dimension (if not merged): times x targets (origins resp. destinations)
-            sdf = SimpleDateFormat('HH:mm:ss')
-            sdf.setTimeZone(TimeZone.getTimeZone("GMT +2"))
-            for t, date_time in enumerate(times):
-                # compare seconds since epoch (different ways to get it from java/python date)
-                epoch = datetime.utcfromtimestamp(0)
-                time_since_epoch = (date_time - epoch).total_seconds()
-                self.request.setDateTime(date_time.year, date_time.month, date_time.day, date_time.hour, date_time.minute, date_time.second)
-                # has to be set every time after setting datetime (and also AFTER setting arriveby)
-                self.request.setMaxTimeSec(max_time)
-
-                msg = 'Starting evaluation of routes with ' + time_note + date_time.strftime(DATETIME_FORMAT)
-                print msg
-
-                results_dt = self.batch_processor.evaluate(self.request)
-
-                # if there already was a calculation: merge it with new results
-                if do_merge and len(results) > 0:
-                    for i, prev_result in enumerate(results[0]):
-                        if prev_result is not None:
-                            prev_result.merge(results_dt[i])
-                #write and append if no merging is needed (saves memory)
+        state = checkpoint.state if checkpoint is not None else None
+        # slice that was not finished when interrupted
+        unfinished = None
+        if state is not None:
+            csv_writer.resume(origins, destinations, times, merged=do_merge,
+                              state=state['writer'])
+            from_index = state['from_index']
+            if state['to_index'] is not None:
+                unfinished = (state['to_index'], state['times_done'])
+            print 'resuming evaluation at source {} of {}'.format(
+                from_index + 1, sources.size())
+        else:
+            csv_writer.open(origins, destinations, times, merged=do_merge)
+            from_index = 0
+        part = 1
+
+        # pairs of sources and times evaluated before an interruption
+        done = 0
+        for unit_from, unit_to, unit_times in units:
+            done += (min(max(from_index, unit_from), unit_to) -
+                     unit_from) * len(unit_times)
+        if unfinished is not None and not per_slice:
+            done += len(unfinished[1]) * (unfinished[0] - from_index)
+        progress = ProgressReporter(
+            sum((u[1] - u[0]) * len(u[2]) for u in units), done=done)
+        smart_search = self.smart_search and do_merge and len(times) > 1
+        if self.smart_search and not do_merge:
+            print 'smart search only applies to results merged over time, all times are evaluated'
+        total_searches = total_skipped = 0
+
+        for unit_from, unit_to, unit_times in units:
+            # units finished before the interruption
+            if unit_to <= from_index:
+                continue
+            from_index = max(from_index, unit_from)
+            while from_index < unit_to:
+                self.check_canceled(csv_writer)
+                times_done = []
+                if unfinished is not None:
+                    to_index, times_done = unfinished
+                    unfinished = None
                 else:
-                    search_time = sdf.format(date_time)
-                    csv_writer.write(results_dt, additional_columns={'search_time': search_time}, append=True)
-                    for r in results_dt:
-                        del(r)
+                    to_index = min(from_index + sizer.size(), unit_to)
+                sliced_sources = sources.get_slice(from_index, to_index)
+                if to_index - from_index < sources.size():
+                    print('calculating part {} (sources {}-{} of {})'.format(
+                        part, from_index + 1, to_index, sources.size()))
+                part += 1
 
-            if do_merge:
-                # flatten the results
-                results = [r for res in results for r in res]
-                csv_writer.write(results, append=False)
+                if not self.arrive_by:
+                    origins = sliced_sources
+                else:
+                    destinations = sliced_sources
+                self.request.setOrigins(origins)
+                self.request.setDestinations(destinations)
+                self.request.setLogProgress(self.print_every_n_lines)
+                sizer.start()
 
 
+        #         # if evaluation is performed in a time window, routes exceeding the window will be ignored
+        #         # (worstTime already takes care of this, but the time needed to reach the snapped the OSM point is also taken into account here)
+        #         if len(times) > 1:
+        #             print 'Cutoff set: routes with {}s exceeding the time window ({}) will be ignored (incl. time to reach OSM-net)'.format(time_note, times[-1])
+        #             cutoff = times[-1]
+        #             self.request.setCutoffTime(cutoff.year, cutoff.month, cutoff.day, cutoff.hour, cutoff.minute, cutoff.second)
 
+                # iterate all times
+                # merged result sets of the slice (one per source), only the best
+                # connections of all times evaluated so far are kept
+                merged = None
+                sdf = SimpleDateFormat('HH:mm:ss')
+                sdf.setTimeZone(TimeZone.getTimeZone("GMT +2"))
+                # the times of an unfinished slice are evaluated completely again,
+                # if merged or reduced by the writer
+                indices = [t for t in unit_times
+                           if per_slice or t not in times_done]
+                if smart_search:
+                    evaluated = self.smart_search_times(times, max_time,
+                                                        indices)
+                else:
+                    evaluated = ((t, date_time, results_dt, 1)
+                                 for t, date_time, results_dt in
+                                 self.evaluate_times(
+                                     times, max_time, origins, destinations,
+                                     indices=indices))
+                for t, date_time, results_dt, n_times in evaluated:
+                    sizer.sample()
+                    progress.add((to_index - from_index) * n_times,
+                                 from_index, to_index, t)
+
+                    # merge the new results into the ones of the previous times,
+                    # the result sets of this time are released afterwards
+                    if do_merge:
+                        merged = merge_result_sets(merged, results_dt)
+                    #write and append if no merging is needed (saves memory)
+                    else:
+                        search_time = sdf.format(date_time)
+                        csv_writer.write(results_dt, additional_columns={'search_time': search_time}, append=True,
+                                         from_index=from_index, time_index=t)
+                        if checkpoint is not None and not per_slice:
+                            times_done.append(t)
+                            checkpoint.commit(from_index, to_index, times_done,
+                                              csv_writer.checkpoint())
+                    results_dt = None
+                    self.check_canceled(csv_writer)
+
+                if smart_search:
+                    print 'smart search: {} search(es) for {} time(s), {} skipped'.format(
+                        self.n_searches, len(indices), self.n_skipped)
+                    total_searches += self.n_searches
+                    total_skipped += self.n_skipped
+
+                # the slice is complete after the last time
+                if do_merge and merged is not None:
+                    csv_writer.write(merged, append=True, from_index=from_index)
+                elif csv_writer.reduces_times:
+                    csv_writer.finish_slice(from_index=from_index)
+                merged = None
+
+                sizer.finish(to_index - from_index)
+                from_index = to_index
+                if checkpoint is not None:
+                    checkpoint.commit(from_index, None, [],
+                                      csv_writer.checkpoint())
+
+        csv_writer.close()
+        progress.finish()
+        if smart_search:
+            print 'smart search: {} search(es) in total, {} time(s) skipped'.format(
+                total_searches, total_skipped)
+        if checkpoint is not None:
+            checkpoint.remove()
+
+
+class StreamWriter(object):
+    '''
+    file-like wrapper around a java PrintStream, used to redirect sys.stdout
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.append(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class OTPServer(object):
+    '''
+    long-running evaluation server, keeps the entry points, routers and batch
+    processors of the requested routers loaded and processes the jobs sent
+    to a local socket one after another
+
+    a job is sent as a single line of json, either
+    {"command": "evaluate", "args": [<arguments of otp_batch.py>]},
+    {"command": "ping"} or {"command": "shutdown"}.
+    The output of the job is streamed back to the client, followed by a
+    line with SERVER_EXIT_MARKER and the exit code of the job.
+
+    A running evaluation is canceled by sending {"command": "cancel"} over
+    the same connection or by closing it, the server stops the evaluation
+    after the current time resp. slice and takes the next job
+
+    Parameters
+    ----------
+    port: optional, port to listen to (localhost only)
+    max_routers: optional, max. number of routers to keep loaded, the least recently used ones are dropped
+    '''
+    def __init__(self, port=SERVER_PORT, max_routers=SERVER_MAX_ROUTERS):
+        self.port = port
+        self.max_routers = max_routers
+        # (graph path, router) -> (modification time of graph, OTPEvaluation)
+        self.evaluations = OrderedDict()
+        self.running = False
+        # connection to the client of the job being processed
+        self.client = None
+        self.reader = None
+
+    def get_evaluation(self, graph_path, router, print_every_n_lines=50,
+                       calculate_details=False, smart_search=False):
+        '''
+        return an evaluation with a fresh request for the given router,
+        the graph is only (re)loaded if it was not loaded before or changed
+        on disk since
+        '''
+        graph_file = os.path.join(graph_path, router, 'Graph.obj')
+        mtime = None
+        if os.path.exists(graph_file):
+            mtime = os.path.getmtime(graph_file)
+        key = (graph_path, router)
+        cached = self.evaluations.pop(key, None)
+        if cached is not None and cached[0] == mtime:
+            evaluation = cached[1]
+            evaluation.reset(print_every_n_lines=print_every_n_lines,
+                             calculate_details=calculate_details,
+                             smart_search=smart_search)
+            print 'reusing loaded graph of router "{}"'.format(router)
+        else:
+            # make some room before loading another graph
+            while len(self.evaluations) >= self.max_routers:
+                self.evaluations.popitem(last=False)
+            print 'loading graph of router "{}"...'.format(router)
+            evaluation = OTPEvaluation(graph_path, router,
+                                       print_every_n_lines=print_every_n_lines,
+                                       calculate_details=calculate_details,
+                                       smart_search=smart_search)
+        evaluation.canceled = self.canceled
+        self.evaluations[key] = (mtime, evaluation)
+        return evaluation
+
+    def canceled(self):
+        '''
+        return True if the client of the current job canceled it (sent
+        anything after the job or closed the connection)
+        '''
+        if self.client is None:
+            return False
+        try:
+            if self.reader.ready():
+                return True
+            # blocks for at most a millisecond, -1 if closed by the client
+            self.client.setSoTimeout(1)
+            self.reader.read()
+            return True
+        except SocketTimeoutException:
+            return False
+        except IOException:
+            return True
+
+    def serve_forever(self, run_job):
+        '''
+        listen for jobs until a shutdown command is received
+
+        Parameters
+        ----------
+        run_job: function processing a job, is called with the list of arguments and this server
+        '''
+        server_socket = ServerSocket(self.port, 0,
+                                     InetAddress.getLoopbackAddress())
+        print 'OTP evaluation server listening on port {}'.format(self.port)
+        self.running = True
+        while self.running:
+            client = server_socket.accept()
+            try:
+                self.handle(client, run_job)
+            except (Exception, Throwable):
+                traceback.print_exc()
+            finally:
+                client.close()
+        server_socket.close()
+        print 'OTP evaluation server stopped'
+
+    def handle(self, client, run_job):
+        '''
+        process a single job sent by the given client socket
+        '''
+        reader = BufferedReader(InputStreamReader(client.getInputStream(),
+                                                  'UTF-8'))
+        stream = PrintStream(client.getOutputStream(), True, 'UTF-8')
+        line = reader.readLine()
+        if not line:
+            return
+        job = json.loads(line)
+        command = job.get('command', 'evaluate')
+
+        if command == 'shutdown':
+            self.running = False
+        elif command == 'evaluate':
+            print 'job received: {}'.format(' '.join(job['args']))
+            self.client, self.reader = client, reader
+            try:
+                exit_code = self.run(job['args'], run_job, stream)
+            finally:
+                self.client = self.reader = None
+            print 'job finished with exit code {}'.format(exit_code)
+            stream.println('{} {}'.format(SERVER_EXIT_MARKER, exit_code))
+            return
+        stream.println('{} 0'.format(SERVER_EXIT_MARKER))
+
+    def run(self, args, run_job, stream):
+        '''
+        run a job with stdout and stderr (python and java) redirected to the
+        given stream, returns the exit code
+        '''
+        java_out, java_err = System.out, System.err
+        py_out, py_err = sys.stdout, sys.stderr
+        System.setOut(stream)
+        System.setErr(stream)
+        sys.stdout = sys.stderr = StreamWriter(stream)
+        exit_code = 0
+        try:
+            run_job(args, self)
+        # argparse exits on invalid arguments
+        except SystemExit as e:
+            exit_code = e.code or 0
+        except JobCanceled:
+            print 'job canceled by the client'
+            exit_code = 1
+        except (Exception, Throwable):
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            System.setOut(java_out)
+            System.setErr(java_err)
+            sys.stdout, sys.stderr = py_out, py_err
+        return exit_code
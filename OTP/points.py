@@ -0,0 +1,108 @@
+'''
+Compact binary interchange format of the origins and destinations
+
+written by the plugin and read by the batch analysis instead of exporting
+the layers as csv and parsing them again in OTP. Compatible with Python 2,
+Python 3 and Jython (no dependencies).
+
+layout (little endian):
+    magic "OTPPTS01"
+    int32 length of the header, header as utf-8 encoded json
+        {"count": number of points, "fields": [names of the fields]}
+    float64 latitudes (count)
+    float64 longitudes (count)
+    per field: int32 end offsets of the values (count),
+               the values as utf-8 encoded strings
+'''
+from array import array
+import struct
+import json
+import sys
+
+MAGIC = b'OTPPTS01'
+EXTENSION = '.pts'
+
+
+def _to_bytes(values, typecode):
+    arr = array(typecode, values)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr.tobytes() if hasattr(arr, 'tobytes') else arr.tostring()
+
+
+def _from_bytes(data, typecode):
+    arr = array(typecode)
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
+
+
+def write_points(filename, fields, latitudes, longitudes, columns):
+    '''
+    write points to a file
+
+    Parameters
+    ----------
+    filename: file to write to (overwrites existing file)
+    fields: names of the fields
+    latitudes: latitudes of the points (WGS84)
+    longitudes: longitudes of the points (WGS84)
+    columns: values of the fields, one list of strings (or None if missing)
+             per field
+    '''
+    count = len(latitudes)
+    if len(longitudes) != count or len(columns) != len(fields):
+        raise ValueError('the coordinates and columns do not match')
+    header = json.dumps({'count': count, 'fields': list(fields)})
+    header = header.encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<i', len(header)))
+        f.write(header)
+        f.write(_to_bytes(latitudes, 'd'))
+        f.write(_to_bytes(longitudes, 'd'))
+        for values in columns:
+            if len(values) != count:
+                raise ValueError('the coordinates and columns do not match')
+            encoded = [b'' if v is None else
+                       (v if isinstance(v, bytes) else v.encode('utf-8'))
+                       for v in values]
+            ends = []
+            end = 0
+            for value in encoded:
+                end += len(value)
+                ends.append(end)
+            f.write(_to_bytes(ends, 'i'))
+            f.write(b''.join(encoded))
+
+
+def read_points(filename):
+    '''
+    read points from a file
+
+    returns the names of the fields, the latitudes, the longitudes and the
+    values of the fields (one list of strings per field)
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('"{}" is no points file'.format(filename))
+        length = struct.unpack('<i', f.read(4))[0]
+        header = json.loads(f.read(length).decode('utf-8'))
+        count = header['count']
+        latitudes = _from_bytes(f.read(count * 8), 'd')
+        longitudes = _from_bytes(f.read(count * 8), 'd')
+        columns = []
+        for field in header['fields']:
+            ends = _from_bytes(f.read(count * 4), 'i')
+            data = f.read(ends[-1] if count else 0)
+            values = []
+            start = 0
+            for end in ends:
+                values.append(data[start:end].decode('utf-8'))
+                start = end
+            columns.append(values)
+    return header['fields'], latitudes, longitudes, columns
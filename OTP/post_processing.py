@@ -0,0 +1,301 @@
+'''
+Post processing of travel time matrices stored by the batch analysis
+(see MatrixWriter and SparseWriter in otp_eval.py) with NumPy
+
+computes the aggregation and accumulation modes of config.AGGREGATION_MODES
+resp. config.ACCUMULATION_MODES from the stored travel times and attribute
+values, so accessibilities can be recomputed with other modes and params
+without routing again
+
+to be used with Python 3 and NumPy (not with Jython)
+'''
+from argparse import ArgumentParser
+import numpy as np
+import json
+import csv
+import os
+
+from config import (AGGREGATION_MODES, ACCUMULATION_MODES, ID_COLUMN,
+                    split_params, mode_columns)
+import points
+
+# number of rows of a dense matrix processed at once
+CHUNK_ROWS = 1000
+
+
+class TravelTimes(object):
+    '''
+    travel times (in seconds) stored as dense matrix (.npy) or sparse matrix
+    (.npz), the layout is taken from the json sidecar file
+
+    Parameters
+    ----------
+    filename: the stored matrix
+    time_index: optional, index of the time to take the travel times of, if
+                not given the results of multiple times are merged (the
+                shortest travel time of all times per pair)
+    '''
+    def __init__(self, filename, time_index=None):
+        base = os.path.splitext(filename)[0]
+        with open(base + '.json') as f:
+            self.meta = json.load(f)
+        path = os.path.dirname(filename)
+        self.origin_ids = np.load(
+            os.path.join(path, self.meta['origin_ids']))
+        self.destination_ids = np.load(
+            os.path.join(path, self.meta['destination_ids']))
+        self.filename = filename
+        self.time_index = time_index
+        # the stored rows are the destinations if arrive by
+        self.transposed = self.meta['axes'][-2] == 'destination'
+
+    @property
+    def n_origins(self):
+        return len(self.origin_ids)
+
+    @property
+    def n_destinations(self):
+        return len(self.destination_ids)
+
+    def pairs(self):
+        '''
+        yield the reachable origin destination pairs block by block as
+        arrays of origin indices, destination indices and travel times
+        '''
+        if self.meta['format'] == 'csr':
+            blocks = self._sparse_pairs()
+        else:
+            blocks = self._dense_pairs()
+        for rows, cols, times in blocks:
+            if self.transposed:
+                rows, cols = cols, rows
+            yield rows, cols, times
+
+    def _dense_pairs(self):
+        matrix = np.load(self.filename, mmap_mode='r')
+        if matrix.ndim == 3 and self.time_index is not None:
+            matrix = matrix[self.time_index]
+        n_rows = matrix.shape[-2]
+        for start in range(0, n_rows, CHUNK_ROWS):
+            block = np.array(matrix[..., start:start + CHUNK_ROWS, :], 'f8')
+            if self.meta['dtype'] == 'int32':
+                # unreachable
+                block[block < 0] = np.nan
+            if block.ndim == 3:
+                block = np.fmin.reduce(block, axis=0)
+            rows, cols = np.nonzero(np.isfinite(block))
+            yield rows + start, cols, block[rows, cols]
+
+    def _sparse_pairs(self):
+        with np.load(self.filename) as npz:
+            indptr = npz['indptr']
+            indices = npz['indices']
+            data = npz['data'].astype('f8')
+        n_rows = self.meta['rows_per_time']
+        n_cols = self.meta['shape'][1]
+        n_times = (len(indptr) - 1) // n_rows
+        if self.time_index is not None:
+            first = self.time_index * n_rows
+            begin, end = indptr[first], indptr[first + n_rows]
+            rows = np.repeat(np.arange(n_rows),
+                             np.diff(indptr[first:first + n_rows + 1]))
+            yield rows, indices[begin:end], data[begin:end]
+            return
+        rows = np.repeat(np.arange(n_rows * n_times), np.diff(indptr)) % n_rows
+        if n_times > 1:
+            # keep the shortest travel time of all times per pair
+            keys = rows.astype('i8') * n_cols + indices
+            order = np.lexsort((data, keys))
+            keys, data = keys[order], data[order]
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = keys[1:] != keys[:-1]
+            keys, data = keys[first], data[first]
+            rows, indices = keys // n_cols, keys % n_cols
+        yield rows, indices, data
+
+
+def weights(mode, params, times):
+    '''
+    return the weights of the travel times (in seconds) in the given mode,
+    pairs not contributing are weighted with 0
+    '''
+    if mode == 'THRESHOLD_SUM_AGGREGATOR' or mode == 'THRESHOLD_ACCUMULATOR':
+        return (times <= params[0]).astype('f8')
+    if mode == 'THRESHOLD_CUMMULATIVE_AGGREGATOR':
+        threshold = params[0]
+        return np.where(times <= threshold, threshold - times, 0)
+    if mode == 'DECAY_AGGREGATOR':
+        threshold, lambda_ = params
+        return np.where(times <= threshold,
+                        np.exp(lambda_ * (times / 60.)), 0)
+    if mode == 'DECAY_ACCUMULATOR':
+        half_life = params[0] * 60.
+        return np.exp(-times / half_life)
+    raise ValueError('unknown mode {}'.format(mode))
+
+
+def aggregate(travel_times, values, mode, params):
+    '''
+    aggregate the values of the reachable destinations per origin
+
+    Parameters
+    ----------
+    travel_times: TravelTimes
+    values: array of the values of the destinations (in order of the destination ids)
+    mode: the aggregation mode (see config.AGGREGATION_MODES)
+    params: params of the mode, multiple sets are aggregated at once (see config.split_params)
+
+    returns an array with the aggregated values of the origins per set of
+    params (shape: sets x origins)
+    '''
+    if mode not in AGGREGATION_MODES:
+        raise ValueError('unknown aggregation mode {}'.format(mode))
+    param_sets = split_params(mode, params)
+    n = travel_times.n_origins
+    aggregated = np.zeros((len(param_sets), n))
+    # weights of the weighted average
+    total = np.zeros(n)
+    for rows, cols, times in travel_times.pairs():
+        dest_values = values[cols]
+        if mode == 'WEIGHTED_AVERAGE_AGGREGATOR':
+            # only destinations that are reached (and not the origin itself)
+            reached = times > 0
+            rows = rows[reached]
+            aggregated[0] += np.bincount(
+                rows, weights=dest_values[reached] * times[reached],
+                minlength=n)
+            total += np.bincount(rows, weights=dest_values[reached],
+                                 minlength=n)
+            continue
+        for i, params in enumerate(param_sets):
+            aggregated[i] += np.bincount(
+                rows, weights=dest_values * weights(mode, params, times),
+                minlength=n)
+    if mode == 'WEIGHTED_AVERAGE_AGGREGATOR':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            aggregated /= total
+    return aggregated
+
+
+def accumulate(travel_times, amounts, mode, params):
+    '''
+    accumulate the amounts of the origins at the destinations they reach
+
+    Parameters
+    ----------
+    travel_times: TravelTimes
+    amounts: array of the amounts of the origins (in order of the origin ids)
+    mode: the accumulation mode (see config.ACCUMULATION_MODES)
+    params: params of the mode, multiple sets are accumulated at once (see config.split_params)
+
+    returns an array with the accumulated values of the destinations per set
+    of params (shape: sets x destinations)
+    '''
+    if mode not in ACCUMULATION_MODES:
+        raise ValueError('unknown accumulation mode {}'.format(mode))
+    param_sets = split_params(mode, params)
+    n = travel_times.n_destinations
+    accumulated = np.zeros((len(param_sets), n))
+    for rows, cols, times in travel_times.pairs():
+        origin_amounts = amounts[rows]
+        for i, params in enumerate(param_sets):
+            accumulated[i] += np.bincount(
+                cols, weights=origin_amounts * weights(mode, params, times),
+                minlength=n)
+    return accumulated
+
+
+def read_values(filename, ids, field, id_field=ID_COLUMN):
+    '''
+    read the values of a field from a csv file or points file (e.g. the
+    exported origins or destinations), ordered like the given ids, missing
+    values are 0
+    '''
+    if os.path.splitext(filename)[1].lower() == points.EXTENSION:
+        fields, latitudes, longitudes, columns = points.read_points(filename)
+        rows = [dict(zip(fields, row)) for row in zip(*columns)]
+    else:
+        with open(filename, newline='', encoding='utf-8') as f:
+            sample = f.read(4096)
+            f.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+            rows = list(csv.DictReader(f, dialect=dialect))
+    values = {}
+    for row in rows:
+        try:
+            values[row[id_field]] = float(row[field])
+        except (TypeError, ValueError):
+            pass
+    return np.array([values.get(str(i), 0.) for i in ids])
+
+
+def write_results(filename, ids, columns, values):
+    '''
+    write the ids and the computed values as csv file in the format of the
+    batch analysis
+    '''
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        # named like the results of the batch analysis to be joinable
+        writer.writerow(['origin id'] + columns)
+        for i, row in zip(ids, values.T):
+            writer.writerow([i] + row.tolist())
+
+
+def get_parser():
+    parser = ArgumentParser(
+        description='Aggregation/Accumulation of stored travel time matrices')
+    parser.add_argument('--matrix', action='store', required=True,
+                        help='stored travel time matrix (.npy or .npz)',
+                        dest='matrix')
+    parser.add_argument('--mode', action='store', required=True,
+                        help='aggregation or accumulation mode',
+                        choices=(list(AGGREGATION_MODES.keys()) +
+                                 list(ACCUMULATION_MODES.keys())),
+                        dest='mode')
+    parser.add_argument('--params', action='store', default='',
+                        help='comma separated params of the mode, multiple ' +
+                        'sets of params are processed at once',
+                        dest='params')
+    parser.add_argument('--values', action='store', required=True,
+                        help='csv or points file with the values to ' +
+                        'aggregate (of the destinations) resp. accumulate ' +
+                        '(of the origins)',
+                        dest='values')
+    parser.add_argument('--field', action='store', required=True,
+                        help='field of the values', dest='field')
+    parser.add_argument('--id-field', action='store', default=ID_COLUMN,
+                        help='field of the ids in the csv file with the values',
+                        dest='id_field')
+    parser.add_argument('--time-index', action='store', type=int,
+                        help='only process the given time, by default the ' +
+                        'shortest travel times of all times are taken',
+                        dest='time_index')
+    parser.add_argument('--target', action='store', required=True,
+                        help='target csv file the results will be written to',
+                        dest='target')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    options = parser.parse_args()
+    params = [float(p) for p in options.params.split(',') if p]
+    try:
+        split_params(options.mode, params)
+    except ValueError as e:
+        parser.error(str(e))
+    travel_times = TravelTimes(options.matrix, time_index=options.time_index)
+    if options.mode in AGGREGATION_MODES:
+        ids = travel_times.origin_ids
+        values = read_values(options.values, travel_times.destination_ids,
+                             options.field, id_field=options.id_field)
+        results = aggregate(travel_times, values, options.mode, params)
+    else:
+        ids = travel_times.destination_ids
+        amounts = read_values(options.values, travel_times.origin_ids,
+                              options.field, id_field=options.id_field)
+        results = accumulate(travel_times, amounts, options.mode, params)
+    columns = mode_columns(options.field, options.mode,
+                           split_params(options.mode, params))
+    write_results(options.target, ids, columns, results)
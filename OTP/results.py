@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+'''
+Loading the results of the batch analysis into QGIS
+
+the results are stored in a table of a GeoPackage with attribute indices on
+the id columns instead of linking the csv file (the delimited text provider
+has no index, so joins and refreshes are slow for large results). Values
+with one row per origin (aggregated values) can be written straight into
+fields of the origin layer.
+'''
+import os
+import re
+import csv
+from osgeo import ogr
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsVectorLayer, QgsVectorDataProvider, QgsField,
+                       QgsFeatureRequest)
+
+# columns holding the ids of origins and destinations, indexed
+ID_COLUMNS = ['origin id', 'destination id']
+# number of rows written per transaction
+TRANSACTION_SIZE = 100000
+# max. length of the field names of shapefiles (longer ones are truncated)
+SHAPEFILE_MAX_NAME = 10
+
+
+def is_number(value):
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def table_name(name):
+    '''
+    return the given name as valid name of a table
+    '''
+    return re.sub('[^0-9a-zA-Z_]', '_', name)
+
+
+def numeric_columns(csv_file):
+    '''
+    return for each column of the results in the csv file if all its values
+    are numbers (empty values are skipped, the ids are always strings)
+    '''
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = next(reader, [])
+        numeric = [name not in ID_COLUMNS for name in header]
+        has_values = [False] * len(header)
+        for row in reader:
+            for i, value in enumerate(row[:len(header)]):
+                if value == '' or not numeric[i]:
+                    continue
+                has_values[i] = True
+                if not is_number(value):
+                    numeric[i] = False
+    return [n and v for n, v in zip(numeric, has_values)]
+
+
+def results_to_geopackage(csv_file, gpkg_file, table, layer_name=None):
+    '''
+    write the results in the csv file into a table (without geometry) of the
+    GeoPackage (created if not existing, an existing table with the same name
+    is replaced), the id columns are indexed
+
+    returns the table as QgsVectorLayer
+    '''
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(gpkg_file):
+        data_source = driver.Open(gpkg_file, 1)
+    else:
+        data_source = driver.CreateDataSource(gpkg_file)
+    for i in range(data_source.GetLayerCount()):
+        if data_source.GetLayerByIndex(i).GetName() == table:
+            data_source.DeleteLayer(i)
+            break
+    layer = data_source.CreateLayer(table, geom_type=ogr.wkbNone)
+    numeric = numeric_columns(csv_file)
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = next(reader, [])
+        for name, is_numeric in zip(header, numeric):
+            layer.CreateField(ogr.FieldDefn(
+                name, ogr.OFTReal if is_numeric else ogr.OFTString))
+        definition = layer.GetLayerDefn()
+        layer.StartTransaction()
+        for n, row in enumerate(reader, 1):
+            feature = ogr.Feature(definition)
+            for i, (value, is_numeric) in enumerate(zip(row, numeric)):
+                if value == '':
+                    continue
+                feature.SetField(i, float(value) if is_numeric else value)
+            layer.CreateFeature(feature)
+            if n % TRANSACTION_SIZE == 0:
+                layer.CommitTransaction()
+                layer.StartTransaction()
+        layer.CommitTransaction()
+    for column in ID_COLUMNS:
+        if column in header:
+            data_source.ExecuteSQL(
+                'CREATE INDEX "idx_{table}_{name}" ON "{table}" ("{column}")'
+                .format(table=table, name=table_name(column), column=column))
+    # closes the GeoPackage
+    data_source = None
+    return QgsVectorLayer('{}|layername={}'.format(gpkg_file, table),
+                          layer_name or table, 'ogr')
+
+
+def write_to_layer(layer, id_field, csv_file, key_column='origin id'):
+    '''
+    write the values of the results with one row per feature (e.g. the
+    aggregated values of the origins) into fields of the layer with the
+    names of the columns (added as decimal fields if not existing), features
+    without results get empty values
+
+    returns False if the fields of the layer can't be added or changed
+    '''
+    provider = layer.dataProvider()
+    capabilities = provider.capabilities()
+    if not (capabilities & QgsVectorDataProvider.AddAttributes and
+            capabilities & QgsVectorDataProvider.ChangeAttributeValues):
+        return False
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = next(reader, [])
+        if key_column not in header:
+            return False
+        key = header.index(key_column)
+        columns = [i for i, name in enumerate(header) if i != key]
+        values = dict(
+            (row[key], [float(row[i]) if is_number(row[i]) else None
+                        for i in columns])
+            for row in reader)
+    names = [header[i] for i in columns]
+    new_fields = [QgsField(name, QVariant.Double) for name in names
+                  if layer.fields().indexFromName(name) < 0]
+    # shapefiles truncate the names, the fields would not be found again
+    if (new_fields and provider.storageType() == 'ESRI Shapefile' and
+        any(len(f.name()) > SHAPEFILE_MAX_NAME for f in new_fields)):
+        return False
+    existing = set(layer.fields().names())
+    if new_fields:
+        if not provider.addAttributes(new_fields):
+            return False
+        layer.updateFields()
+    indices = [layer.fields().indexFromName(name) for name in names]
+    # e.g. names truncated or changed by other providers, remove the added
+    # fields again
+    if -1 in indices:
+        added = [i for i, field in enumerate(layer.fields())
+                 if field.name() not in existing]
+        if (added and provider.capabilities() &
+            QgsVectorDataProvider.DeleteAttributes):
+            provider.deleteAttributes(added)
+            layer.updateFields()
+        return False
+    empty = [None] * len(indices)
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes([id_field], layer.fields())
+    changes = {}
+    for feature in layer.getFeatures(request):
+        row = values.get(str(feature[id_field]), empty)
+        changes[feature.id()] = dict(zip(indices, row))
+    if not provider.changeAttributeValues(changes):
+        return False
+    layer.triggerRepaint()
+    return True
@@ -0,0 +1,74 @@
+'''
+Skipping of departure times in the smart search over a time batch (see
+OTPEvaluation.smart_search_times)
+
+kept free of Java and the OTP bindings, so that it runs with Jython and
+with the Python of QGIS
+'''
+import hashlib
+
+# parts of a signature of the results not using transit
+UNREACHABLE = '-'
+NO_TRANSIT = 'w'
+
+
+def signature(parts):
+    '''
+    return a digest of the connections of the results of a source, given as
+    parts per result (times of boarding the first and alighting the last
+    transit vehicle, UNREACHABLE or NO_TRANSIT)
+
+    None if any result doesn't use transit: with a max. travel time such a
+    result might reach its target by transit at a time in between (and even
+    without one a transit connection in between may be faster than walking),
+    so no step is skipped for these sources
+    '''
+    if UNREACHABLE in parts or NO_TRANSIT in parts:
+        return None
+    return hashlib.md5('|'.join(parts).encode('utf-8')).digest()
+
+
+def connections_unchanged(signatures, next_signatures):
+    '''
+    return True if all results use the same transit connections at both ends
+    of a step, the times in between lead to the same connections then
+    '''
+    return None not in signatures and signatures == next_signatures
+
+
+def smart_search(n_times, search):
+    '''
+    search the times with the given number in order, reusing earlier
+    searches: the step to the next searched time grows as long as the
+    connections found at both ends of a step are unchanged, the times in
+    between are skipped. If they changed, the step is halved and searched
+    again.
+
+    Parameters
+    ----------
+    n_times: number of times
+    search: function searching the time with the given position, returns
+            the results and their signatures (one per source, see signature)
+
+    yields the position of the searched time, its results and the number
+    of times they stand for (the searched one and the skipped ones before
+    it)
+    '''
+    if not n_times:
+        return
+    results, signatures = search(0)
+    yield 0, results, 1
+    pos = 0
+    step = 1
+    while pos < n_times - 1:
+        next_pos = min(pos + step, n_times - 1)
+        results, next_signatures = search(next_pos)
+        unchanged = connections_unchanged(signatures, next_signatures)
+        if next_pos == pos + 1 or unchanged:
+            yield next_pos, results, next_pos - pos
+            pos = next_pos
+            signatures = next_signatures
+            step = step * 2 if unchanged else 1
+        else:
+            step = max(1, (next_pos - pos) // 2)
+        results = None
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+the results written in Arrow IPC file format have to be readable with
+pyarrow and pandas (skipped if they are not installed)
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from arrow_ipc import ArrowFileWriter, Column, dictionary_encode
+
+try:
+    import pyarrow.ipc
+    import pandas
+except ImportError:
+    pyarrow = None
+
+
+class DictionaryEncodeTest(unittest.TestCase):
+
+    def test_duplicates(self):
+        dictionary, index = dictionary_encode(['b', 'a', 'b', 'c', 'a'])
+        self.assertEqual(dictionary, ['b', 'a', 'c'])
+        self.assertEqual(index, {'b': 0, 'a': 1, 'c': 2})
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow and pandas are not installed')
+class ArrowFileWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'results.arrow')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, origin_ids, destination_ids, batches, resume_after=None):
+        '''
+        write the batches of (origin id, destination id, travel time, mode)
+        rows, the writer is continued from its state after the given number
+        of batches (the batches written after the state are discarded)
+        '''
+        origins, origin_index = dictionary_encode(origin_ids)
+        destinations, destination_index = dictionary_encode(destination_ids)
+        columns = [Column('origin id', 'utf8', dictionary=0),
+                   Column('destination id', 'utf8', dictionary=1),
+                   Column('travel time (sec)', 'int64'),
+                   Column('traverse modes', 'utf8')]
+        writer = ArrowFileWriter(self.filename, columns, dictionaries={
+            0: origins, 1: destinations})
+        for i, rows in enumerate(batches):
+            if i == resume_after:
+                # checkpoints store the state as json
+                state = json.loads(json.dumps(writer.state()))
+            o, d, t, m = zip(*rows)
+            writer.write_batch([[origin_index[v] for v in o],
+                                [destination_index[v] for v in d],
+                                list(t), list(m)])
+        if resume_after is not None:
+            writer.file.close()
+            writer = ArrowFileWriter(self.filename, columns, resume=state)
+        writer.close()
+
+    def test_duplicate_ids(self):
+        # ids are not unique in the layers, the dictionaries have to be distinct
+        batches = [[('1', 'a', 60, u'WALK'), ('1', 'b', None, None)],
+                   [(u'ö', 'a', 120, u'BUS,WALK'), ('1', 'a', 30, u'WALK')]]
+        self.write(['1', u'ö', '1'], ['a', 'b', 'a'], batches)
+        table = pyarrow.ipc.open_file(self.filename).read_all()
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(table.column('origin id').to_pylist(),
+                         ['1', '1', u'ö', '1'])
+        self.assertEqual(table.column('destination id').to_pylist(),
+                         ['a', 'b', 'a', 'a'])
+        self.assertEqual(table.column('travel time (sec)').to_pylist(),
+                         [60, None, 120, 30])
+        df = pandas.read_feather(self.filename)
+        self.assertEqual(list(df['origin id'].cat.categories), ['1', u'ö'])
+        self.assertEqual(list(df['traverse modes'].isnull()),
+                         [False, True, False, False])
+
+    def test_resume(self):
+        batches = [[('1', 'a', 60, u'WALK')], [('2', 'a', 90, u'WALK')],
+                   [('2', 'b', 10, u'WALK')]]
+        self.write(['1', '2'], ['a', 'b'], batches, resume_after=1)
+        table = pyarrow.ipc.open_file(self.filename).read_all()
+        self.assertEqual(table.column('travel time (sec)').to_pylist(), [60])
+
+
+if __name__ == '__main__':
+    unittest.main()
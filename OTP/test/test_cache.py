@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+identical jobs have to share the key of their cached results, the least
+recently used results are evicted first
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+# the cache is part of the plugin package (relative imports)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+if sys.version_info[0] >= 3:
+    from OTP.cache import ResultCache
+    from OTP.config import typed_settings
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'the plugin requires Python 3')
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.tmp_dir, 'cache'))
+        self.origins = self.write('origins.pts', b'origins')
+        self.destinations = self.write('destinations.pts', b'destinations')
+        self.settings = typed_settings({})
+        self.settings['router_config']['path'] = self.tmp_dir
+        self.settings['router_config']['router'] = 'router'
+        os.makedirs(os.path.join(self.tmp_dir, 'router'))
+        self.write(os.path.join('router', 'Graph.obj'), b'graph')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return filename
+
+    def key(self, settings=None, origins=None):
+        return self.cache.key(settings or self.settings,
+                              origins or self.origins, self.destinations)
+
+    def test_key(self):
+        key = self.key()
+        self.assertEqual(key, self.key(typed_settings(self.settings)))
+        self.assertTrue(key.endswith('.csv'))
+        # settings the results don't depend on
+        settings = typed_settings(self.settings)
+        settings['system']['n_threads'] = 1
+        self.assertEqual(key, self.key(settings))
+        # settings and inputs the results depend on
+        settings['router_config']['max_time_min'] += 1
+        self.assertNotEqual(key, self.key(settings))
+        other = self.write('other.pts', b'other origins')
+        self.assertNotEqual(key, self.key(origins=other))
+        self.assertNotEqual(key, self.cache.key(
+            self.settings, self.origins, self.destinations, '.arrow'))
+        # a rebuilt graph
+        self.write(os.path.join('router', 'Graph.obj'), b'new graph')
+        self.assertNotEqual(key, self.key())
+
+    def test_get_put(self):
+        key = self.key()
+        target = os.path.join(self.tmp_dir, 'target.csv')
+        self.assertFalse(self.cache.get(key, target))
+        results = self.write('results.csv', b'origin id;destination id\n')
+        self.cache.put(key, results)
+        self.assertTrue(self.cache.get(key, target))
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'origin id;destination id\n')
+
+    def test_eviction(self):
+        results = self.write('results.csv', b'x' * 100)
+        self.cache.max_bytes = 250
+        now = time.time()
+        for i, name in enumerate(['a', 'b']):
+            self.cache.put(name, results)
+            filename = os.path.join(self.cache.path, name)
+            os.utime(filename, (now - 100 + i, now - 100 + i))
+        # reading marks the oldest results as recently used
+        self.assertTrue(self.cache.get('a', os.path.join(self.tmp_dir, 'a')))
+        self.cache.put('c', results)
+        self.assertEqual(sorted(os.listdir(self.cache.path)), ['a', 'c'])
+        # results larger than the cache are not stored
+        self.cache.put('d', self.write('large.csv', b'x' * 300))
+        self.assertEqual(sorted(os.listdir(self.cache.path)), ['a', 'c'])
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''
+the settings have to keep their types and hash through writing and reading
+the config
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from config import Config, typed_settings, settings_hash
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'config.xml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def changed_config(self):
+        config = Config()
+        settings = config.settings
+        # values as set in the UI
+        settings['router_config']['max_walk_distance'] = '1500.5'
+        settings['router_config']['max_time_min'] = 90
+        settings['time']['arrive_by'] = 'True'
+        settings['time']['time_batch']['time_step'] = ''
+        settings['system']['n_threads'] = '8'
+        settings['system']['server'] = True
+        agg_acc = settings['post_processing']['aggregation_accumulation']
+        agg_acc['params'] = ['0.5', '10']
+        agg_acc['processed_field'] = u'Einwohner_ä'
+        return config
+
+    def test_types(self):
+        settings = self.changed_config().typed()
+        self.assertEqual(settings['router_config']['max_walk_distance'],
+                         1500.5)
+        self.assertEqual(settings['router_config']['max_time_min'], 90)
+        self.assertIs(settings['time']['arrive_by'], True)
+        self.assertIsNone(settings['time']['time_batch']['time_step'])
+        self.assertEqual(settings['system']['n_threads'], 8)
+        agg_acc = settings['post_processing']['aggregation_accumulation']
+        self.assertEqual(agg_acc['params'], [0.5, 10.])
+
+    def test_round_trip(self):
+        config = self.changed_config()
+        typed = config.typed()
+        config.write(self.filename)
+        read = Config()
+        read.read(self.filename)
+        self.assertEqual(read.invalid, [])
+        self.assertEqual(read.settings, typed)
+        self.assertEqual(read.hash(), config.hash())
+
+    def test_hash(self):
+        config = self.changed_config()
+        settings = config.typed()
+        # the order of the keys doesn't matter
+        reordered = OrderedDict(reversed(list(settings.items())))
+        self.assertEqual(settings_hash(reordered), config.hash())
+        # entries not in the structure are not hashed
+        settings['META'] = {'user': 'someone'}
+        self.assertEqual(settings_hash(settings), config.hash())
+        settings['system']['n_threads'] = 4
+        self.assertNotEqual(settings_hash(settings), config.hash())
+        # the hash can be restricted to some of the settings
+        keys = ['router_config', 'time']
+        self.assertEqual(settings_hash(settings, keys=keys),
+                         config.hash(keys=keys))
+
+    def test_invalid(self):
+        config = Config()
+        config.settings['system']['n_threads'] = 'many'
+        self.assertRaises(ValueError, config.typed)
+        config.write(self.filename)
+        read = Config()
+        read.read(self.filename)
+        self.assertEqual(read.invalid, ['system/n_threads'])
+        self.assertEqual(read.settings['system']['n_threads'],
+                         typed_settings({})['system']['n_threads'])
+
+
+if __name__ == '__main__':
+    unittest.main()
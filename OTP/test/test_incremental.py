@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+rerunning an analysis into the same results has to route only the added or
+moved sources and patch the previous results
+'''
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import unittest
+
+# the incremental update is part of the plugin package (relative imports)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+if sys.version_info[0] >= 3:
+    from OTP.incremental import IncrementalUpdate, keep_inputs
+    from OTP.config import Config
+    from OTP.points import write_points
+
+ORIGINS = [('1', 53.5, 10.0), ('2', 53.6, 10.1), ('3', 53.7, 10.2)]
+DESTINATIONS = [('a', 53.0, 9.0), ('b', 53.1, 9.1)]
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'the plugin requires Python 3')
+class IncrementalUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.target = self.path('results.csv')
+        self.prev_config = self.path('results-config.xml')
+        self.write_config(self.prev_config)
+        rows = [['origin id', 'destination id', 'travel time (sec)']]
+        rows += [[o, d, '60'] for o, lat, lon in ORIGINS
+                 for d, lat, lon in DESTINATIONS]
+        self.write_csv(self.target, rows)
+        keep_inputs(self.target,
+                    self.write_points('prev_origins.pts', ORIGINS),
+                    self.write_points('prev_destinations.pts', DESTINATIONS))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def write_config(self, filename, **changes):
+        config = Config()
+        config.settings['origin']['id_field'] = 'id'
+        config.settings['destination']['id_field'] = 'id'
+        for section, values in changes.items():
+            config.settings[section].update(values)
+        config.write(filename)
+        return filename
+
+    def write_points(self, name, rows):
+        filename = self.path(name)
+        ids, latitudes, longitudes = zip(*rows)
+        write_points(filename, ['id'], latitudes, longitudes, [list(ids)])
+        return filename
+
+    def write_csv(self, filename, rows):
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f, delimiter=';').writerows(rows)
+
+    def read_csv(self, filename):
+        with open(filename, newline='', encoding='utf-8') as f:
+            return list(csv.reader(f, delimiter=';'))
+
+    def update(self, origins, destinations=DESTINATIONS, **changes):
+        return IncrementalUpdate(
+            self.target, self.prev_config,
+            self.write_config(self.path('config.xml'), **changes),
+            self.write_points('origins.pts', origins),
+            self.write_points('destinations.pts', destinations))
+
+    def test_unchanged(self):
+        update = self.update(ORIGINS)
+        self.assertTrue(update.possible)
+        self.assertEqual(update.changed, [])
+        self.assertEqual(update.replaced, set())
+
+    def test_changed_sources(self):
+        # 1 unchanged, 2 moved, 3 removed, 4 added
+        origins = [ORIGINS[0], ('2', 53.65, 10.1), ('4', 54.0, 11.0)]
+        update = self.update(origins)
+        self.assertTrue(update.possible)
+        self.assertEqual(sorted(row['id'] for row in update.changed),
+                         ['2', '4'])
+        self.assertEqual(update.replaced, set(['2', '3', '4']))
+
+        changed_csv = self.path('changed.csv')
+        update.write_changed(changed_csv)
+        # read by OTP as population (comma separated)
+        with open(changed_csv, newline='', encoding='utf-8') as f:
+            self.assertEqual(sorted(row['id'] for row in csv.DictReader(f)),
+                             ['2', '4'])
+
+        update_csv = self.path('update.csv')
+        self.write_csv(update_csv, [
+            ['origin id', 'destination id', 'travel time (sec)'],
+            ['2', 'a', '120'], ['4', 'b', '30']])
+        update.patch(update_csv)
+        self.assertEqual(self.read_csv(self.target), [
+            ['origin id', 'destination id', 'travel time (sec)'],
+            ['1', 'a', '60'], ['1', 'b', '60'],
+            ['2', 'a', '120'], ['4', 'b', '30']])
+
+    def test_full_run_required(self):
+        # changed targets
+        self.assertFalse(self.update(
+            ORIGINS, destinations=DESTINATIONS[:1]).possible)
+        # changed settings
+        self.assertFalse(self.update(
+            ORIGINS, router_config={'max_time_min': 1}).possible)
+        # accumulated values depend on all sources
+        self.assertFalse(self.update(ORIGINS, post_processing={
+            'aggregation_accumulation': {
+                'active': True, 'mode': 'DECAY_ACCUMULATOR',
+                'processed_field': 'id', 'params': [1]}}).possible)
+        # no previous run
+        os.remove(self.prev_config)
+        self.assertFalse(self.update(ORIGINS).possible)
+
+
+if __name__ == '__main__':
+    unittest.main()
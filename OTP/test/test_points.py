@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+the points written by the plugin have to be read unchanged by the batch
+analysis
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from points import write_points, read_points, EXTENSION
+
+
+class PointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'points' + EXTENSION)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        fields = ['id', u'Einwohner', 'name']
+        latitudes = [53.55, 48.137154, -33.8688]
+        longitudes = [9.99, 11.576124, 151.2093]
+        columns = [['1', '2', '2'],
+                   ['100', None, '0.5'],
+                   [u'Hamburg', u'München', u'']]
+        write_points(self.filename, fields, latitudes, longitudes, columns)
+        r_fields, r_lats, r_lons, r_columns = read_points(self.filename)
+        self.assertEqual(r_fields, fields)
+        # the coordinates are stored without loss of precision
+        self.assertEqual(list(r_lats), latitudes)
+        self.assertEqual(list(r_lons), longitudes)
+        # missing values are read as empty strings
+        columns[1][1] = u''
+        self.assertEqual(r_columns, columns)
+
+    def test_empty(self):
+        write_points(self.filename, ['id'], [], [], [[]])
+        fields, latitudes, longitudes, columns = read_points(self.filename)
+        self.assertEqual(fields, ['id'])
+        self.assertEqual((len(latitudes), len(longitudes)), (0, 0))
+        self.assertEqual(columns, [[]])
+
+    def test_mismatch(self):
+        with self.assertRaises(ValueError):
+            write_points(self.filename, ['id'], [1.], [1., 2.], [['1']])
+        with self.assertRaises(ValueError):
+            write_points(self.filename, ['id'], [1.], [1.], [['1', '2']])
+
+    def test_no_points_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'id;lat;lon\n')
+        self.assertRaises(ValueError, read_points, self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
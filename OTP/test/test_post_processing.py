@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+the modes computed from stored travel time matrices have to match the
+values computed by hand (skipped if NumPy is not installed)
+'''
+import os
+import sys
+import json
+import math
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+try:
+    import numpy as np
+    from post_processing import TravelTimes, aggregate, accumulate
+except ImportError:
+    np = None
+
+NAN = float('nan')
+# travel times in seconds of the origins A, B to the destinations x, y, z
+TIMES = [[60, 300, NAN],
+         [600, NAN, 0]]
+DEST_VALUES = [1., 2., 4.]
+ORIGIN_AMOUNTS = [10., 20.]
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class PostProcessingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def store(self, times, fmt='dense', dtype='float32', arrive_by=False):
+        '''
+        store the travel times (times x origins x destinations) like the
+        writers of the batch analysis, return the filename of the matrix
+        '''
+        times = np.array(times, dtype='f8')
+        if times.ndim == 2:
+            times = times[np.newaxis]
+        axes = ['origin', 'destination']
+        if arrive_by:
+            times = times.transpose(0, 2, 1)
+            axes.reverse()
+        base = os.path.join(self.tmp_dir, 'results')
+        np.save(base + '-origins.npy', np.array(['A', 'B']))
+        np.save(base + '-destinations.npy', np.array(['x', 'y', 'z']))
+        n_times, n_rows, n_cols = times.shape
+        meta = {'dtype': dtype, 'format': fmt,
+                'origin_ids': 'results-origins.npy',
+                'destination_ids': 'results-destinations.npy'}
+        if fmt == 'dense':
+            filename = base + '.npy'
+            stored = times if n_times > 1 else times[0]
+            if dtype == 'int32':
+                stored = np.where(np.isnan(stored), -1, stored)
+            np.save(filename, stored.astype(dtype))
+            meta.update(shape=list(stored.shape),
+                        axes=(['time'] if n_times > 1 else []) + axes)
+        else:
+            filename = base + '.npz'
+            stacked = times.reshape(n_times * n_rows, n_cols)
+            reachable = np.isfinite(stacked)
+            indptr = np.concatenate([[0], np.cumsum(reachable.sum(axis=1))])
+            rows, cols = np.nonzero(reachable)
+            np.savez(filename, format=np.array(['csr']),
+                     shape=np.array(stacked.shape), indptr=indptr,
+                     indices=cols.astype('i4'),
+                     data=stacked[rows, cols].astype(dtype))
+            meta.update(shape=list(stacked.shape), axes=axes,
+                        rows_per_time=n_rows)
+        meta['file'] = os.path.basename(filename)
+        with open(base + '.json', 'w') as f:
+            json.dump(meta, f)
+        return filename
+
+    def stored_variants(self, times=TIMES):
+        for fmt in ['dense', 'csr']:
+            for dtype in ['float32', 'int32']:
+                for arrive_by in [False, True]:
+                    yield TravelTimes(self.store(times, fmt=fmt, dtype=dtype,
+                                                 arrive_by=arrive_by))
+
+    def assert_values(self, computed, expected):
+        np.testing.assert_allclose(computed, np.array(expected), rtol=1e-6)
+
+    def test_aggregation(self):
+        values = np.array(DEST_VALUES)
+        decay = [1 * math.exp(-0.1) + 2 * math.exp(-0.5),
+                 1 * math.exp(-1.) + 4]
+        for travel_times in self.stored_variants():
+            self.assert_values(
+                aggregate(travel_times, values, 'THRESHOLD_SUM_AGGREGATOR',
+                          [300, 600]),
+                [[3, 4], [3, 5]])
+            self.assert_values(
+                aggregate(travel_times, values,
+                          'THRESHOLD_CUMMULATIVE_AGGREGATOR', [300]),
+                [[1 * 240, 4 * 300]])
+            # the origin itself (travel time 0) is not averaged
+            self.assert_values(
+                aggregate(travel_times, values, 'WEIGHTED_AVERAGE_AGGREGATOR',
+                          []),
+                [[(1 * 60 + 2 * 300) / 3., 600]])
+            self.assert_values(
+                aggregate(travel_times, values, 'DECAY_AGGREGATOR',
+                          [600, -0.1]),
+                [decay])
+
+    def test_accumulation(self):
+        amounts = np.array(ORIGIN_AMOUNTS)
+        expected = [10 * math.exp(-60 / 300.) + 20 * math.exp(-600 / 300.),
+                    10 * math.exp(-300 / 300.), 20]
+        for travel_times in self.stored_variants():
+            self.assert_values(
+                accumulate(travel_times, amounts, 'DECAY_ACCUMULATOR', [5]),
+                [expected])
+
+    def test_times(self):
+        # the shortest travel time of all times per pair, unless a single
+        # time is taken
+        later = [[120, 60, 900],
+                 [NAN, NAN, 0]]
+        values = np.array(DEST_VALUES)
+        for fmt in ['dense', 'csr']:
+            filename = self.store([TIMES, later], fmt=fmt)
+            merged = TravelTimes(filename)
+            self.assert_values(
+                aggregate(merged, values, 'THRESHOLD_SUM_AGGREGATOR', [100]),
+                [[3, 4]])
+            second = TravelTimes(filename, time_index=1)
+            self.assert_values(
+                aggregate(second, values, 'THRESHOLD_SUM_AGGREGATOR', [100]),
+                [[2, 4]])
+
+    def test_unknown_mode(self):
+        travel_times = TravelTimes(self.store(TIMES))
+        self.assertRaises(ValueError, aggregate, travel_times,
+                          np.array(DEST_VALUES), 'DECAY_ACCUMULATOR', [5])
+        self.assertRaises(ValueError, accumulate, travel_times,
+                          np.array(ORIGIN_AMOUNTS), 'DECAY_AGGREGATOR',
+                          [600, -0.1])
+
+
+if __name__ == '__main__':
+    unittest.main()
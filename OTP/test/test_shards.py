@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+the shards of a batch analysis have to cover every pair of source and time
+exactly once
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from config import shard_units
+
+
+def covered(n_sources, n_times, count, merged=False):
+    '''
+    return the (source, time) pairs of all shards with the indices of the
+    shards evaluating them
+    '''
+    pairs = {}
+    for index in range(count):
+        for first, end, time_indices in shard_units(
+                n_sources, n_times, index, count, merged=merged):
+            for s in range(first, end):
+                for t in time_indices:
+                    pairs.setdefault((s, t), []).append(index)
+    return pairs
+
+
+class ShardUnitsTest(unittest.TestCase):
+
+    def test_partition(self):
+        for n_sources, n_times, count in [(10, 1, 3), (7, 5, 3), (3, 4, 5),
+                                          (100, 12, 4), (1, 1, 1)]:
+            for merged in [False, True]:
+                pairs = covered(n_sources, n_times, count, merged=merged)
+                self.assertEqual(len(pairs), n_sources * n_times)
+                self.assertTrue(all(len(shards) == 1
+                                    for shards in pairs.values()))
+
+    def test_merged(self):
+        # all times of a source are evaluated by the same shard
+        pairs = covered(10, 6, 3, merged=True)
+        for s in range(10):
+            shards = set(pairs[(s, t)][0] for t in range(6))
+            self.assertEqual(len(shards), 1)
+
+    def test_spread_over_times(self):
+        # a single block of sources is still split, if not merged
+        pairs = covered(1, 6, 3)
+        self.assertEqual(sorted(set(p[0] for p in pairs.values())),
+                         [0, 1, 2])
+
+    def test_single_shard(self):
+        self.assertEqual(shard_units(5, 2), [(0, 5, [0, 1])])
+        self.assertEqual(shard_units(0, 2), [])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, shard_units, 5, 2, 2, 2)
+        self.assertRaises(ValueError, shard_units, 5, 2, 0, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+the smart search over a time batch has to lead to the same results merged
+over time as searching every single time
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from smart_search import smart_search, signature, UNREACHABLE, NO_TRANSIT
+
+
+class Router(object):
+    '''
+    routes pairs at departure times (in minutes) with trips given as
+    (departure, arrival) and a walking time, the earliest arrival is taken,
+    results exceeding the max. travel time are unreachable
+    '''
+    def __init__(self, pairs, max_time=None):
+        self.pairs = pairs
+        self.max_time = max_time
+        self.n_searches = 0
+
+    def route(self, pair, t):
+        trips, walk = pair
+        options = [(arr, '{}/{}'.format(dep, arr))
+                   for dep, arr in trips if dep >= t]
+        if walk is not None:
+            options.append((t + walk, NO_TRANSIT))
+        if not options:
+            return None, UNREACHABLE
+        arrival, part = min(options)
+        if self.max_time is not None and arrival - t > self.max_time:
+            return None, UNREACHABLE
+        return arrival - t, part
+
+    def search(self, times, pos):
+        self.n_searches += 1
+        routed = [self.route(pair, times[pos]) for pair in self.pairs]
+        results = [r[0] for r in routed]
+        return results, [signature([r[1] for r in routed])]
+
+
+def merge(merged, results):
+    '''
+    keep the shortest travel times (best of)
+    '''
+    if merged is None:
+        return list(results)
+    return [m if r is None or (m is not None and m <= r) else r
+            for m, r in zip(merged, results)]
+
+
+def serial(router, times):
+    merged = None
+    for pos in range(len(times)):
+        merged = merge(merged, router.search(times, pos)[0])
+    return merged
+
+
+def smart(router, times):
+    merged = None
+    n_times = 0
+    for pos, results, n in smart_search(
+        len(times), lambda pos: router.search(times, pos)):
+        merged = merge(merged, results)
+        n_times += n
+    assert n_times == len(times)
+    return merged
+
+
+class SmartSearchTest(unittest.TestCase):
+
+    times = list(range(0, 240, 5))
+
+    def compare(self, pairs, max_time=None):
+        expected = serial(Router(pairs, max_time=max_time), self.times)
+        router = Router(pairs, max_time=max_time)
+        self.assertEqual(smart(router, self.times), expected)
+        return router.n_searches
+
+    def test_transit_only(self):
+        pairs = [([(d, d + 20) for d in range(0, 300, 60)], None),
+                 ([(d, d + 35) for d in range(10, 300, 120)], None)]
+        n_searches = self.compare(pairs)
+        self.assertLess(n_searches, len(self.times))
+
+    def test_unreachable_at_both_ends(self):
+        # a single trip in between reaches the target within max. time
+        pairs = [([(d, d + 20) for d in range(0, 300, 60)], None),
+                 ([(112, 130)], None)]
+        self.compare(pairs, max_time=30)
+
+    def test_walking_at_both_ends(self):
+        # transit is faster than walking only right before departure
+        pairs = [([(d, d + 20) for d in range(0, 300, 60)], None),
+                 ([(112, 130)], 40)]
+        self.compare(pairs)
+        self.compare(pairs, max_time=45)
+
+    def test_no_times(self):
+        self.assertEqual(list(smart_search(0, None)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
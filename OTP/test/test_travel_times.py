@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+the statistics streamed over the times have to match the statistics of all
+travel times of a pair, the percentiles within the width of a bin
+'''
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from travel_times import TravelTimeStatistics, BIN_WIDTH
+
+
+def exact_percentile(values, p):
+    '''
+    percentile of the values, interpolated linearly between the ranks
+    '''
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100.
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (rank - lower) * (values[upper] - values[lower])
+
+
+class TravelTimeStatisticsTest(unittest.TestCase):
+
+    def stream(self, times_per_pair, **kwargs):
+        '''
+        add the travel times of a single source to two targets time by time,
+        return the statistics per target
+        '''
+        n_times = len(times_per_pair[0])
+        statistics = TravelTimeStatistics(1, len(times_per_pair), **kwargs)
+        for t in range(n_times):
+            statistics.add([[times[t] for times in times_per_pair]])
+        return dict((j, values) for i, j, values in statistics.pairs())
+
+    def test_percentiles_of_known_distribution(self):
+        rng = random.Random(42)
+        percentiles = [10, 50, 90]
+        # many departures spread over an hour and a few of them far away
+        uniform = [rng.randint(10 * 60, 70 * 60) for t in range(1000)]
+        skewed = [int(rng.expovariate(1. / 1800)) for t in range(1000)]
+        results = self.stream([uniform, skewed], max_time=4 * 3600,
+                              percentiles=percentiles)
+        for j, times in enumerate([uniform, skewed]):
+            values = results[j]
+            self.assertEqual(values[:3], [1000, 1000, min(times)])
+            self.assertAlmostEqual(values[3], float(sum(times)) / 1000)
+            self.assertEqual(values[4 + len(percentiles)], max(times))
+            for p, value in zip(percentiles, values[4:]):
+                self.assertLessEqual(abs(value - exact_percentile(times, p)),
+                                     BIN_WIDTH)
+
+    def test_overflow(self):
+        # travel times beyond the range of the histogram are interpolated up
+        # to the maximum, percentiles below stay within the bins
+        times = [600] * 50 + list(range(5 * 3600, 5 * 3600 + 50))
+        results = self.stream([times], max_time=None, percentiles=[25, 100])
+        values = results[0]
+        self.assertLessEqual(abs(values[4] - 600), BIN_WIDTH)
+        self.assertEqual(values[5], max(times))
+        self.assertGreaterEqual(values[5], 5 * 3600)
+
+    def test_unreachable_and_thresholds(self):
+        times = [300, None, 900, None]
+        statistics = TravelTimeStatistics(2, 1, max_time=3600,
+                                          thresholds=[600])
+        for t in times:
+            statistics.add([[t], None])
+        rows = list(statistics.pairs())
+        self.assertEqual(len(rows), 1)
+        i, j, values = rows[0]
+        self.assertEqual((i, j), (0, 0))
+        self.assertEqual(values[:4], [4, 2, 300, 600.])
+        self.assertEqual(values[-1], 0.25)
+
+    def test_pair_bytes(self):
+        # the histogram doesn't grow with the max. travel time beyond its
+        # range
+        self.assertEqual(TravelTimeStatistics.pair_bytes(max_time=10 * 3600),
+                         TravelTimeStatistics.pair_bytes())
+        self.assertLess(TravelTimeStatistics.pair_bytes(max_time=1800),
+                        TravelTimeStatistics.pair_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
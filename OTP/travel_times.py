@@ -0,0 +1,166 @@
+'''
+Streaming statistics of the travel times of pairs over multiple departure
+times (see StatisticsWriter in otp_eval)
+
+kept free of Java and the OTP bindings, so that it runs with Jython and
+with the Python of QGIS
+'''
+from array import array
+
+# width of the bins of the histogram in seconds
+BIN_WIDTH = 60
+# max. travel time in seconds covered by regular bins, longer travel times
+# are counted in a single overflow bin
+MAX_RANGE = 3 * 3600
+
+
+class TravelTimeStatistics(object):
+    '''
+    streaming statistics of the travel times between a slice of sources and
+    all targets over multiple times, the travel times of the times are added
+    one after another and can be released afterwards
+
+    every pair has accumulators of fixed size (independent of the number of
+    times): the number of reachable times, the sum, minimum and maximum of
+    the travel times, the number of times within each threshold and a
+    histogram of the travel times the percentiles are approximated from
+    (interpolated linearly within the bins, the error is at most the bin
+    width up to the range of the histogram)
+
+    the histogram has bins of fixed width up to the max. travel time (but
+    at most max_range) and an overflow bin for longer travel times,
+    percentiles falling into it are interpolated up to the maximum of the
+    pair
+
+    Parameters
+    ----------
+    n_sources: number of sources of the slice
+    n_targets: number of targets
+    max_time: optional, maximum travel time in seconds, range of the histogram
+    percentiles: optional, percentiles to approximate (0 - 100)
+    thresholds: optional, travel times in seconds to count the times within
+    bin_width: optional, width of the bins of the histogram in seconds
+    max_range: optional, max. range of the regular bins of the histogram in seconds
+    '''
+
+    def __init__(self, n_sources, n_targets, max_time=None,
+                 percentiles=[10, 50, 90], thresholds=[],
+                 bin_width=BIN_WIDTH, max_range=MAX_RANGE):
+        self.n_sources = n_sources
+        self.n_targets = n_targets
+        self.percentiles = percentiles
+        self.thresholds = thresholds
+        self.bin_width = bin_width
+        self.n_bins = self.n_bins_for(max_time, bin_width, max_range)
+        self.range = (self.n_bins - 1) * bin_width
+        self.n_times = 0
+        n_pairs = n_sources * n_targets
+        self.counts = array('i', [0]) * n_pairs
+        self.sums = array('d', [0]) * n_pairs
+        self.minima = array('i', [0]) * n_pairs
+        self.maxima = array('i', [0]) * n_pairs
+        self.within = [array('i', [0]) * n_pairs for t in thresholds]
+        self.histogram = array('i', [0]) * (n_pairs * self.n_bins)
+
+    @staticmethod
+    def n_bins_for(max_time=None, bin_width=BIN_WIDTH, max_range=MAX_RANGE):
+        '''
+        number of bins of the histogram (including the overflow bin)
+        '''
+        histogram_range = min(max_time or max_range, max_range)
+        return -(-int(histogram_range) // bin_width) + 1
+
+    @classmethod
+    def pair_bytes(cls, thresholds=[], max_time=None, bin_width=BIN_WIDTH,
+                   max_range=MAX_RANGE):
+        '''
+        memory of the accumulators of a single pair in bytes
+        '''
+        n_bins = cls.n_bins_for(max_time, bin_width, max_range)
+        return 4 * (3 + len(thresholds) + n_bins) + 8
+
+    @staticmethod
+    def columns(percentiles=[10, 50, 90], thresholds=[]):
+        '''
+        return the names of the statistics, in order of the values of pairs()
+        '''
+        names = ['times', 'reachable times', 'min travel time (sec)',
+                 'mean travel time (sec)']
+        names += ['p{:g} travel time (sec)'.format(p) for p in percentiles]
+        names.append('max travel time (sec)')
+        names += ['share within {:g} sec'.format(t) for t in thresholds]
+        return names
+
+    def add(self, travel_times):
+        '''
+        add the travel times of a time, per source of the slice (in order) the
+        travel times to all targets in seconds, None if not reachable (may be
+        None for the whole source as well)
+        '''
+        self.n_times += 1
+        counts, sums = self.counts, self.sums
+        minima, maxima = self.minima, self.maxima
+        histogram, n_bins = self.histogram, self.n_bins
+        bin_width, last_bin = self.bin_width, self.n_bins - 1
+        within = list(zip(self.thresholds, self.within))
+        for i, source_times in enumerate(travel_times):
+            if source_times is None:
+                continue
+            offset = i * self.n_targets
+            for j, travel_time in enumerate(source_times):
+                if travel_time is None:
+                    continue
+                pair = offset + j
+                if counts[pair] == 0 or travel_time < minima[pair]:
+                    minima[pair] = travel_time
+                if travel_time > maxima[pair]:
+                    maxima[pair] = travel_time
+                counts[pair] += 1
+                sums[pair] += travel_time
+                b = min(int(travel_time // bin_width), last_bin)
+                histogram[pair * n_bins + b] += 1
+                for threshold, n_within in within:
+                    if travel_time <= threshold:
+                        n_within[pair] += 1
+
+    def percentile(self, pair, p):
+        '''
+        approximate the p-th percentile of the travel times of the pair
+        '''
+        count = self.counts[pair]
+        rank = count * p / 100.
+        start = pair * self.n_bins
+        last_bin = self.n_bins - 1
+        cumulated = 0
+        value = self.maxima[pair]
+        for b in range(self.n_bins):
+            n = self.histogram[start + b]
+            if n and cumulated + n >= rank:
+                fraction = (rank - cumulated) / n
+                if b < last_bin:
+                    value = (b + fraction) * self.bin_width
+                else:
+                    lower = max(self.range, self.minima[pair])
+                    value = lower + fraction * (self.maxima[pair] - lower)
+                break
+            cumulated += n
+        return min(max(value, self.minima[pair]), self.maxima[pair])
+
+    def pairs(self):
+        '''
+        yield the index of the source in the slice, the index of the target
+        and the statistics (see columns()) of all pairs reachable at least
+        once
+        '''
+        n_times = self.n_times
+        for pair, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            values = [n_times, count, self.minima[pair],
+                      self.sums[pair] / count]
+            values += [int(round(self.percentile(pair, p)))
+                       for p in self.percentiles]
+            values.append(self.maxima[pair])
+            values += [float(n_within[pair]) / n_times
+                       for n_within in self.within]
+            yield pair // self.n_targets, pair % self.n_targets, values